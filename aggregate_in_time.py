@@ -20,25 +20,16 @@ import cftime
 import multiprocessing as mp
 import time, sys
 
+import precision
+import icar_io
+import conservation
+import output_registry
+
 
 #####################
 #   FUNCTIONS
 #####################
 
-def sum_var_3hr(ds3hr, ds1, varname, varname_dt):
-    """ Sum a 1h variable over 3 hours. ds3hr is the 3hourly dataset, ds1 the original hourly."""
-
-    # sum over 3 hours:
-    ds3hr[varname_dt]    = ds1[varname_dt].resample(time='3H').sum().astype('float64') # 64 b/c of overflow??
-     # write attrs:
-    ds3hr[varname_dt].attrs['processing_note2'] = f'summed the hourly {varname} amount over 3hours'
-    ds3hr[varname_dt].attrs['units']           = 'kg m-2'
-    ds3hr[varname_dt].attrs['standard_name']   = f'{varname}_amount_dt'
-    ds3hr[varname_dt].attrs['long_name']       = f'timestep {varname} amount '
-
-    return ds3hr
-
-
 # # # not used  # # # #
 def sum_var_24hr(ds24hr, ds1, varname, varname_dt):
     """ Sum a 1h variable over 24 hours. ds24hr is the 3hourly dataset, ds1 the original hourly."""
@@ -60,12 +51,12 @@ def sum_var_24hr(ds24hr, ds1, varname, varname_dt):
 def make_3h_monthly_file( ds_in  ): # file2load
     # """ make a 3hourly and a daily file from 1h input file. filename is destilled from input filename,  """
     """ make a 3hourly file from hourly dataset ds1 (can also be path to file(s)) """
-    print("   swe and precip are float64")
+    print(f"   dtype policy: {precision.dtype_policy}")
     # ________ Open 1h file  ____________
     # take ds or path_to_files as input:
     if isinstance( ds_in, str ) :
         try:
-            ds1 = xr.open_mfdataset(ds_in, parallel=True)
+            ds1 = icar_io.open_icar(ds_in)
         except OSError:
             print( '\n   !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!')
             print(   '   !!! OSError in file ',ds_in,' !!!')
@@ -90,39 +81,20 @@ def make_3h_monthly_file( ds_in  ): # file2load
     # varsInFile=list(ds1.data_vars) # list of variables that exist in files  Better???
 
     print(f"    input vars {list(ds1.data_vars)}")
-    all_variables = list(ds1.data_vars)
 
 
     ############################################################
     # # # # # # #              3 hourly              # # # # # #
     ############################################################
+    # the outputs (output_registry.products_3hr, default all variables) with their reduction: the timestep
+    # amounts (precip_dt, snowfall_dt, ...) summed, swe instantaneous, the rest averaged over 3 hours
+    selected = output_registry.select(3, list(ds1.data_vars))
+    ds3hr = output_registry.build(ds1, 3, selected)
 
-    ds3hr       = ds1.resample(time='3H').mean().astype('float32')
-    ds3hr.attrs = ds1.attrs
-
-    variables = all_variables.copy()
-    for var in variables:
-
-        ds3hr[var].attrs = ds1[var].attrs
-        ds3hr[var].attrs['processing_note2'] = 'computed the average over three hour from hourly output. Average include time stamp plus next two time steps.'
-
-
-    vars_to_sum={'precipitation'   : 'precip_dt',
-                 'snowfall'        : 'snowfall_dt',
-                 'cu_precipitation': 'cu_precip_dt',
-                 'graupel'         : 'graupel_dt'
-                }
-    # # # # Keep for attrs history?
-    # ds3hr.drop_vars(vars_to_sum.values) # drop the 3h mean variables, will be replaces with sum.
-
-    for varname, varname_dt in vars_to_sum.items():
-        print(f'   calculating 3hr {varname} sum' )
-        ds3hr = sum_var_3hr(ds3hr, ds1, varname, varname_dt)
-
-
-    # SWE: resample nearest iso mean? (Abby's code)
-    ds3hr['swe']              = ds1['swe'].resample(time='3H').nearest().astype('float64')
-    ds3hr['swe'].attrs['processing_note'] = 'took the instantaneous value from hourly output to three hourly data'
+    for name, (output, inputs) in selected.items():
+        if output.reduction=='sum':
+            print(f'   calculating 3hr {name} sum' )
+            conservation.account('3hr_sum', name, into=ds1[inputs[0]].sum(dtype='float64'), out=ds3hr[name].sum(dtype='float64'))
 
     ds3hr.attrs['history'] = ds3hr.attrs['history'] + ', modified to 3 hourly data (instantaneous) on '+str(datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
 
@@ -151,7 +123,7 @@ def make_yearly_24h_file( ds_in ):
     # take ds or path_to_files as input:
     if isinstance( ds_in, str ) :
         try:
-            ds1 = xr.open_mfdataset(ds_in, parallel=True)
+            ds1 = icar_io.open_icar(ds_in)
         except OSError:
             print( '\n   !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!')
             print(   '   !!! OSError in file ',ds_in,' !!!')
@@ -168,62 +140,18 @@ def make_yearly_24h_file( ds_in ):
 
 
     print(f"    input vars {list(ds1.data_vars)}")
-    all_variables = list(ds1.data_vars)
-
-    # ______ get precip _______
-    if 'precip_dt' in ds_in.data_vars:
-        precip_var='precip_dt'
-    elif 'precipitation' in ds_in.data_vars:
-        precip_var='precipitation'
-    elif 'Prec' in ds_in.data_vars:
-        precip_var='Prec'
-    else:
-        print( f"! ! !  ERROR:  define precip variable in ICAR  dataset")
-        sys.exit()
-
-    # or
-    # if precip_var=='Prec': return ds1
 
     ############################################################
     # # # # # # #              24 hourly              # # # # # #
     ############################################################
-    if 'ta2m' in ds1.data_vars:
-        # Tmax, Tmin, Wind Speed, Daily Precipitation
-        t_max          = ds1['ta2m'].resample(time='D').max(dim='time').to_dataset(name='Tmax').astype('float32')
-        t_min          = ds1['ta2m'].resample(time='D').min(dim='time').to_dataset(name='Tmin').astype('float32')
-    if 'wind_speed' not in ds1.data_vars:
-        wind_speed     = np.abs((np.sqrt(ds1['u10m']**2+ds1['v10m']**2))).resample(time='D').mean(dim='time').to_dataset(name='Wind').astype('float32')
-    # precDaily = ds1[pcp_var].diff(dim='time', label='lower').resample(time='D').sum(dim='time').to_dataset(name='Prec')
-    if 'Prec' not in ds1.data_vars:
-        precDaily = ds1[precip_var].resample(time='D').sum(dim='time').to_dataset(name='Prec').astype('float32')
-
-
-    # combine into new dataset
-    ds_daily=xr.merge([precDaily,t_max,t_min,wind_speed])
-
-    # Add Attributes
-    ds_daily.attrs=ds1.attrs
-
-
-    ds_daily['Prec'].attrs  = ds1[precip_var].attrs
-    # print( "   ds1[precip_var].attrs : ", ds1[precip_var].attrs)
-    # print( "   ds_daily['Prec'].attrs : ", ds_daily['Prec'].attrs)
-    ds_daily['Prec'].attrs['units'] = 'kg m-2 d-1'
-    ds_daily['Prec'].attrs['standard_name'] = 'precipitation_flux'
-    ds_daily['Prec'].attrs['long_name'] = 'precipitation flux per day'
-    ds_daily['Prec'].attrs['processing_note2'] = 'calculated from timestep precipitation by summation - precipitation equals the total amount of precipitation that occured throughout the day. e.g. If time stamp is 1950-01-01 00:00:00 then it is the precipitation that occured between 1950-01-01 00:00 and 1950-01-02 00:00'
-
-    ds_daily['Tmax'].attrs = ds1['ta2m'].attrs
-    ds_daily['Tmax'].attrs['non-standard_name'] = 'maximum_daily_air_temperature'
-    ds_daily['Tmax'].attrs['long_name'] = 'Bulk maximum daily air temperature at 2m'
-
-    ds_daily['Tmin'].attrs = ds1['ta2m'].attrs
-    ds_daily['Tmin'].attrs['non-standard_name'] = 'minimum_daily_air_temperature'
-    ds_daily['Tmin'].attrs['long_name'] = 'Bulk minimum daily air temperature at 2m'
-
-    ds_daily['Wind'].attrs = ds1['u10m'].attrs
-    ds_daily['Wind'].attrs['standard_name'] = 'wind_speed'
-    ds_daily['Wind'].attrs['long_name'] = '10-m wind speed independent of direction calculated as abs(sqrt(u10m^2 + v10m^2)): Daily Average'
+    # the outputs (output_registry.products_24hr, default Prec, Tmax, Tmin, Wind) whose inputs are in ds1,
+    # only their inputs are read:
+    selected = output_registry.select(24, list(ds1.data_vars))
+    ds_daily = output_registry.build(ds1, 24, selected)
+
+    for name, (output, inputs) in selected.items():
+        if output.reduction=='sum':
+            conservation.account('daily_sum', name, into=ds1[inputs[0]].sum(dtype='float64'), out=ds_daily[name].sum(dtype='float64'))
 
     ds_daily.attrs['history'] = ds_daily.attrs['history'] + ', modified to daily data on '+str(datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
 
@@ -22,6 +22,9 @@ import sys
 import cftime
 import argparse
 
+import time_axis
+import icar_io
+
 
 #################################
 #       FUNCTIONS
@@ -42,7 +45,7 @@ def process_command_line():
 def determine_time_step(path_to_files):
     """returns nr of timesteps per day (integer) """
     try:
-        ds=xr.open_mfdataset(path_to_files)
+        ds=icar_io.open_icar(path_to_files)
         # ds=xr.open_mfdataset(f"{path}/icar_*.nc")
     except OSError:
         print(f"   cannot open {path_to_files}")
@@ -50,9 +53,9 @@ def determine_time_step(path_to_files):
     # except HDFError:
     #     print(f"   cannot open ")
 
-    # Determine which month, timestep (hour or 3hr or...)
-    timestep =  (ds.time.diff(dim='time')).mean().values
-    timestep_h = int(timestep/60/60/1000/1000/1000)
+    # Determine which month, timestep (hour or 3hr or...) on the integer time axis (any calendar)
+    timestep_h = time_axis.TimeAxis.from_dataarray(ds.time).step_hours()
+    timestep   = f"{timestep_h} hours"
     ts_p_day = int(24/timestep_h)  # nr of timesteps per day
 
     print(f" Input timestep is {timestep}, or {timestep_h}hr")
@@ -81,7 +84,7 @@ def check_month(path_to_files,
     if isinstance(path_to_files, str ) :
         # print(f'   loading: {path_to_files}')
         try:
-            ds = xr.open_mfdataset( path_to_files)
+            ds = icar_io.open_icar( path_to_files)
         except OSError:
             print(f"   cannot open {path_to_files}")
             return
@@ -9,11 +9,18 @@
 #      - nr of timesteps (completeness)
 #      - nr of  variables
 #      - nr of dims, coordinates
+#   - from the sidecar (.nc.json, sidecar.py) of every output file when it is up to date, the
+#     file is only opened when its sidecar is missing or stale
+#   - the model_scen directories are checked in parallel (--nproc), files without sidecar by
+#     reading their header only (netCDF4, no data)
+#   - results are cached by file (size + mtime) in --cache, so a rerun only rechecks new / changed
+#     files, and written as a table (--report csv: one row per expected file, with status)
 #
 # To be run after main_Xhr.py /sumit_postprocess_{X}hinput.sh
 #
 # Usage: (python check_results.py --help)
 #   - $ python check_results.py [-t dt OPTIONAL]  [model OPTIONAL] [scenario OPTIONAL] [path_out OPTIONAL]
+#                               [--nproc 16] [--report check_results.csv] [--cache file]
 #   - -t = 3hr or 24hr
 #   - BUT: if you specify a scenario, also specify model
 #   - when no arguments are given, all subdirs in the default
@@ -26,14 +33,21 @@
 import pandas as pd
 from datetime import datetime, timedelta
 import xarray as xr
+import netCDF4 as nc
 import numpy as np
+import fnmatch
 import glob
+import json
 import os
 import multiprocessing as mp
 import sys
 import cftime
 import argparse
 
+import time_axis
+import icar_io
+import sidecar
+
 
 
 
@@ -52,32 +66,83 @@ def process_command_line():
                         default="/glade/campaign/ral/hap/bert/CMIP6/WUS_icar_nocp_full",
                         help='path to files (should have [model_scen] as subdirs)')
     parser.add_argument('-t',    default=None,    help="time resolution to check, either '3hr' or '24hr' ")
+    parser.add_argument('--nproc',  default=8, type=int, help='model_scen directories checked in parallel')
+    parser.add_argument('--report', default='check_results.csv', help='csv with one row per expected file')
+    parser.add_argument('--cache',  default=None,  help='results of previous checks (json), default path_out/.check_results_cache.json')
 
     return parser.parse_args()
 
+
+def header_summary(file):
+    """ summary (see file_summary) of one file from its header (+ the first 2 time values)"""
+    with nc.Dataset(file) as ds:
+        # coordinates as xarray decodes them: dimension variables + the 'coordinates' attributes
+        coords = set(d for d in ds.dimensions if d in ds.variables)
+        for v in ds.variables.values():
+            coords |= set(getattr(v, 'coordinates', '').split()) & set(ds.variables)
+        n_time, step_hours, calendar = 0, None, None
+        if 'time' in ds.variables:
+            time = ds.variables['time']
+            n_time = len(time)
+            calendar = getattr(time, 'calendar', 'standard')
+            if n_time > 1:
+                step_hours = int(round( float(time[1] - time[0]) *
+                                        time_axis.hours_per_unit[time.units.split(' since ')[0].strip().lower()] ))
+        return {'n_time'     : n_time,
+                'n_data_vars': len(set(ds.variables) - coords),
+                'n_coords'   : len(coords),
+                'n_dims'     : len(ds.dimensions),
+                'step_hours' : step_hours,
+                'calendar'   : calendar}
+
+
+def file_summary(path_to_files):
+    """ nr of timesteps, data vars, coords and dims (+ timestep, calendar) of the file(s): from the sidecar
+        of a single file (sidecar.py) when it is up to date, else from its header; several files are
+        opened (OSError if that fails)"""
+    files = sorted(glob.glob(path_to_files))
+    if len(files)==1:
+        return _single_file_summary(files[0])[0]
+
+    ds = icar_io.open_icar(path_to_files)
+    # timestep (hour or 3hr or...) on the integer time axis (any calendar)
+    ta = time_axis.TimeAxis.from_dataarray(ds.time)
+    return {'n_time'     : len(ds.time),
+            'n_data_vars': len(ds.data_vars),
+            'n_coords'   : len(list(ds.coords)),
+            'n_dims'     : len(list(ds.dims)),
+            'step_hours' : ta.step_hours(),
+            'calendar'   : ta.calendar}
+
+
+def _single_file_summary(file):
+    """ (summary, source) of one file: its sidecar or its header"""
+    info = sidecar.read(file)
+    if info is not None:
+        return {'n_time'     : info['n_time'],
+                'n_data_vars': len(info['data_vars']),
+                'n_coords'   : len(info['coords']),
+                'n_dims'     : len(info['dims']),
+                'step_hours' : info['step_hours'],
+                'calendar'   : info['calendar']}, 'sidecar'
+    return header_summary(file), 'header'
+
+
 def determine_time_step(path_to_files, print_results=True):
     """returns nr of timesteps per day (integer) """
     try:
-        ds=xr.open_mfdataset(path_to_files)
-        # ds=xr.open_mfdataset(f"{path}/icar_*.nc")
+        summary = file_summary(path_to_files)
     except OSError:
         print(f"   cannot open {path_to_files}")
         sys.exit()
     # except HDFError:
     #     print(f"   cannot open ")
 
-    # Determine which month, timestep (hour or 3hr or...)
-    timestep =  (ds.time.diff(dim='time')).mean().values
-    timestep_h = int(timestep/60/60/1000/1000/1000)
+    timestep_h = summary['step_hours']
+    timestep   = f"{timestep_h} hours"
     ts_p_day = int(24/timestep_h)  # nr of timesteps per day
 
-    try:
-        calendar=ds.time.dt.calendar
-    except:
-        try:
-            calendar=ds.time.encoding['calendar']
-        except:
-            calendar="could not determine calendar"
+    calendar = summary['calendar'] if summary['calendar'] is not None else "could not determine calendar"
 
     if print_results:
         print(f" Input timestep is {timestep}, or {timestep_h}hr")
@@ -89,6 +154,40 @@ def determine_time_step(path_to_files, print_results=True):
 ###################################
 #
 ###################################
+def year_problems(summary, year, ts_p_day=1, n_dims=3, n_coords=3, n_data_vars=4):
+    """ problems (list of messages) of a yearly 24hr file summary"""
+    problems = []
+    if summary['n_time'] < 365*ts_p_day and not (year in [2005, 2050, 2099]):
+        problems.append(f"{year} is short")
+    if summary['n_data_vars'] < n_data_vars :
+        problems.append(f"{year} has less than {n_data_vars} data vars")
+    elif summary['n_coords'] < n_coords :
+        problems.append(f"{year} has less than {n_coords} coordinates")
+    elif summary['n_dims'] < n_dims:
+        problems.append(f"{year} has less than {n_dims} dims")
+    return problems
+
+
+def month_problems(summary, m, year, ts_p_day=24, n_dims=4, n_coords=3, n_data_vars=21):
+    """ problems (list of messages) of a monthly file summary"""
+    problems = []
+    # Check length (time)
+    if m in [1,3,5,7,8,10,12] and summary['n_time'] < 31*ts_p_day: # January, March, May, July, August, October, and December
+        problems.append(f"{year} month {str(m).zfill(2)} is short")
+    elif m in [4,6,9,11] and summary['n_time'] < 30*ts_p_day:
+        problems.append(f"{year} month {str(m).zfill(2)} is short")
+    elif m==2 and summary['n_time'] < 28*ts_p_day:
+        problems.append(f"{year} month {str(m).zfill(2)} is short")
+    # CHeck nr of data_vars, coords and dims:
+    if summary['n_data_vars'] < n_data_vars :
+        problems.append(f"{year} month {str(m).zfill(2)} has less than {n_data_vars} data vars")
+    elif summary['n_coords'] < n_coords :
+        problems.append(f"{year} month {str(m).zfill(2)} has less than {n_coords} coordinates")
+    elif summary['n_dims'] < n_dims:
+        problems.append(f"{year} month {str(m).zfill(2)} has less than {n_dims} dims")
+    return problems
+
+
 def check_year(path_to_files,
                 # m,
                 year,
@@ -100,29 +199,13 @@ def check_year(path_to_files,
     """ Check yearly 24hr files for correct nr of dims, coords, data vars and timesteps."""
 
     try:
-        ds=xr.open_mfdataset(path_to_files)
-
-        # if len(ds.time) < 365*ts_p_day :
-        if len(ds.time) < 365*ts_p_day and not (year in [2005, 2050, 2099]):
-            print(f"  {year} is short")
-            err=True
-        if len(ds.data_vars) < n_data_vars :
-            print(f"  {year} has less than 21 data vars")
-            err=True
-        elif len(list(ds.coords)) < n_coords :
-            print(f"  {year} has less than 3 coordinates")
-            err=True
-        elif len(list(ds.dims)) < n_dims:
-            print(f"  {year} has less than 4 dims")
-            err=True
+        summary = file_summary(path_to_files)
+        for p in year_problems(summary, year, ts_p_day, n_dims, n_coords, n_data_vars):
+            print(f"  {p}")
     except:
         print(f"  {year} is wrong")
-        err=True
 
 
-###################################
-#
-###################################
 def check_month(path_to_files,
                 m,
                 year,
@@ -133,42 +216,135 @@ def check_month(path_to_files,
                 ):
     """check files in path_to_files for correct nr of timesteps, dims, coordinates and variables"""
 
-    err=None
     try:
-        ds=xr.open_mfdataset(path_to_files)
-        # ds=xr.open_mfdataset(f"{path}/icar_*.nc")
+        summary = file_summary(path_to_files)
     except OSError:
         print(f"   cannot open {path_to_files}")
         return
-    # except HDFError:
-    #     print(f"   cannot open ")
-
-
-    # Check length (time)
-    if m in [1,3,5,7,8,10,12] and len(ds.time) < 31*ts_p_day: # January, March, May, July, August, October, and December
-        print(f"   {year} month {str(m).zfill(2)} is short")
-        err=True
-    elif m in [4,6,9,11] and len(ds.time) < 30*ts_p_day:
-        print(f"   {year} month {str(m).zfill(2)} is short")
-        err=True
-    elif m==2 and len(ds.time) < 28*ts_p_day:
-        print(f"   {year} month {str(m).zfill(2)} is short")
-        err=True
-    # CHeck nr of data_vars, coords and dims:
-    if len(ds.data_vars) < n_data_vars :
-        print(f"   {year} month {str(m).zfill(2)} has less than 21 data vars")
-        err=True
-    elif len(list(ds.coords)) < n_coords :
-        print(f"   {year} month {str(m).zfill(2)} has less than 3 coordinates")
-        err=True
-    elif len(list(ds.dims)) < n_dims:
-        print(f"   {year} month {str(m).zfill(2)} has less than 4 dims")
-        err=True
+    for p in month_problems(summary, m, year, ts_p_day, n_dims, n_coords, n_data_vars):
+        print(f"   {p}")
 
-    # if not err: print(f"   no errors found in month {m}")
 
+###################################
+#    crawler (one model_scen dir per process)
+###################################
+def year_range(modscen):
+    """ first, last year of a model_scen directory (None if the period is unknown)"""
+    for suffix, years in [("_hist", (1950, 2005)), ("_2004", (2005, 2050)), ("_2049", (2050, 2099)),
+                          ("2005_2050", (2005, 2050)), ("2050_2099", (2050, 2099))]:
+        if modscen.endswith(suffix):
+            return years
+    return None
+
+
+def month_range(modscen, year):
+    """ months to check in year: range(m_start, m_end)"""
+    if modscen[-5:] == "_hist" and year==2005:
+        return range(1, 10)
+    elif modscen[-5:] == "_2004" and year==2005:
+        return range(10, 13)
+    elif modscen[-5:] == "_2004" and year==2050:
+        return range(1, 10)
+    elif modscen[-5:] == "_2049" and year==2050:
+        return range(10, 13)
+    elif modscen[-5:] == "_2049" and year==2099:
+        return range(1, 11)  # 2099-12 often misses last day.
+    return range(1, 13)
+
+
+def expected_files(modscen, t):
+    """ (year, month, subdir, file name pattern) of every output file expected in modscen"""
+    years = year_range(os.path.basename(modscen))
+    if years is None:
+        return []
+    y1, y2 = years
+    if t=='3hr':
+        return [ (year, m, '3hr', f"icar_*_{year}-{str(m).zfill(2)}*.nc")
+                 for year in range(y1, y2+1) for m in month_range(os.path.basename(modscen), year) ]
+    return [ (year, None, 'daily', f"[iI][cC][aA][rR]_*_{year}.nc") for year in range(y1, y2+1) ]
+
+
+def check_dir(args):
+    """ check the expected files of one model_scen dir; returns (report rows, messages, cache entries)"""
+    modscen, t, cache = args
+    if t=='3hr':
+        n_dims, n_coords, n_data_vars, ts_expected = 3, 3, 21-14, 8  # default-len(vars_to_drop) (in remove_cp.py)
+    else:
+        n_dims, n_coords, n_data_vars, ts_expected = 3, 3, 4, 1
+    expected = expected_files(modscen, t)
+    subdir   = '3hr' if t=='3hr' else 'daily'
+    try:
+        names = sorted(f for f in os.listdir(f"{modscen}/{subdir}") if f.endswith('.nc'))
+    except OSError:
+        names = []
+    if len(expected)==0:
+        return [], [f"  unknown period (scenario suffix), not checked"], {}
+    if len(names)==0:
+        return [], [f"  No {subdir} files found for {modscen}"], {}
+
+    rows, messages, new_cache = [], [], {}
+    summaries = []
+    for year, m, sub, pattern in expected:
+        row = {'model_scen': os.path.basename(modscen), 'dt': t, 'year': year, 'month': m, 'file': None, 'source': None}
+        matches = fnmatch.filter(names, pattern)
+        if len(matches)==0:
+            rows.append({**row, 'status': 'missing', 'message': 'no file'})
+            continue
+        file = f"{modscen}/{subdir}/{matches[0]}"
+        row['file'] = file
+        try:
+            st = os.stat(file)
+            hit = cache.get(file)
+            if hit is not None and hit['size']==st.st_size and hit['mtime_ns']==st.st_mtime_ns:
+                summary, source = hit['summary'], 'cache'
+            else:
+                summary, source = _single_file_summary(file)
+            new_cache[file] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'summary': summary}
+        except (OSError, RuntimeError, KeyError, ValueError) as e:
+            rows.append({**row, 'status': 'unreadable', 'message': str(e)})
+            messages.append(f"   cannot open {file}")
+            continue
+        summaries.append( (len(rows), summary) )
+        rows.append({**row, 'source': source, **summary})
+
+    # nr of timesteps per day from the data (first file with a timestep):
+    steps = [s['step_hours'] for i, s in summaries if s['step_hours']]
+    ts_per_day = int(24/steps[0]) if len(steps) > 0 else ts_expected
+    if not ts_per_day==ts_expected: messages.append(f"\n ! ! ! ts_per_day={ts_per_day} ! ! !\n")
+
+    for i, summary in summaries:
+        row = rows[i]
+        if t=='3hr':
+            problems = month_problems(summary, row['month'], row['year'], ts_per_day, n_dims, n_coords, n_data_vars)
+        else:
+            problems = year_problems(summary, row['year'], ts_per_day, n_dims, n_coords, n_data_vars)
+        row['status']  = 'ok' if len(problems)==0 else 'error'
+        row['message'] = '; '.join(problems)
+        messages += [f"   {p}" for p in problems]
+    messages += [f"   {r['year']} {'' if r['month'] is None else 'month '+str(r['month']).zfill(2)} missing"
+                 for r in rows if r['status']=='missing']
+    return rows, messages, new_cache
+
+
+def read_cache(cache_file):
+    if cache_file is None or not os.path.exists(cache_file):
+        return {}
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except ValueError:
+        print(f"   ! could not read the cache {cache_file}, checking all files")
+        return {}
 
 
+def write_cache(cache_file, cache):
+    tmp = f"{cache_file}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp, cache_file)
+    except OSError as e:
+        print(f"   ! could not write the cache {cache_file}: {e}")
 
 
 #################################
@@ -183,7 +359,7 @@ if __name__ == '__main__':
     scenario    = args.scenario  # default=None
     path_out    = args.path_out  # default="/glade/campaign/ral/hap/bert/CMIP6/WUS_icar_nocp_full"
     t           = args.t
-
+    cache_file  = args.cache if args.cache is not None else f"{path_out}/.check_results_cache.json"
 
 
 
@@ -196,6 +372,7 @@ if __name__ == '__main__':
     else:
         # get a list of all model_scenario directories in path:
         dirs = sorted(glob.glob(f"{path_out}/*"))
+    dirs = [d for d in dirs if os.path.isdir(d) and not os.path.basename(d).startswith("old_")]
 
 
     # _________  Print general info: __________
@@ -205,106 +382,28 @@ if __name__ == '__main__':
     for ms in dirs: print(f"#      {ms.split('/')[-1]} ")
     print(f"#\n#######################################################################\n")
 
-
-    # _________  check monthly 3hr results: __________
-    if t is None or t=='3hr':
-        print(f"\n**********   checking 3hr monthly results  ***************  ")
-        for modscen in dirs:
-
-            if modscen[:4]=="old_": continue
-
-            print("\n", modscen.split('/')[-1])
-
-            if modscen[-5:] == "_hist":
-                y1=1950; y2=2005
-            elif modscen[-5:] == "_2004":
-                y1=2005; y2=2050
-            elif modscen[-5:] == "_2049":
-                y1=2050; y2=2099
-
-
-            # # #   file characteristics to check for (timestep is derived from data)
-            n_dims =3 ; n_coords=3 ;n_data_vars=21-14 # default-len(vars_to_drop) (in remove_cp.py)
-
-            # determine timestep (nr of timesteps per day): (could just harcode?)
-            ts_per_day = determine_time_step(f"{modscen}/3hr/icar_*_{y1}-{str(10).zfill(2)}*.nc",
-                                            print_results=False
-                                            )
-            if not ts_per_day==8: print(f"\n ! ! ! ts_per_day={ts_per_day} ! ! !\n")
-
-            for year in range(y1, y2+1):
-                # set start and end month to check based on year and scenario:
-                m_start=1 ; m_end=13
-                if modscen[-5:] == "_hist" and year==2005:
-                    m_end=10
-                elif modscen[-5:] == "_2004" and year==2005:
-                    m_start=10
-                elif modscen[-5:] == "_2004" and year==2050:
-                    m_end=10
-                elif modscen[-5:] == "_2049" and year==2050:
-                    m_start=10
-                elif modscen[-5:] == "_2049" and year==2099:
-                    m_end=11  # 2099-12 often misses last day.
-                else:
-                    m_start=1 ; m_end=13
-
-                for m in range(m_start,m_end):
-                    path_m = f"{modscen}/3hr/icar_*_{year}-{str(m).zfill(2)}*.nc"
-
-                    check_month(path_m, m, year,
-                                ts_p_day    = ts_per_day,
-                                n_dims      = n_dims,
-                                n_coords    = n_coords,
-                                n_data_vars = n_data_vars
-                                )
-
-    if t is None or t=='24hr':
-        # _________  check Yearly 24hr results: __________
-        print(f"\n**********   checking 24hr yearly results  ***************")
-        for modscen in dirs:
-
-            print("\n", modscen.split('/')[-1])
-
-            if modscen[-5:] == "_hist":
-                y1=1950; y2=2005
-            elif modscen[-5:] == "_2004":
-                y1=2005; y2=2050
-            elif modscen[-5:] == "_2049":
-                y1=2050; y2=2099
-            elif modscen[-5:] == "2005_2050":
-                y1=2005; y2=2050
-            elif modscen[-5:] == "2050_2099":
-                y1=2050; y2=2099
-
-
-            # # #   file characteristics to check for (timestep is derived from data)
-            n_dims =3 ; n_coords=3 ;n_data_vars=4 # default-len(vars_to_drop) (in remove_cp.py)
-
-            if len(glob.glob(f"{modscen}/daily/*"))==0:
-                print(f"  No daily files found for {modscen}")
-                continue
-
-            # determine timestep (nr of timesteps per day): (could just harcode?)
-            if len(glob.glob(f"{modscen}/daily/icar_*_{y1}.nc"))>0:
-                file_ts=f"{modscen}/daily/icar_*_{y1}.nc"
-                prefix="icar"
-            elif len(glob.glob(f"{modscen}/daily/ICAR_*_{y1}.nc"))>0:
-                file_ts=f"{modscen}/daily/ICAR_*_{y1}.nc"
-                prefix="ICAR"
-
-            ts_per_day = determine_time_step(file_ts,
-                                            print_results=False
-                                            )
-            if not ts_per_day==1: print(f"\n ! ! ! ts_per_day={ts_per_day} ! ! !\n")
-
-            for year in range(y1, y2+1):
-                # print(f"- - -  {year}  - - -")
-                path_y = f"{modscen}/daily/{prefix}_*_{year}.nc"
-
-                check_year( path_y, #glob.glob(path_y)[0],
-                            year,
-                            ts_p_day    = ts_per_day,
-                            n_dims      = n_dims,
-                            n_coords    = n_coords,
-                            n_data_vars = n_data_vars
-                            )
+    cache = read_cache(cache_file)
+    rows  = []
+
+    for dt in ['3hr', '24hr']:
+        if t is not None and t!=dt:
+            continue
+        print(f"\n**********   checking {'3hr monthly' if dt=='3hr' else '24hr yearly'} results  ***************  ")
+
+        # fan out over the model_scen directories, each with the cache entries of its files:
+        tasks = [ (modscen, dt, {f: e for f, e in cache.items() if f.startswith(f"{modscen}/")}) for modscen in dirs ]
+        with mp.Pool(max(1, min(args.nproc, len(tasks)))) as pool:
+            for modscen, (dir_rows, messages, dir_cache) in zip(dirs, pool.imap(check_dir, tasks)):
+                print("\n", modscen.split('/')[-1])
+                for msg in messages: print(msg)
+                rows += dir_rows
+                cache.update(dir_cache)
+
+    write_cache(cache_file, cache)
+
+    report = pd.DataFrame(rows)
+    if len(report) > 0:
+        report['month'] = report['month'].astype('Int64')
+        report.to_csv(args.report, index=False)
+        print(f"\n   {len(report)} files expected: {report.status.value_counts().to_dict()}, "
+              f"{(report.source=='cache').sum()} from the cache; report written to {args.report}")
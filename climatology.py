@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# coding: utf-8
+######################################################################################################
+#
+# Monthly climatology and precipitation extremes, accumulated from the daily output of a year while
+# it is in memory (iso re-reading the written archive):
+#    - per month and pixel: sum and count of every daily variable (Prec, Tmax, Tmin, Wind, ...), and
+#      for Prec the nr of wet days (Prec >= wet_threshold) and the maximum
+#    - per pixel: a fixed-bin histogram of the daily Prec of the whole year (log spaced bins, bin_edges),
+#      the sketch the percentiles are estimated from (exact to the bin, linear inside the bin)
+#    - written per model / scenario / year (clim_dir/{model}_{scenario}/clim_{model}_{scen}_{year}.nc);
+#      all accumulators are sums / counts / maxima, so any set of years merges exactly (merge()) and a
+#      multi-decade climatology does not touch the daily files
+#    - products(): monthly means, wet-day frequency, Prec max and the Prec percentiles (all days and
+#      wet days) of the merged accumulators
+#
+# Usage:
+#   set clim_dir in main_24hr.py / main_24hr_from3hinput.py / main_3hr_24hr_from3hinput.py
+#   python climatology.py "clim_dir/MODEL_ssp245_2049/clim_*_205[0-9].nc" clim_2050s.nc [--percentiles 95 99]
+#
+######################################################################################################
+
+import argparse
+import xarray as xr
+import numpy as np
+import datetime
+import glob
+import os
+
+import conservation
+
+
+#########################################
+#         SETTTINGS
+#######################################
+wet_threshold = 1.0   # kg m-2 d-1, a wet day has Prec >= wet_threshold
+# histogram bins of daily Prec (kg m-2 d-1): [0, 0.1), 32 log spaced bins per decade from 0.1 to 1000, [1000, inf)
+bin_edges     = np.concatenate([[0.], 10**np.arange(-1, 3 + 1/64, 1/32), [np.inf]])
+percentiles   = [95, 99]
+
+
+def process_command_line():
+    '''Parse the commandline'''
+    parser = argparse.ArgumentParser(description='merge yearly climatology files and write the climatology products')
+    parser.add_argument('files',                               help='yearly climatology files (glob, quoted)')
+    parser.add_argument('file_out',                            help='file to write the products to')
+    parser.add_argument('--percentiles', default=percentiles, nargs='+', type=float, help='Prec percentiles')
+    parser.add_argument('--merged',      default=None,         help='also write the merged accumulators to this file')
+
+    return parser.parse_args()
+
+
+class Climatology:
+    """ monthly sums / counts and the daily Prec histogram of the added days"""
+
+    def __init__(self):
+        self.acc    = {}     # name: accumulator array
+        self.coords = None   # lat / lon of the grid
+        self.attrs  = {}     # attrs of the variables
+        self.years  = set()
+
+    def _init(self, ds, names):
+        ny, nx = ds.sizes['lat_y'], ds.sizes['lon_x']
+        for v in names:
+            self.acc[f'{v}_sum']   = np.zeros((12, ny, nx), dtype='float64')
+            self.acc[f'{v}_count'] = np.zeros((12, ny, nx), dtype='int32')
+        if 'Prec' in names:
+            self.acc['Prec_wet_days'] = np.zeros((12, ny, nx), dtype='int32')
+            self.acc['Prec_max']      = np.full((12, ny, nx), np.nan, dtype='float32')
+            self.acc['Prec_hist']     = np.zeros((len(bin_edges)-1, ny, nx), dtype='int32')
+        self.coords = {c: ds[c].values for c in ['lat', 'lon'] if c in ds.coords}
+        self.attrs  = {v: dict(ds[v].attrs) for v in names}
+
+    def add(self, ds):
+        """ add the days of the daily dataset ds (the daily variables with dims time, lat_y, lon_x).
+            ds is computed (with the pending mass accounts, conservation.py) if it is not in memory;
+            returns the computed ds, so the write does not compute it again"""
+        ds, = conservation.compute(ds)
+        names = [v for v in ds.data_vars if ds[v].dims==('time', 'lat_y', 'lon_x')]
+        if len(self.acc)==0:
+            self._init(ds, names)
+
+        months = ds.time.dt.month.values
+        self.years.update(int(y) for y in np.unique(ds.time.dt.year.values))
+        for m in np.unique(months):
+            sel = months==m
+            for v in names:
+                x = ds[v].values[sel]
+                self.acc[f'{v}_sum'][m-1]   += np.nansum(x, axis=0, dtype='float64')
+                self.acc[f'{v}_count'][m-1] += np.sum(~np.isnan(x), axis=0, dtype='int32')
+            if 'Prec' in names:
+                x = ds['Prec'].values[sel]
+                self.acc['Prec_wet_days'][m-1] += np.sum(x >= wet_threshold, axis=0, dtype='int32')
+                with np.errstate(invalid='ignore'):
+                    self.acc['Prec_max'][m-1] = np.fmax(self.acc['Prec_max'][m-1], np.nanmax(x, axis=0))
+                self._add_hist(x)
+        return ds
+
+    def _add_hist(self, x):
+        """ count the values x (time, y, x) in their bins, per pixel"""
+        nb, ny, nx = self.acc['Prec_hist'].shape
+        valid = ~np.isnan(x)
+        b     = np.clip(np.searchsorted(bin_edges, np.where(valid, x, 0), side='right') - 1, 0, nb-1)
+        pix   = np.broadcast_to(np.arange(ny*nx).reshape(1, ny, nx), x.shape)
+        self.acc['Prec_hist'] += np.bincount((b*ny*nx + pix)[valid], minlength=nb*ny*nx).reshape(nb, ny, nx).astype('int32')
+
+    def to_dataset(self):
+        """ the accumulators as a Dataset (dims month, bin, lat_y, lon_x)"""
+        ds = xr.Dataset(coords={'month': np.arange(1, 13), 'bin_lower': ('bin', bin_edges[:-1]), 'bin_upper': ('bin', bin_edges[1:])})
+        for c, values in self.coords.items():
+            ds.coords[c] = (('lat_y', 'lon_x'), values)
+        for name, a in self.acc.items():
+            ds[name] = (('bin' if name.endswith('_hist') else 'month', 'lat_y', 'lon_x'), a)
+        for v, attrs in self.attrs.items():
+            ds[f'{v}_sum'].attrs = {k: attrs[k] for k in ['units', 'long_name'] if k in attrs}
+        ds.attrs = {'description'  : 'monthly sums / counts of the daily output and histogram of daily Prec (climatology.py), merge by summing',
+                    'years'        : ' '.join(str(y) for y in sorted(self.years)),
+                    'wet_threshold': wet_threshold,
+                    'history'      : 'created on '+str(datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S"))}
+        return ds
+
+    def write(self, file_out):
+        """ write the accumulators (atomically, tmp file + rename)"""
+        os.makedirs(os.path.dirname(file_out), exist_ok=True)
+        tmp = f"{file_out}.{os.getpid()}.tmp"
+        ds  = self.to_dataset()
+        ds.to_netcdf(tmp, encoding={v: {'zlib': True, 'complevel': 1} for v in ds.data_vars})
+        os.replace(tmp, file_out)
+        print(f"   climatology of {ds.attrs['years']} written to {file_out}")
+
+
+def merge(files):
+    """ the accumulators of the yearly files summed (maxima: max), as one Dataset"""
+    merged = None
+    for f in files:
+        with xr.open_dataset(f) as ds:
+            ds = ds.load()
+        if merged is None:
+            merged = ds
+            continue
+        if ds.attrs['wet_threshold']!=merged.attrs['wet_threshold'] or not np.array_equal(ds.bin_lower, merged.bin_lower):
+            raise ValueError(f"{f}: other wet_threshold / histogram bins than {files[0]}, cannot merge")
+        for v in merged.data_vars:
+            if v.endswith('_max'):
+                merged[v] = np.fmax(merged[v], ds[v])
+            else:
+                merged[v] = merged[v] + ds[v]
+        merged.attrs['years'] = merged.attrs['years'] + ' ' + ds.attrs['years']
+    return merged
+
+
+def hist_percentile(hist, lower, upper, q, vmax=None):
+    """ percentile q (0-100) per pixel of the histogram hist (bin, y, x), linear inside the bin
+        (the open last bin ends at vmax)"""
+    n      = hist.sum(axis=0)
+    cum    = np.cumsum(hist, axis=0)
+    target = q / 100. * n
+    i      = np.argmax(cum >= target[None], axis=0)   # the bin of the percentile
+    before = np.take_along_axis(cum, i[None], axis=0)[0] - np.take_along_axis(hist, i[None], axis=0)[0]
+    count  = np.take_along_axis(hist, i[None], axis=0)[0]
+    lo, hi = lower[i], upper[i]
+    if vmax is not None:
+        hi = np.where(np.isinf(hi), vmax, hi)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        frac = np.clip((target - before) / count, 0, 1)
+        out  = lo + frac * (hi - lo)
+    return np.where(n > 0, out, np.nan).astype('float32')
+
+
+def products(acc, percentiles=percentiles):
+    """ monthly means, wet-day frequency, Prec max and percentiles of the (merged) accumulators"""
+    out = xr.Dataset(coords={c: acc[c] for c in ['month', 'lat', 'lon'] if c in acc.coords})
+    names = [v[:-4] for v in acc.data_vars if v.endswith('_sum')]
+    for v in names:
+        out[f'{v}_mean'] = (acc[f'{v}_sum'] / acc[f'{v}_count'].where(acc[f'{v}_count'] > 0)).astype('float32')
+        out[f'{v}_mean'].attrs = {**acc[f'{v}_sum'].attrs, 'cell_methods': 'time: mean within months'}
+    if 'Prec_hist' in acc:
+        thr = acc.attrs['wet_threshold']
+        out['wet_day_freq'] = (acc['Prec_wet_days'] / acc['Prec_count'].where(acc['Prec_count'] > 0)).astype('float32')
+        out['wet_day_freq'].attrs = {'long_name': f'fraction of days with Prec >= {thr} kg m-2 d-1'}
+        out['Prec_max'] = acc['Prec_max']
+        out['Prec_max'].attrs = {'units': 'kg m-2 d-1', 'long_name': 'maximum daily precipitation per month'}
+        hist  = acc['Prec_hist'].values
+        lower = acc['bin_lower'].values
+        upper = acc['bin_upper'].values
+        vmax  = acc['Prec_max'].max('month').values
+        wet   = np.where((lower >= thr)[:, None, None], hist, 0)   # thr is a bin edge: only the wet days
+        for q in percentiles:
+            name = f"Prec_p{q:g}"
+            out[name]        = (('lat_y', 'lon_x'), hist_percentile(hist, lower, upper, q, vmax))
+            out[name].attrs  = {'units': 'kg m-2 d-1', 'long_name': f'{q:g}th percentile of daily precipitation (all days, from the histogram)'}
+            out[f"{name}_wet"]       = (('lat_y', 'lon_x'), hist_percentile(wet, lower, upper, q, vmax))
+            out[f"{name}_wet"].attrs = {'units': 'kg m-2 d-1', 'long_name': f'{q:g}th percentile of daily precipitation on wet days (>= {thr} kg m-2 d-1)'}
+    out.attrs = {'description': 'monthly climatology and daily precipitation extremes (climatology.py)',
+                 'years'      : acc.attrs['years'],
+                 'history'    : 'created on '+str(datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S"))}
+    return out
+
+
+###########################
+#     MAIN
+###########################
+if __name__=="__main__":
+
+    args  = process_command_line()
+    files = sorted(glob.glob(args.files))
+    if len(files)==0:
+        print(f"   no climatology files found for {args.files}")
+    else:
+        acc = merge(files)
+        print(f"   merged {len(files)} files, years {acc.attrs['years']}")
+        if args.merged is not None:
+            acc.to_netcdf(args.merged)
+            print(f"   written {args.merged}")
+        products(acc, args.percentiles).to_netcdf(args.file_out)
+        print(f"   written {args.file_out}")
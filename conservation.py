@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# coding: utf-8
+######################################################################################################
+#
+# Mass conservation ledger of the precipitation through the stages of a run:
+#    - the modules add domain totals (sums in float64, lazy) with account(check, var, into=, out=,
+#      removed=, clipped=): what went into a step, what came out, what was removed on purpose
+#      (GCM cp) and what was added by setting values < 0 to 0 (clipped)
+#        neg_pcp   (fix_neg_pcp.py)       cumulative -> timestep amounts, on the timesteps that were not
+#                                         repaired (the mass changed by the repair is recorded as 'repaired')
+#        3hr_sum   (aggregate_in_time.py) 1h -> 3hr sums
+#        daily_sum (aggregate_in_time.py) timestep -> daily Prec
+#        remove_cp (remove_cp.py)         pcp - GCM cp * units_conv, < 0 -> 0
+#    - the sums are not computed on their own: they are computed with the next compute of the
+#      pipeline (compute(), used for the writes, the daily aggregation and the cp removal), so they
+#      share the reads of the data they sum
+#    - checked: out == into - removed + clipped, within the relative tolerance; every check is
+#      printed and written to the run log (instrument.py, stage 'conservation', tagged with the
+#      month / stage it was made in), deviations beyond the tolerance are flagged
+#    - without a Ledger (e.g. sweep_cp.py) account() does nothing
+#
+# Usage:
+#   set conservation_tol in the main_*.py drivers
+#   python conservation.py "run_log_dir/*.jsonl" [--all]     (the flagged / all checks of the run logs)
+#
+######################################################################################################
+
+import argparse
+import numpy as np
+import dask
+import glob
+
+import instrument
+
+
+active = None   # the Ledger of the current run, used by account() / compute()
+
+
+def process_command_line():
+    '''Parse the commandline'''
+    parser = argparse.ArgumentParser(description='mass conservation checks in the run logs')
+    parser.add_argument('logs',                           help='run log files (glob, quoted)')
+    parser.add_argument('--all',  action='store_true',    help='show all checks, not only the flagged ones')
+
+    return parser.parse_args()
+
+
+def _num(x):
+    """ json number (None for nan / inf)"""
+    x = float(x)
+    return x if np.isfinite(x) else None
+
+
+class Ledger:
+    """ the pending and checked mass accounts of one run"""
+
+    def __init__(self, tolerance=1e-4):
+        self.tolerance = tolerance
+        self._pending  = []     # (tags, {name: lazy sum})
+        self.n_checked = 0
+        self.flagged   = []
+        global active
+        active = self
+
+    def account(self, check, var, checked=True, **sums):
+        """ add the sums (into, out, removed, clipped, ...) of a step, computed with the next compute()"""
+        tags = {'check': check, 'var': var, 'checked': checked, **instrument.context()}
+        self._pending.append( (tags, sums) )
+
+    def settle(self, values):
+        """ check and log the pending accounts, values: their computed sums"""
+        pending, self._pending = self._pending, []
+        for (tags, _), sums in zip(pending, values):
+            self._check(tags, {k: float(v) + 0. for k, v in sums.items()})   # (no -0)
+
+    def _check(self, tags, sums):
+        expected  = sums['into'] - sums.get('removed', 0.) + sums.get('clipped', 0.)
+        deviation = sums['out'] - expected
+        rel_dev   = deviation / abs(sums['into']) if sums['into']!=0 else deviation
+        ok = (not tags['checked']) or bool(abs(rel_dev) <= self.tolerance)
+        record = {**tags, **{k: _num(v) for k, v in sums.items()}, 'deviation': _num(deviation), 'rel_dev': _num(rel_dev), 'ok': ok}
+        self.n_checked += 1
+        if not ok:
+            self.flagged.append(record)
+        if instrument.active is not None:
+            instrument.active.record('conservation', **record)
+
+        month = f" month {record['month']}" if 'month' in record else ''
+        extra = ', '.join(f"{k} {v:.6g}" for k, v in sums.items() if k not in ['into', 'out'])
+        flag  = '' if ok else f"   ! ! ! beyond tolerance {self.tolerance} ! ! !"
+        result = f"rel. deviation {rel_dev:.2e}" if tags['checked'] else f"added {deviation:.6g}"
+        print(f"   conservation {tags['check']} {tags['var']}{month}: in {sums['into']:.6g}, out {sums['out']:.6g}"
+              f"{', '+extra if extra else ''} kg m-2 (domain sum), {result}{flag}")
+
+    def finish(self):
+        """ check what is still pending, print the summary"""
+        if len(self._pending) > 0:
+            values, = dask.compute([s for _, s in self._pending])
+            self.settle(values)
+        print(f"   conservation: {self.n_checked} checks, {len(self.flagged)} beyond tolerance {self.tolerance}")
+        global active
+        if active is self:
+            active = None
+
+
+def account(check, var, checked=True, **sums):
+    """ account of the active run, a no-op without a Ledger"""
+    if active is not None:
+        active.account(check, var, checked=checked, **sums)
+
+
+def compute(*args):
+    """ dask.compute(*args), with the pending sums of the active Ledger in the same compute"""
+    if active is None or len(active._pending)==0:
+        return dask.compute(*args)
+    *results, values = dask.compute(*args, [s for _, s in active._pending])
+    active.settle(values)
+    return tuple(results)
+
+
+###########################
+#     MAIN
+###########################
+if __name__=="__main__":
+
+    args = process_command_line()
+    logs = instrument.read_logs(sorted(glob.glob(args.logs)))
+    if len(logs)==0 or 'stage' not in logs.columns or (logs.stage=='conservation').sum()==0:
+        print(f"   no conservation records in {args.logs}")
+    else:
+        checks = logs[logs.stage=='conservation'].dropna(axis=1, how='all')
+        print(f"   {len(checks)} checks, {(~checks.ok.astype(bool)).sum()} beyond tolerance")
+        if not args.all:
+            checks = checks[~checks.ok.astype(bool)]
+        cols = [c for c in ['model', 'scenario', 'year', 'dt', 'month', 'in_stage', 'check', 'var',
+                            'into', 'out', 'removed', 'clipped', 'repaired', 'rel_dev'] if c in checks.columns]
+        print(checks[cols].to_string(index=False))
@@ -23,6 +23,7 @@
 import argparse
 import xarray as xr
 import numpy as np
+import dask
 import glob
 import os
 import datetime
@@ -32,6 +33,10 @@ import multiprocessing as mp
 import time
 import sys
 
+import precision
+import icar_io
+import conservation
+
 ##################################        USER SETTINGS        ##################################
 #
 # !!!   N.B. settings in batch submit script!!!!
@@ -57,11 +62,89 @@ def process_command_line():
     return parser.parse_args()
 
 
+##############################################################################################
+#      column kernel: cumulative -> repaired timestep amounts, in one output buffer          #
+##############################################################################################
+def repair_rows(dt, bad, left=None, right=None):
+    """ in place: replace the bad rows (timesteps) of dt by linear interpolation between the nearest
+        good rows and set values < 0 to 0. The interpolation weights only depend on the timestep, so
+        they are the same for every pixel. Bad rows without a good row on both sides become NaN (as
+        interpolate_na). left / right: optional good rows just before / after dt (anchors). Returns dt"""
+    n    = len(dt)
+    bad  = np.asarray(bad[:n], dtype=bool)
+    good = np.where(~bad)[0]
+    if left is not None:
+        good = np.concatenate([[-1], good])
+    if right is not None:
+        good = np.concatenate([good, [n]])
+    ibad = np.where(bad)[0]
+    k    = np.searchsorted(good, ibad)          # first good row after each bad row
+
+    row  = lambda j: left if j < 0 else (right if j==n else dt[j])
+    for i, ki in zip(ibad, k):
+        if ki==0 or ki==len(good):
+            dt[i] = np.nan
+            continue
+        lo, hi = good[ki-1], good[ki]
+        w = (i - lo) / (hi - lo)
+        # dt[i] = lo + w*(hi-lo), without temporaries:
+        np.subtract(row(hi), row(lo), out=dt[i], casting='same_kind')
+        dt[i] *= w
+        dt[i] += row(lo)
+
+    # there can still be very small neg values (between 0 and neg_thresh). These we set to zero:
+    np.maximum(dt, 0, out=dt)
+    return dt
+
+
+def repair_columns(cum, boundary, bad, out=None, dtype='float32'):
+    """ cum: (time, ...) cumulative values, boundary: first timestep(s) of the next file (or None),
+        bad: boolean per diff timestep (len(cum)-1+len(boundary)). Writes the repaired, non-negative
+        timestep amounts (label='lower') into out (len(cum) rows, allocated if None) and returns it.
+        Rows without a next value are NaN."""
+    nt = len(cum)
+    nb = 0 if boundary is None else len(boundary)
+    if out is None:
+        out = np.empty(cum.shape, dtype=dtype)
+
+    np.subtract(cum[1:], cum[:-1], out=out[:nt-1], casting='same_kind')
+    if nb > 0:
+        np.subtract(boundary[0], cum[-1], out=out[nt-1], casting='same_kind')
+    else:
+        out[nt-1] = np.nan
+
+    # a bad last timestep is interpolated towards the diff of the next file's first 2 timesteps:
+    right = None
+    if nb > 1 and bad[nt-1] and not bad[nt]:
+        right = np.subtract(boundary[1], boundary[0], dtype=out.dtype)
+
+    return repair_rows(out, bad, right=right)
+
+
 ##############################################################################################
 #      calculate timestep amount from cumulative variable, and correct negative values       #
 ##############################################################################################
-def correct_var(ds1, varname, varname_dt, ds2=None, neg_thrsh=neg_thrsh):
-    """ takes a cumulative variable and returns the timestep version of that variable without negative values"""
+def with_next(ds1, varname, ds2=None):
+    """ varname with the first 2 timesteps of the next file added (2: in case the last timestep is negative),
+        in one chunk along time (for the interpolation)"""
+    if ds2 is not None:
+        return xr.concat([ds1[varname], ds2[varname][:2]], dim='time').chunk({"time": -1, "lat_y": "auto", "lon_x": "auto"})
+    else: # year=2099 or 2049 without 2050
+        return ds1[varname].chunk({"time": -1, "lat_y": "auto", "lon_x": "auto"})
+
+
+def find_bad_steps(pcp, neg_thrsh=neg_thrsh):
+    """ timesteps (of the diff of cumulative pcp) with values < neg_thrsh anywhere, and the min per timestep.
+        A reduction over space, the diff is not kept in memory."""
+    pcp_dt    = pcp.diff(dim='time', label='lower')
+    space     = [d for d in pcp_dt.dims if d!='time']
+    bad, tmin = dask.compute( (pcp_dt < neg_thrsh).any(dim=space).data, pcp_dt.min(dim=space).data )
+    return np.asarray(bad), np.asarray(tmin)
+
+
+def correct_var(ds1, varname, varname_dt, ds2=None, neg_thrsh=neg_thrsh, bad_steps=None):
+    """ takes a cumulative variable and returns the timestep version of that variable without negative values.
+        bad_steps: the negative timesteps if already known (glitch_index), skips the detection"""
 
     print(f"\n   correcting negative {varname} ...")
 
@@ -70,81 +153,46 @@ def correct_var(ds1, varname, varname_dt, ds2=None, neg_thrsh=neg_thrsh):
         # return ds1
         sys.exit(f" \n ! ! !   {varname} not found in data_vars. Already corrected?   ! ! ! \n")
 
-    remove_last=False
-    # add last timestep of next file so we can calculate the difference: (need one chunk along time dim for interpolation)
-    # if has_nextyearfiles:
-    if ds2 is not None:
-        pcp = xr.concat([ds1[varname], ds2[varname][0]], dim='time').chunk({"time": -1, "lat_y": "auto", "lon_x": "auto"})
-    else: # year=2099 or 2049 without 2050
-        pcp = ds1[varname].chunk({"time": -1, "lat_y": "auto", "lon_x": "auto"})
-
-    # calc timestep amount from cumulative:
-    pcp_dt = pcp.diff(dim='time', label='lower')#.load()
+    nt  = len(ds1.time)
+    pcp = with_next(ds1, varname, ds2)
 
     # 1. where are the negative values?
-    idx = np.where( pcp_dt.values < neg_thrsh ) #-0.0001 )
-    print(f'      {len(np.unique(idx[0]))} negative timesteps found:')
-    for i in range(len( np.unique(idx[0]))):
-        print( '      ', pcp_dt.time[np.unique(idx[0])[i]].values, '   ',np.round(pcp_dt[np.unique(idx[0])[i]].min().values,2)  )
-
-    # # 2.A replace w nans (only neg values)
-    # pcp_na       = xr.where(  pcp_dt< neg_thrsh,    #-0.000001 ,       # cond
-    #                           np.nan ,              # when cond is T
-    #                           pcp_dt                # when cond is F
-    #                         )
-    # print(f'      negative {varname} replaced w NaNs' )
-
-
-    print(f"   nans before: {np.sum(pcp_dt.isnull().values)}")
-    # # 2.B replace w nans (all values in suspect timestep)
-    idx = np.where( pcp_dt.values < neg_thrsh ) # return indices
-    a = np.empty(pcp_dt.isel(time=0).shape)
-    a[:] = np.nan
-    for i in range(len(np.unique(idx[0]))):
-        # pcp_dt[np.unique(idx[0])[i],:,:].values = a
-        pcp_dt[np.unique(idx[0])[i],:,:] = a
-
-    print(f"   nans afer: {np.sum(pcp_dt.isnull().values)}")
-    # print(f"   equals #timesteps: {np.sum(pcp_dt.isnull().values)/439/319 }")
-
-    # 3. check?
-    # Think about edge cases:
-       # a. first value idx[0][0]==0 is negative? -> load previous file and redo?
-       # b. last value idx[0][-1]==-1 is negative? -> ...
-    if len(np.unique(idx[0]))>0 and  pcp_dt.time[np.unique(idx[0])[-1]].values ==  pcp_dt.time[-1].values :
-        print( "\n !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!! \n !!!    last timestep is negative, loading one more timestep...  !!! \n !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!" )
-        if ds2 is not None: # otherwise not much we can do..
-            # redo the calculation with one additional timestep
-            pcp = xr.concat([ds1[varname], ds2[varname][:2]], dim='time').chunk({"time": -1, "lat_y": "auto", "lon_x": "auto"})
-            pcp_dt = pcp.diff(dim='time', label='lower')
-            remove_last=True # flag to remember to take the last timestep off again later.
-
-            # look for neg values again:
-            idx = np.where( pcp_dt.values < neg_thrsh ) # return indices
-            a = np.empty(pcp_dt.isel(time=0).shape)
-            a[:] = np.nan
-            for i in range(len(np.unique(idx[0]))):
-                pcp_dt[np.unique(idx[0])[i],:,:] = a
-
-    # 4. interpolate nans
-    # pcp_dt_pos = pcp_na.interpolate_na(dim="time", method='linear'   )
-    pcp_dt_pos = pcp_dt.interpolate_na(dim="time", method='linear'   )
-    print('      NaNs interpolated' )
-
-    # check final reslult:
-    idx2 = np.where( pcp_dt_pos< neg_thrsh) # -0.0001 )
-    print(f'      {len(np.unique(idx2[0]))} negative timesteps found in corrected data:')
-    for i in range(len( np.unique(idx2[0]))):
-        print( '      ', pcp_dt_pos.time[np.unique(idx2[0])[i]].values, '   ',np.round(pcp_dt[np.unique(idx2[0])[i]].min().values,2) ) # time should be same(?)
-
-    # 5. there can still be very small neg values (between 0 and neg_thresh). These we set to zero:
-    pcp_dt_pos = xr.where(pcp_dt_pos<0,0, pcp_dt_pos)
-
-    # 6. add corrected timestep-precipitation to dataset
-    if remove_last or (ds2 is None):
-        ds1[varname_dt] = pcp_dt_pos[:-1]
+    if bad_steps is None:
+        bad, tmin = find_bad_steps(pcp, neg_thrsh)
+        ibad      = np.where(bad[:nt])[0]
+        print(f'      {len(ibad)} negative timesteps found:')
+        for i in ibad:
+            print( '      ', ds1.time[i].values, '   ', np.round(tmin[i],2) )
     else:
-        ds1[varname_dt] = pcp_dt_pos
+        bad  = np.asarray(bad_steps, dtype=bool)
+        ibad = np.where(bad[:nt])[0]
+        print(f'      {len(ibad)} negative timesteps (from glitch index):')
+        for i in ibad:
+            print( '      ', ds1.time[i].values )
+    if len(ibad)>0 and ibad[-1]==nt-1:
+        print( "\n !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!! \n !!!    last timestep is negative, using one more timestep...  !!! \n !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!" )
+
+    # 2. set ALL values at those timesteps to NaN, interpolate in time and set small negative values to 0,
+    #    in one pass per spatial chunk (pure numpy kernel, one output buffer per chunk):
+    dtype = precision.policy_dtype(varname_dt)
+    pcp_dt_pos = pcp.data.map_blocks( lambda block: repair_columns(block[:nt], block[nt:] if ds2 is not None else None, bad, dtype=dtype),
+                                      chunks=((nt,),) + pcp.data.chunks[1:],
+                                      dtype=dtype )
+
+    # 3. add corrected timestep-precipitation to dataset
+    ds1[varname_dt] = xr.DataArray(pcp_dt_pos, dims=ds1[varname].dims, coords=ds1[varname].coords)
+
+    # 4. mass account (conservation.py): on the timesteps that were not repaired only the small negative
+    #    values were set to 0; the mass changed by the interpolation is recorded as 'repaired'
+    n_valid = nt if ds2 is not None else nt-1   # the last timestep has no next value without ds2
+    diff    = pcp.diff(dim='time', label='lower')[:n_valid]
+    good    = ~bad[:n_valid]
+    out     = ds1[varname_dt][:n_valid]
+    conservation.account('neg_pcp', varname_dt,
+                         into     = diff.isel(time=good).sum(dtype='float64'),
+                         clipped  = -diff.isel(time=good).clip(max=0).sum(dtype='float64'),
+                         out      = out.isel(time=good).sum(dtype='float64'),
+                         repaired = out.isel(time=~good).sum(dtype='float64') - diff.isel(time=~good).sum(dtype='float64') )
 
     # write attrs:
     ds1[varname_dt].attrs['processing_note1'] = f'From the cumulative {varname}, calculated difference with diff(dim="time",label="lower"). Negative values due to restart errors were replaced with interpolated values (linearly interpolated in time).'
@@ -161,9 +209,10 @@ def correct_var(ds1, varname, varname_dt, ds2=None, neg_thrsh=neg_thrsh):
 ######################################################################################
 ######      open 3hr icar files and correct negative precipitation          ##########
 ######################################################################################
-def open_and_remove_neg_pcp(files_in, nextmonth_file_in, vars_to_correct):
+def open_and_remove_neg_pcp(files_in, nextmonth_file_in, vars_to_correct, glitches=None):
 
-    """ remove negative precipitation and return a 3h dataset with a new variable precip_dt (3hr precipitation amount). Files_in can be a string (path) or xr.dataset. vars_to_correct a dict with cumulative names as keys, dt vars as values"""
+    """ remove negative precipitation and return a 3h dataset with a new variable precip_dt (3hr precipitation amount). Files_in can be a string (path) or xr.dataset. vars_to_correct a dict with cumulative names as keys, dt vars as values.
+        glitches: optional glitch_index.GlitchIndex, to take the negative timesteps from (or add them to)"""
 
     # ________ open one month/year of 1h/3h files  _______
 
@@ -171,7 +220,7 @@ def open_and_remove_neg_pcp(files_in, nextmonth_file_in, vars_to_correct):
     if isinstance(files_in, str ) :
         print(f'   loading: {files_in}')
         try:
-            ds1 = xr.open_mfdataset( files_in).chunk({"time": -1, "lat_y": "auto", "lon_x": "auto"}) # , parallel=True
+            ds1 = icar_io.open_icar( files_in).chunk({"time": -1, "lat_y": "auto", "lon_x": "auto"}) # , parallel=True
         except OSError:
             # if not model in errlist.keys():errlist[model]=[] # initiate a errorlist for this model if it does not yet exist.
             err_file = files_in # err_file.append(ftime)
@@ -209,7 +258,7 @@ def open_and_remove_neg_pcp(files_in, nextmonth_file_in, vars_to_correct):
     if not nextmonth_file_in is None:
         if isinstance(files_in, str ) :
             try:
-                ds2 = xr.open_dataset( nextmonth_file_in ).chunk({"time": -1, "lat_y": "auto", "lon_x": "auto"}) #, parallel=True)
+                ds2 = icar_io.open_file( nextmonth_file_in, chunks='aligned' ).chunk({"time": -1, "lat_y": "auto", "lon_x": "auto"}) #, parallel=True)
                 print("   loaded next month's 1st file")
                 has_nextyearfiles=True
             except OSError:
@@ -232,7 +281,18 @@ def open_and_remove_neg_pcp(files_in, nextmonth_file_in, vars_to_correct):
     # returns a dataset with the dt-version of thr variable iso the cumulative variable:
     for varname, varname_dt in vars_to_correct.items():
 
-        ds1 = correct_var(ds1, varname, varname_dt, ds2) #, neg_thrsh=neg_thrsh)
+        # negative timesteps from the glitch index (only for files, the index is keyed by the input files):
+        bad_steps = None
+        if glitches is not None and isinstance(files_in, str):
+            files     = sorted(glob.glob(files_in)) + [nextmonth_file_in if (ds2 is not None and isinstance(nextmonth_file_in, str)) else None]
+            bad_steps = glitches.lookup(varname, files)
+            if bad_steps is None:
+                pcp = with_next(ds1, varname, ds2)
+                bad_steps, tmin = find_bad_steps(pcp, glitches.neg_thrsh)
+                glitches.store(varname, files, bad_steps, tmin, pcp.time.values[:-1])
+                print(f"   glitch index: scanned {varname}, {int(np.sum(bad_steps))} negative timesteps added")
+
+        ds1 = correct_var(ds1, varname, varname_dt, ds2, bad_steps=bad_steps) #, neg_thrsh=neg_thrsh)
 
     #  return corrected dataset:
     return ds1
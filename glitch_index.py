@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# coding: utf-8
+######################################################################################################
+#
+# Index of the ICAR restart glitches (negative timestep precip) per model/scenario:
+#    - the negative timesteps found by fix_neg_pcp are the same every time a run is reprocessed, so
+#      they are stored (timestep, time, min value, variable) in an sqlite file per model/scenario
+#    - a next run takes them from the index and skips the detection scan over the full arrays
+#    - entries are keyed by the input file names (a month / year of files + the next file) and neg_thrsh;
+#      the fingerprints (name, size, mtime) of the files are stored with them
+#    - verify=True: compare the fingerprints and re-scan when the input files changed
+#      (verify=False trusts the index, no stat of the input files)
+#
+# Usage:
+#   - set glitch_dir in the main_*.py drivers (passed to fix_neg_pcp.open_and_remove_neg_pcp)
+#   - stand-alone to list the glitches:  python glitch_index.py glitch_dir model scenario
+#
+######################################################################################################
+
+import argparse
+import numpy as np
+import hashlib
+import json
+import sqlite3
+import datetime
+import os
+import contextlib
+
+import fix_neg_pcp as fix
+
+
+def process_command_line():
+    '''Parse the commandline'''
+    parser = argparse.ArgumentParser(description='list the restart glitches (negative timesteps) in the index')
+    parser.add_argument('glitch_dir',  help='directory with the glitch index files')
+    parser.add_argument('model',       help='model')
+    parser.add_argument('scenario',    help='scenario')
+
+    return parser.parse_args()
+
+
+def fingerprint(files):
+    """ sha256 of (file name, size, mtime) of the input files. File names without path, so the
+        index stays valid when the files are staged to another disk (copied with their mtime)"""
+    fp = []
+    for f in files:
+        if f is None or not os.path.exists(f):
+            fp.append([None if f is None else os.path.basename(f), None, None])
+        else:
+            st = os.stat(f)
+            fp.append([os.path.basename(f), st.st_size, int(st.st_mtime)])
+    return hashlib.sha256( json.dumps(fp).encode() ).hexdigest()
+
+
+def source_key(files):
+    """ key of a set of input files: first / last file name, number of files and the next file"""
+    names = [os.path.basename(f) for f in files[:-1] if f is not None]
+    nxt   = None if files[-1] is None else os.path.basename(files[-1])
+    return f"{names[0] if names else ''}|{names[-1] if names else ''}|{len(names)}|{nxt}"
+
+
+class GlitchIndex:
+    """ sqlite index of the negative timesteps for one model/scenario """
+
+    def __init__(self, glitch_dir, model, scenario, neg_thrsh=fix.neg_thrsh, verify=False):
+        self.model     = model
+        self.scenario  = scenario
+        self.neg_thrsh = neg_thrsh
+        self.verify    = verify
+        os.makedirs(glitch_dir, exist_ok=True)
+        self.file = f"{glitch_dir}/glitches_{model}_{scenario.replace('/', '_')}.sqlite"
+        with self._connect() as con:
+            con.execute("""CREATE TABLE IF NOT EXISTS scans (
+                               varname TEXT, source TEXT, neg_thrsh REAL, fingerprint TEXT,
+                               n_steps INTEGER, scanned TEXT,
+                               PRIMARY KEY (varname, source, neg_thrsh))""")
+            con.execute("""CREATE TABLE IF NOT EXISTS glitches (
+                               varname TEXT, source TEXT, neg_thrsh REAL,
+                               step INTEGER, time TEXT, min_value REAL)""")
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # several jobs (years) of a model/scenario can write at the same time:
+        con = sqlite3.connect(self.file, timeout=120)
+        try:
+            with con:   # commit (or rollback)
+                yield con
+        finally:
+            con.close()
+
+    def lookup(self, varname, files):
+        """ boolean array of the negative timesteps (of the diff incl. the next file), or None if
+            these files were not scanned yet (or changed, with verify=True)"""
+        source = source_key(files)
+        with self._connect() as con:
+            row = con.execute("SELECT fingerprint, n_steps FROM scans WHERE varname=? AND source=? AND neg_thrsh=?",
+                              (varname, source, self.neg_thrsh)).fetchone()
+            if row is None:
+                return None
+            if self.verify and row[0] != fingerprint(files):
+                print(f"   glitch index: input files changed for {varname} {source}, re-scanning")
+                return None
+            steps = [r[0] for r in con.execute("SELECT step FROM glitches WHERE varname=? AND source=? AND neg_thrsh=?",
+                                               (varname, source, self.neg_thrsh))]
+        bad = np.zeros(row[1], dtype=bool)
+        bad[steps] = True
+        return bad
+
+    def store(self, varname, files, bad, tmin, times):
+        """ add (replace) the scan result of these files"""
+        source = source_key(files)
+        key    = (varname, source, self.neg_thrsh)
+        with self._connect() as con:
+            con.execute("DELETE FROM glitches WHERE varname=? AND source=? AND neg_thrsh=?", key)
+            con.execute("INSERT OR REPLACE INTO scans VALUES (?,?,?,?,?,?)",
+                        key + (fingerprint(files), len(bad), datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S")))
+            con.executemany("INSERT INTO glitches VALUES (?,?,?,?,?,?)",
+                            [key + (int(i), str(times[i]), float(tmin[i])) for i in np.where(bad)[0]])
+
+    def glitches(self):
+        """ all stored glitches: [(varname, time, min_value)]"""
+        with self._connect() as con:
+            return con.execute("SELECT varname, time, min_value FROM glitches ORDER BY time, varname").fetchall()
+
+
+###########################
+#     MAIN
+###########################
+if __name__=="__main__":
+
+    args = process_command_line()
+    gi   = GlitchIndex(args.glitch_dir, args.model, args.scenario)
+
+    with gi._connect() as con:
+        n_scans = con.execute("SELECT COUNT(*) FROM scans").fetchone()[0]
+    glitches = gi.glitches()
+    print(f"   {gi.file}: {n_scans} scans, {len(glitches)} negative timesteps")
+    for varname, t, vmin in glitches:
+        print(f"      {t[:19]}   {varname:<20} {np.round(vmin,2)}")
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# coding: utf-8
+######################################################################################################
+#
+# Shared opener for the ICAR / GCM netcdf files, used by all modules:
+#    - engine selection ('netcdf4' or 'h5netcdf'), with a larger HDF5 chunk cache than the default
+#      (64 MB per variable, nelems 1000), so the (compressed) chunks of a 480x480 domain are
+#      decompressed once iso once per time slice
+#    - open_icar: one month / year of files as one dataset. The files are concatenated along time
+#      in file name (= time) order (combine='nested'); coordinates and variables without a time
+#      dimension are taken from the first file (coords / data_vars='minimal', compat='override'),
+#      so the expensive comparison of lat/lon/hgt across all files is skipped. Files are opened in
+#      parallel (dask delayed)
+#    - chunks='aligned': dask chunks of the whole file along time and a multiple of the on-disk
+#      chunks along lat_y / lon_x, so a dask chunk never reads part of an HDF5 chunk
+#    - reference_dir: open_icar opens the files from their reference index (reference_index.py)
+#      when they are all in it, without reading the HDF5 metadata of every file
+#
+# Usage:
+#   import icar_io
+#   ds = icar_io.open_icar(f"{path_in}/icar_out_{year}-01*.nc")           # month of files (lazy)
+#   ds = icar_io.open_file(file, decode_times=False)                      # one file
+#   python icar_io.py "files_glob"      (shows the on-disk and aligned chunks)
+#
+######################################################################################################
+
+import argparse
+import xarray as xr
+import netCDF4 as nc
+import glob
+import os
+
+import reference_index
+import instrument
+
+
+default_engine  = 'netcdf4'   # or 'h5netcdf' (if installed)
+chunk_cache_mb  = 256         # HDF5 chunk cache per open variable
+chunk_cache_nelems = 4133     # hash slots (prime, ~ 100 x nr of chunks that fit in the cache)
+chunk_cache_w0  = 0.75        # preemption of fully read chunks
+target_chunk_mb = 128         # size of the aligned dask chunks
+reference_dir   = None        # indexes of reference_index.py, None: always open the files
+
+
+def process_command_line():
+    '''Parse the commandline'''
+    parser = argparse.ArgumentParser(description='show the on-disk and aligned chunks of netcdf files')
+    parser.add_argument('files', help='file glob (quoted)')
+
+    return parser.parse_args()
+
+
+def set_chunk_cache(mb=None):
+    """ set the netCDF4 (netcdf-c) default chunk cache, for the variables opened after this"""
+    mb = chunk_cache_mb if mb is None else mb
+    nc.set_chunk_cache(int(mb*1024**2), chunk_cache_nelems, chunk_cache_w0)
+
+set_chunk_cache()
+
+
+def _engine_kwargs(engine=None):
+    """ engine + chunk cache arguments for xr.open_dataset / open_mfdataset"""
+    engine = default_engine if engine is None else engine
+    if engine=='h5netcdf':
+        return dict(engine='h5netcdf',
+                    driver_kwds={'rdcc_nbytes': int(chunk_cache_mb*1024**2),
+                                 'rdcc_nslots': chunk_cache_nelems,
+                                 'rdcc_w0'    : chunk_cache_w0})
+    return dict(engine='netcdf4')
+
+
+def disk_chunks(file):
+    """ (shape, on-disk chunks) of the largest (time, lat_y, lon_x) variable, chunks None if contiguous"""
+    with nc.Dataset(file) as ds:
+        vars_3d = [v for v in ds.variables.values() if v.ndim==3 and v.dimensions[0]=='time']
+        if len(vars_3d)==0:
+            return None, None
+        var = max(vars_3d, key=lambda v: v.size * v.dtype.itemsize)
+        chunking = var.chunking()
+        return var.shape, (None if chunking=='contiguous' else tuple(chunking))
+
+
+def aligned_chunks(file, target_mb=None):
+    """ dask chunks: whole file along time, lat_y / lon_x the smallest power-of-2 multiple of the
+        on-disk chunks that gives chunks of about target_mb"""
+    target = (target_chunk_mb if target_mb is None else target_mb) * 1024**2
+    shape, chunks = disk_chunks(file)
+    if shape is None or chunks is None:   # contiguous / no 3d vars: one chunk per file
+        return {'time': -1}
+    nt, ny, nx = shape
+    _, cy, cx  = chunks
+    k = 1
+    while nt * (k*cy) * (k*cx) * 4 < target and (k*cy < ny or k*cx < nx):
+        k *= 2
+    return {'time': -1, 'lat_y': min(k*cy, ny), 'lon_x': min(k*cx, nx)}
+
+
+def _files(files):
+    """ sorted list of files from a glob or a list"""
+    if isinstance(files, (str, os.PathLike)):
+        files = glob.glob(str(files))
+    files = sorted(str(f) for f in files)
+    if len(files)==0:
+        raise OSError("no files to open")
+    return files
+
+
+def open_icar(files, chunks='aligned', parallel=True, engine=None, **kwargs):
+    """ lazy dataset of files (glob or list) concatenated along time in file name order.
+        chunks: 'aligned', {} (on-disk chunks) or a dict of dask chunks per file.
+        Other kwargs (decode_times, drop_variables, ...) are passed to open_mfdataset."""
+    files = _files(files)
+    if isinstance(chunks, str) and chunks=='aligned':
+        chunks = aligned_chunks(files[0])
+    with instrument.stage('open', n_files=len(files)):
+        if reference_dir is not None and len(kwargs)==0:
+            ds = reference_index.open_files(reference_dir, files, chunks)
+            if ds is not None:
+                return ds
+        return xr.open_mfdataset( files,
+                                  combine    = 'nested',
+                                  concat_dim = 'time',
+                                  coords     = 'minimal',
+                                  data_vars  = 'minimal',
+                                  compat     = 'override',
+                                  chunks     = chunks,
+                                  parallel   = parallel and len(files) > 1,
+                                  **_engine_kwargs(engine),
+                                  **kwargs )
+
+
+def open_file(file, chunks=None, engine=None, **kwargs):
+    """ one file (numpy backed, lazily loaded, unless chunks are given), with the engine / chunk cache settings"""
+    if isinstance(chunks, str) and chunks=='aligned':
+        chunks = aligned_chunks(file)
+    with instrument.stage('open', n_files=1):
+        return xr.open_dataset(file, chunks=chunks, **_engine_kwargs(engine), **kwargs)
+
+
+###########################
+#     MAIN
+###########################
+if __name__=="__main__":
+
+    args  = process_command_line()
+    files = _files(args.files)
+    shape, chunks = disk_chunks(files[0])
+    print(f"   {len(files)} files, largest 3d var {shape}, on disk chunks {chunks}")
+    print(f"   aligned dask chunks: {aligned_chunks(files[0])}")
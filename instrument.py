@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# coding: utf-8
+######################################################################################################
+#
+# Per-stage timing and memory instrumentation of the main_*.py drivers:
+#    - RunLog(run_log_dir, model=, scenario=, year=, dt=) measures the stages of a run
+#      (with runlog.stage('fix', month=m): ...): wall time, cpu time (all threads), bytes read /
+#      written (/proc/self/io rchar / wchar, so also on glade where read_bytes stays 0) and the
+#      peak RSS of the stage (VmHWM, reset at the start of every stage via /proc/self/clear_refs)
+#    - stages can be nested (the 'open' of the files inside 'fix'); a nested stage does not lose
+#      the peak memory of the enclosing one
+#    - every stage is printed and, with run_log_dir set, written as a json line to
+#      run_log_dir/{model}_{scenario}_{year}_{dt}.jsonl; finish() adds a 'total' line (wall_s,
+#      peak_rss_mb), which is the telemetry that plan_jobs.py --telemetry reads
+#    - modules measure sub-stages with instrument.stage(name) (nothing if no run is active)
+#    - with profile_dir set the top level stages are also profiled (dask task stream, see profiling.py)
+#    - other records (e.g. the mass conservation checks of conservation.py) are added with record(),
+#      tagged with the open stages (context())
+#
+# Usage:
+#   set run_log_dir in the main_*.py drivers
+#   python instrument.py "run_log_dir/*.jsonl" [--scenario ssp245_2049] [--top 10] [--csv stages.csv]
+#      (wall / cpu / io / peak memory per stage, and the slowest years / months)
+#
+######################################################################################################
+
+import argparse
+import pandas as pd
+import numpy as np
+import contextlib
+import resource
+import datetime
+import socket
+import json
+import glob
+import time
+import os
+
+import profiling
+
+
+active = None   # the RunLog of the current run, used by stage()
+
+
+def process_command_line():
+    '''Parse the commandline'''
+    parser = argparse.ArgumentParser(description='summarize the run logs (timing / memory per stage)')
+    parser.add_argument('logs',                       help='run log files (glob, quoted)')
+    parser.add_argument('--model',    default=None,   help='only this model')
+    parser.add_argument('--scenario', default=None,   help='only this scenario')
+    parser.add_argument('--top',      default=10, type=int, help='nr of slowest years / months to show')
+    parser.add_argument('--csv',      default=None,   help='write the per stage summary to this csv')
+
+    return parser.parse_args()
+
+
+##############################################################################################
+#      measurements                                                                           #
+##############################################################################################
+def _proc_status(key):
+    """ a kB value of /proc/self/status in MB, None if not available"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(key):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss_mb():
+    """ peak RSS since the last reset_peak_rss() (VmHWM), or since the process start"""
+    peak = _proc_status('VmHWM')
+    if peak is None:   # not linux: ru_maxrss (kB)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return peak
+
+
+def reset_peak_rss():
+    """ reset VmHWM to the current RSS (linux >= 4.0), False if not possible"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def io_bytes():
+    """ (read, written) bytes of the process (all threads)"""
+    try:
+        with open('/proc/self/io') as f:
+            io = dict(line.split(': ') for line in f.read().splitlines())
+        return int(io['rchar']), int(io['wchar'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def cpu_seconds():
+    """ user + system time of the process (all threads) and its finished children"""
+    s, c = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    return s.ru_utime + s.ru_stime + c.ru_utime + c.ru_stime
+
+
+##############################################################################################
+#      run log                                                                                #
+##############################################################################################
+class RunLog:
+    """ measures the stages of one run (model / scenario / year / dt) """
+
+    def __init__(self, run_log_dir=None, profile_dir=None, **tags):
+        self.tags     = tags
+        self.run      = f"{socket.gethostname()}-{os.getpid()}-{int(time.time())}"
+        name = '_'.join(str(tags[k]) for k in ['model', 'scenario', 'year', 'dt'] if k in tags)
+        self.log_file = None
+        if run_log_dir is not None:
+            os.makedirs(run_log_dir, exist_ok=True)
+            self.log_file = f"{run_log_dir}/{name.replace('/', '-')}.jsonl"
+        self.profile  = None if profile_dir is None else profiling.RunProfile(profile_dir, name)
+        self._t0     = time.time()
+        self._cpu0   = cpu_seconds()
+        self._io0    = io_bytes()
+        self._peaks  = []            # running peak RSS of the open (nested) stages
+        self._open   = []            # (name, tags) of the open stages
+        self._peak   = peak_rss_mb() # of the run
+        global active
+        active = self
+
+    def _write(self, record, rounded=True):
+        if self.log_file is not None:
+            if rounded:
+                record = {k: (round(v, 3) if isinstance(v, float) else v) for k, v in record.items()}
+            with open(self.log_file, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+    @contextlib.contextmanager
+    def stage(self, name, quiet=False, **tags):
+        """ measure the block as stage name (tags e.g. month=m are added to the record)"""
+        # the peak of the enclosing stage so far, before the reset:
+        if len(self._peaks) > 0:
+            self._peaks[-1] = max(self._peaks[-1], peak_rss_mb())
+        self._peak = max(self._peak, peak_rss_mb())
+        reset_peak_rss()
+        self._peaks.append(peak_rss_mb())
+        self._open.append((name, tags))
+        # dask profile of the top level stages only:
+        profile = self.profile.stage(name, **tags) if self.profile is not None and len(self._peaks)==1 else contextlib.nullcontext()
+        t0, cpu0, (r0, w0) = time.time(), cpu_seconds(), io_bytes()
+        start = datetime.datetime.now().isoformat(timespec='seconds')
+        try:
+            with profile:
+                yield self
+        finally:
+            self._open.pop()
+            peak   = max(self._peaks.pop(), peak_rss_mb())
+            if len(self._peaks) > 0:
+                self._peaks[-1] = max(self._peaks[-1], peak)
+            self._peak = max(self._peak, peak)
+            r1, w1 = io_bytes()
+            record = { 'run': self.run, 'start': start, 'stage': name, **self.tags, **tags,
+                       'wall_s'     : time.time() - t0,
+                       'cpu_s'      : cpu_seconds() - cpu0,
+                       'read_mb'    : (r1 - r0) / 1024**2,
+                       'write_mb'   : (w1 - w0) / 1024**2,
+                       'peak_rss_mb': peak }
+            self._write(record)
+            if not quiet:
+                print(f"\n   {name} took: {np.round(record['wall_s'],1)} sec (cpu {np.round(record['cpu_s'],1)} sec, "
+                      f"read {np.round(record['read_mb'],1)} MB, written {np.round(record['write_mb'],1)} MB, "
+                      f"peak RSS {np.round(peak,1)} MB)")
+
+    def context(self):
+        """ the tags of the open stages (e.g. month), with the name of the top level stage as 'in_stage'"""
+        context = {}
+        for name, tags in self._open:
+            context.update(tags)
+        if len(self._open) > 0:
+            context['in_stage'] = self._open[0][0]
+        return context
+
+    def record(self, name, **fields):
+        """ write a non-timing record (stage=name) to the run log"""
+        self._write({ 'run': self.run, 'stage': name, **self.tags, **fields }, rounded=False)
+
+    def finish(self):
+        """ write the 'total' line of the run (the plan_jobs.py telemetry)"""
+        global active
+        r1, w1 = io_bytes()
+        record = { 'run': self.run, 'stage': 'total', **self.tags,
+                   'wall_s'     : time.time() - self._t0,
+                   'cpu_s'      : cpu_seconds() - self._cpu0,
+                   'read_mb'    : (r1 - self._io0[0]) / 1024**2,
+                   'write_mb'   : (w1 - self._io0[1]) / 1024**2,
+                   'peak_rss_mb': max(self._peak, peak_rss_mb()) }
+        self._write(record)
+        if self.profile is not None:
+            self.profile.write()
+        print(f"   run total: {np.round(record['wall_s']/60,1)} min, cpu {np.round(record['cpu_s']/60,1)} min, "
+              f"peak RSS {np.round(record['peak_rss_mb'],1)} MB")
+        if active is self:
+            active = None
+
+
+def context():
+    """ tags of the open stages of the active run ({} without a RunLog)"""
+    return {} if active is None else active.context()
+
+
+def stage(name, quiet=True, **tags):
+    """ stage of the active run (for the modules), a no-op without a RunLog"""
+    if active is None:
+        return contextlib.nullcontext()
+    return active.stage(name, quiet=quiet, **tags)
+
+
+##############################################################################################
+#      summary                                                                                #
+##############################################################################################
+def read_logs(files):
+    """ DataFrame of the records in the log files, last run per model/scenario/year/dt only"""
+    lines = []
+    for file_in in files:
+        with open(file_in) as f:
+            lines += [json.loads(l) for l in f if l.strip()]
+    if len(lines)==0:
+        return pd.DataFrame()
+    logs = pd.DataFrame(lines)
+    keys = [k for k in ['model', 'scenario', 'year', 'dt'] if k in logs.columns]
+    last = logs.groupby(keys, dropna=False).run.transform('last')
+    logs = logs[logs.run==last]
+    if 'month' in logs.columns:
+        logs = logs.assign(month=logs.month.astype('Int64'))
+    return logs
+
+
+def summarize(logs, top=10):
+    """ per stage totals, and the slowest years / months. Returns the per stage DataFrame"""
+    logs   = logs[logs.stage!='conservation']   # not timing (conservation.py)
+    stages = logs[logs.stage!='total'].groupby('stage').agg( n           = ('wall_s', 'size'),
+                                                              wall_h      = ('wall_s', lambda x: x.sum()/3600),
+                                                              wall_mean_s = ('wall_s', 'mean'),
+                                                              cpu_h       = ('cpu_s', lambda x: x.sum()/3600),
+                                                              read_gb     = ('read_mb', lambda x: x.sum()/1024),
+                                                              write_gb    = ('write_mb', lambda x: x.sum()/1024),
+                                                              peak_rss_mb = ('peak_rss_mb', 'max') )
+    total = logs[logs.stage=='total']
+    stages['wall_frac'] = stages.wall_h / (total.wall_s.sum()/3600 if len(total) > 0 else stages.wall_h.sum())
+    print(f"\n   per stage (nested stages, e.g. open, are also part of their enclosing stage; wall_frac of the run totals):")
+    print(stages.sort_values('wall_h', ascending=False).round(2).to_string())
+
+    if len(total) > 0:
+        cols = [c for c in ['model', 'scenario', 'year', 'dt', 'wall_s', 'cpu_s', 'peak_rss_mb'] if c in total.columns]
+        print(f"\n   {len(total)} runs, {np.round(total.wall_s.sum()/3600,1)} h; slowest:")
+        print(total.sort_values('wall_s', ascending=False)[cols].head(top).round(1).to_string(index=False))
+
+    if 'month' in logs.columns:
+        keys   = [c for c in ['model', 'scenario', 'year', 'month', 'stage'] if c in logs.columns]
+        months = logs[logs.month.notna() & (logs.stage!='open')].groupby(keys).wall_s.sum().unstack('stage')
+        months['sum'] = months.sum(axis=1)
+        print(f"\n   slowest months (wall s per stage):")
+        print(months.sort_values('sum', ascending=False).head(top).round(1).to_string())
+    return stages
+
+
+###########################
+#     MAIN
+###########################
+if __name__=="__main__":
+
+    args = process_command_line()
+    logs = read_logs(sorted(glob.glob(args.logs)))
+    if args.model is not None and len(logs) > 0:
+        logs = logs[logs.model==args.model]
+    if args.scenario is not None and len(logs) > 0:
+        logs = logs[logs.scenario==args.scenario]
+    if len(logs)==0:
+        print(f"   no run log records in {args.logs}")
+    else:
+        stages = summarize(logs, top=args.top)
+        if args.csv is not None:
+            stages.to_csv(args.csv)
+            print(f"\n   written {args.csv}")
@@ -24,6 +24,9 @@ import time
 import sys
 from datetime import datetime, timedelta
 
+import time_axis
+import icar_io
+
 dask.config.set(**{'array.slicing.split_large_chunks': True})
 
 
@@ -31,68 +34,35 @@ def find_intp_missing(ds):
     """find missing timesteps and interpolate them. Return fixes dataset"""
 
 
-    # Find out what is missing
-    idx = np.where(ds.time.diff(dim='time').values > min(ds.time.diff(dim='time').values ) )[0] #? [0]
+    # Find out what is missing (on the integer time axis, hours since 1900-01-01):
+    t_axis = time_axis.TimeAxis.from_dataarray(ds.time)
+    idx    = t_axis.gaps()
+    if len(idx)==0:
+        print(f"  No missing values, :) ")
+        return ds
     if idx[0]!=0:
         print(ds.time[idx[0]-1:idx[0]+2].values )
     else:
         print(ds.time[idx[0]:idx[0]+3].values )
-    # if idx[0]!=0:     print(ds.time[idx[0]-1:idx[0]+2].values )
-
-
-
-    try:
-        t = np.arange( ds.time[idx[0]].values , ds.time[idx[0]+1].values , timedelta(hours=3))
-    except:
-        t = np.arange( ds.time[idx[0]].values.astype('datetime64[h]') ,
-                    ds.time[idx[0]+1].values.astype('datetime64[h]'),
-                    timedelta(hours=3))
-    # else:
-    #     print('need to think about this case')
-    #     t = np.arange( ds.time[idx[0]].values , ds.time[idx[0]+1].values , timedelta(hours=3))
-
 
-
-    missing_time = t[1:]
+    step = t_axis.step_hours()
+    missing_time = time_axis.TimeAxis( np.arange(t_axis.hours[idx[0]]+step, t_axis.hours[idx[0]+1], step), t_axis.calendar ).decode()
     print(f" missing_time = {missing_time}")
 
 
-    # Create a full time period:
-    t1 = ( f"{str(ds.time[0].dt.year.values)}-{str(ds.time[0].dt.month.values).zfill(2)}-{str(ds.time[0].dt.day.values).zfill(2)} {str(ds.time[0].dt.hour.values).zfill(2)}:00:00")
-    t2 = f"{str(ds.time[-1].dt.year.values)}-{str(ds.time[-1].dt.month.values).zfill(2)}-{str(ds.time[-1].dt.day.values).zfill(2)} {str(ds.time[-1].dt.hour.values).zfill(2)}:00:00"
-
-    print( t1, " - ",t2)
-
-
-    if ds.time.dt.calendar=='noleap':
-        ds.time[0]
-        time2 = xr.cftime_range(start=t1 , #ds.time[0].values.astype('datetime64[h]'),
-                    end=t2, #ds.time[-1].values.astype('datetime64[h]'),
-                    freq='3H', calendar='noleap' )
-
-    elif ds.time.dt.calendar=='proleptic_gregorian':
-        time2 = pd.date_range(start=t1 , #ds.time[0].values.astype('datetime64[h]'),
-                    end=t2, #ds.time[-1].values.astype('datetime64[h]'),
-                    freq='3H' )
-    # print(time2)
+    # Create a full time period (any calendar):
+    full_axis = t_axis.full(step)
+    print( ds.time[0].values, " - ", ds.time[-1].values, f" ({len(full_axis)} timesteps of {step}h)")
 
     # turn the full time into a dataArray:
-    full_time = xr.DataArray(
-        data=time2,
-        dims=["time"],
-    # coords=dict( time=time ),
-    # attrs=dict(
-    #     description="time.",
-    #     units="degC",
-    #     )
-    )
+    full_time = full_axis.to_dataarray()
 
 
     # _____ ReIndex ______
     full = ds.reindex(time=full_time, fill_value=np.nan).sortby("time")
 
     #Check no more missing:
-    idx2 =np.where( full.time.diff(dim='time').values.astype(float) > full.time.diff(dim='time').values.astype(float)[0] )[0]
+    idx2 = time_axis.TimeAxis.from_dataarray(full.time).gaps()
     if len(idx2)>0:
         print(f"  ! More missing values, at:")
         if idx2[0]!=0:
@@ -133,7 +103,7 @@ if __name__=="main":
     file2fix="icar_3hr_livgrid_CCSM4_rcp85_2010-2014.nc"
 
 
-    ds_in =xr.open_dataset(f"{path_in}/{file2fix}")
+    ds_in =icar_io.open_file(f"{path_in}/{file2fix}")
 
     ds_fix=find_intp_missing( ds_in )
 
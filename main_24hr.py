@@ -36,6 +36,19 @@ import check_complete as check
 import aggregate_in_time as change_temporal_res
 import fix_neg_pcp as fix
 import remove_cp as cp
+import stream_aggregate as stream
+import tiled_correction as tile
+import glitch_index
+import preflight_check as preflight
+import staging
+import icar_io
+import instrument
+import conservation
+import regrid_cp
+import temporal_cp
+import output_registry
+import climatology
+import sidecar
 
 
 #################################
@@ -68,13 +81,20 @@ def correct_to_yearly_24hr_files( path_in, path_out, model, scenario, year,
     '''Post process hourly ICAR output to yearly files with 24hr timestep'''
     t00=time.time()
 
-    # __________  check files for completeness  ______
+    # a year with input files that failed the pre-flight scan (preflight_check.py) can not be corrected, stop up front:
+    bad_files = preflight.quarantined(quarantine, f"{path_in}/{model}/{scenario}/{year}/icar_out_{year}-*.nc")
+    if len(bad_files) > 0:
+        sys.exit(f"\n ! ! !   {year} has quarantined input files {bad_files}, stopping.  ! ! ! \n")
+
+    # __________  check files for completeness  ______ (opens every month, so not when streaming/tiled)
     print(f"\n**********************************************")
     for m in range(1,13):
+        if streaming or tiled: break
         path_m = f"{path_in}/{model}/{scenario}/{year}/icar_out_{year}-{str(m).zfill(2)}*.nc"
 
         print(f"   checking {year}-{str(m).zfill(2)}")
-        check_result = check.check_month( path_to_files=path_m, m=m, ts_p_day=ts_per_day )
+        with runlog.stage('check', month=m):
+            check_result = check.check_month( path_to_files=path_m, m=m, ts_p_day=ts_per_day )
 
         # ________ interpolate / fill missing timesteps  __________
         # if check_result == not None:
@@ -88,25 +108,103 @@ def correct_to_yearly_24hr_files( path_in, path_out, model, scenario, year,
     #
     #     make timestep precip vars  &  fix neg precip (should be separate functions, so we can turn them on/off indiv.)
     # __________________________________________________
-    if cor_neg_pcp:
+    file_out_24hr  = f"{path_out}/{model}_{scenario}/daily/icar_daily_{model}_{scenario.split('_')[0]}_{year}.nc"
+    if not os.path.exists(f"{path_out}/{model}_{scenario}/daily"):
+        os.makedirs(f"{path_out}/{model}_{scenario}/daily")
+    file_clim      = f"{clim_dir}/{model}_{scenario}/clim_{model}_{scenario.split('_')[0]}_{year}.nc"
+
+    if streaming:
+        # ______ correct + aggregate day file by day file (one day in memory) ______
+        print(f"\n   **********************************************")
+        print(f"   streaming day files to 24hr for {year} ")
+        try:
+                nextmonth_file_in = sorted(glob.glob(f"{path_in}/{model}/{scenario}/{str(int(year)+1)}/icar_out_{str(int(year)+1)}-01*.nc"))[0]
+        except:
+                nextmonth_file_in=None  # should catch all fringe cases, ie 2005 in hist, 2050 in sspXXX_2004
+        if len(preflight.quarantined(quarantine, [nextmonth_file_in])) > 0:   # corrupt, treat as missing
+            nextmonth_file_in = None
+        print( "   nextmonth_file_in ", nextmonth_file_in )
+
+        # without cp removal the daily windows are appended to file_out_24hr directly
+        try:
+            with runlog.stage('stream'):
+                ds24hr = stream.stream_aggregate( f"{path_in}/{model}/{scenario}/{year}/icar_out_{year}-*.nc",
+                                                  nextmonth_file_in,
+                                                  vars_to_correct = vars_to_correct_24hr,
+                                                  freq_hours      = 24,
+                                                  file_out        = None if remove_cp else file_out_24hr
+                                                  )
+        except (OSError, ValueError) as e:   # unreadable input, the partial output is removed
+            sys.exit(f"\n ! ! !   could not stream {year}: {e}, stopping.  ! ! ! \n")
+        if not remove_cp:
+            sidecar.from_file(file_out_24hr)   # written by the streaming / tiled writer
+            if clim_dir is not None:
+                with runlog.stage('climatology'), icar_io.open_file(file_out_24hr) as ds_written:   # daily data, fits in memory
+                    clim = climatology.Climatology()
+                    clim.add(ds_written)
+                    clim.write(file_clim)
+            if stage is not None:
+                stage.put(file_out_24hr)
+                stage.put(sidecar.sidecar_path(file_out_24hr))
+            print(f"\n   - - - - -     {year}  done in {np.round((time.time()-t00)/60,1)} min  - - - - - ")
+            return
+
+    elif tiled:
+        # ______ two-pass correction + aggregation by lat_y/lon_x tile, written to file_out_24hr ______
+        print(f"\n   **********************************************")
+        print(f"   tiled correction to 24hr for {year} ")
+        try:
+                nextmonth_file_in = sorted(glob.glob(f"{path_in}/{model}/{scenario}/{str(int(year)+1)}/icar_out_{str(int(year)+1)}-01*.nc"))[0]
+        except:
+                nextmonth_file_in=None  # should catch all fringe cases, ie 2005 in hist, 2050 in sspXXX_2004
+        if len(preflight.quarantined(quarantine, [nextmonth_file_in])) > 0:   # corrupt, treat as missing
+            nextmonth_file_in = None
+        print( "   nextmonth_file_in ", nextmonth_file_in )
+
+        with runlog.stage('tiled'):
+            tile.correct_and_aggregate_tiled( f"{path_in}/{model}/{scenario}/{year}/icar_out_{year}-*.nc",
+                                              nextmonth_file_in,
+                                              vars_to_correct = vars_to_correct_24hr,
+                                              freq_hours      = 24,
+                                              file_out        = file_out_24hr,
+                                              tile_size       = tile_size
+                                              )
+        if not remove_cp:
+            sidecar.from_file(file_out_24hr)   # written by the streaming / tiled writer
+            if clim_dir is not None:
+                with runlog.stage('climatology'), icar_io.open_file(file_out_24hr) as ds_written:   # daily data, fits in memory
+                    clim = climatology.Climatology()
+                    clim.add(ds_written)
+                    clim.write(file_clim)
+            if stage is not None:
+                stage.put(file_out_24hr)
+                stage.put(sidecar.sidecar_path(file_out_24hr))
+            print(f"\n   - - - - -     {year}  done in {np.round((time.time()-t00)/60,1)} min  - - - - - ")
+            return
+        with icar_io.open_file(file_out_24hr) as ds_tiled:   # daily data, fits in memory
+            ds24hr = ds_tiled.load()
+
+    elif cor_neg_pcp:
         print(f"\n   **********************************************")
         print(f"   fixing neg pcp  for {year} ")
-        t0 = time.time()
 
         # find next month's file (needed to calculate timestep pcp (diff))
         try:
                 nextmonth_file_in = sorted(glob.glob(f"{path_in}/{model}/{scenario}/{str(int(year)+1)}/icar_out_{str(int(year)+1)}-01*.nc"))[0]
         except:
                 nextmonth_file_in=None  # should catch all fringe cases, ie 2005 in hist, 2050 in sspXXX_2004
+        if len(preflight.quarantined(quarantine, [nextmonth_file_in])) > 0:   # corrupt, treat as missing
+            nextmonth_file_in = None
         print( "   nextmonth_file_in ", nextmonth_file_in )
 
         # call the correction functions
         path_y = f"{path_in}/{model}/{scenario}/{year}/icar_out_{year}-*.nc"
-        ds_fxd = fix.open_and_remove_neg_pcp(path_y,
-                                            nextmonth_file_in,
-                                            vars_to_correct=vars_to_correct_24hr
-                                            )
-        print(f"\n   correcting  neg pcp took: {np.round(time.time()-t0,1)} sec")
+        with runlog.stage('fix'):
+            ds_fxd = fix.open_and_remove_neg_pcp(path_y,
+                                                nextmonth_file_in,
+                                                vars_to_correct=vars_to_correct_24hr,
+                                                glitches=glitches
+                                                )
     else:
          # in this case we should still disaggregate pcp!!
          print("   NOT IMPLEMENTED YET, Stopping")
@@ -126,12 +224,12 @@ def correct_to_yearly_24hr_files( path_in, path_out, model, scenario, year,
     #                                           )
 
     # ____________ aggregate to 24hr yearly files __________
-    print(f"\n   **********************************************")
-    print(f"   aggregating to yearly 24hr files: {year}")
-    t0 =time.time()
-    # precip is now dt, correct attrs etc...
-    ds24hr = change_temporal_res.make_yearly_24h_file( ds_fxd ) #, directory_3hr=path_out)
-    print(f"\n   aggregating to 24hr took: {np.round(time.time()-t0,1)} sec")
+    if not (streaming or tiled):
+        print(f"\n   **********************************************")
+        print(f"   aggregating to yearly 24hr files: {year}")
+        # precip is now dt, correct attrs etc...
+        with runlog.stage('aggregate'):
+            ds24hr = change_temporal_res.make_yearly_24h_file( ds_fxd ) #, directory_3hr=path_out)
 
 
 
@@ -139,33 +237,40 @@ def correct_to_yearly_24hr_files( path_in, path_out, model, scenario, year,
     if remove_cp:
         print(f"\n   **********************************************")
         print( f'   removing GCM cp  {year}-{str(m).zfill(2)}')
-        t0 =time.time()
-        ds24hr = cp.remove_24hr_cp( ds_in       = ds24hr,
-                                    # m           = m,
-                                    year        = year,
-                                    model       = model,
-                                    scen        = scenario.split('_')[0],
-                                    GCM_path    = GCM_path,
-                                    noise_path  = noise_path, #'/pscratch/sd/b/bkruyt/CMIP/uniform_noise_480_480.nc',
-                                    drop_vars   =  drop_vars
-                                    )
-        print(f"\n   removing cp took: {np.round(time.time()-t0,1)} sec")
+        with runlog.stage('remove_cp'):
+            ds24hr = cp.remove_24hr_cp( ds_in       = ds24hr,
+                                        # m           = m,
+                                        year        = year,
+                                        model       = model,
+                                        scen        = scenario.split('_')[0],
+                                        GCM_path    = GCM_path,
+                                        noise_seed  = noise_seed,
+                                        # drop_vars   =  drop_vars
+                                        )
+
+
+    # ____________ monthly climatology / Prec extremes (from the daily data in memory) _____________
+    if clim_dir is not None:
+        with runlog.stage('climatology'):
+            clim   = climatology.Climatology()
+            ds24hr = clim.add(ds24hr)
+            clim.write(file_clim)
 
 
     # ____________ save output _____________
 
     # save 24hr dataset to disk:
-    file_out_24hr  = f"{path_out}/{model}_{scenario}/daily/icar_daily_{model}_{scenario.split('_')[0]}_{year}.nc"
     print(f"\n   **********************************************")
     print( '   writing 24hfile to ', file_out_24hr )
 
-    if not os.path.exists(f"{path_out}/{model}_{scenario}/daily"):
-        os.makedirs(f"{path_out}/{model}_{scenario}/daily")
-
-    ds24hr.to_netcdf(file_out_24hr, encoding={'time':{'units':"days since 1900-01-01"},
-                                            #   'Prec':{'dtype':"float32"}  # leads to overflow error?
-                                              }
-                                              )
+    with runlog.stage('write'):
+        sidecar.write(ds24hr, file_out_24hr, encoding={'time':{'units':"days since 1900-01-01"},
+                                                     #   'Prec':{'dtype':"float32"}  # leads to overflow error?
+                                                       }
+                                                       )
+    if stage is not None:
+        stage.put(file_out_24hr)
+        stage.put(sidecar.sidecar_path(file_out_24hr))
 
 
     print(f"\n   - - - - -     {year}  done   - - - - - ")
@@ -195,13 +300,28 @@ if __name__ == '__main__':
 
 
     # # #  Additional settings (might become arguments )  # # #
-    if os.uname()[1][:5] == "login" or os.uname()[1][:3] == "nid":
-        noise_path  = '/global/cfs/cdirs/m4062/bert/uniform_noise_480_480.nc'
-    else:
-        noise_path   = '/glade/derecho/scratch/bkruyt/CMIP6/uniform_noise_480_480.nc'
+    noise_seed   = None   # add reproducible uniform noise to the dry pixels of the corrected pcp (noise.py, generated on the fly, no noise file), None: no noise
 
     drop_vars    = False
     cor_neg_pcp  = True # also does the pcp_cum -> pcp_dt, so keep set at True (for now)
+    streaming    = False  # read the day files one by one (constant memory) iso open_mfdataset of the whole year
+    tiled        = False  # two-pass correction by lat_y/lon_x tiles (for domains that do not fit in memory)
+    tile_size    = 120    # tile size (pixels) when tiled=True
+    glitch_dir   = None   # index of the negative timesteps per model/scenario (skips the detection on reruns), None to switch off
+    glitch_verify= False  # re-scan when the input files changed (size/mtime) since they were indexed
+    glitches = None if glitch_dir is None else glitch_index.GlitchIndex(glitch_dir, model, scenario, verify=glitch_verify)
+    quarantine_file= None   # list of bad input files written by preflight_check.py (skipped up front), None to switch off
+    quarantine = preflight.read_quarantine(quarantine_file)
+    stage_dir    = None   # node-local dir (e.g. /dev/shm, $TMPDIR) for the year's input + GCM cp and the outputs, None to switch off
+    icar_io.reference_dir = None   # reference indexes of the input (reference_index.py), opens the months without reading every file's metadata, None to switch off
+    run_log_dir  = None   # json lines log of time / cpu / io / peak memory per stage (instrument.py, telemetry for plan_jobs.py), None: only print
+    profile_dir  = None   # dask task stream + resource profile per stage (profiling.py: trace json + html report, e.g. f"{path_out}/profiles"), None to switch off
+    conservation_tol = 1e-4   # relative tolerance of the precipitation mass conservation checks (conservation.py, in the run log), None to switch off
+    regrid_cp.raw_path = None   # raw GCM cp (CMIP prc files), regridded to the ICAR grid in the pipeline with cached weights (regrid_cp.py) iso the cp in GCM_path, None to switch off
+    temporal_cp.source_dt = None   # resample the GCM cp from the files of this frequency ('3hr', '24hr'; raw cp also '6hr') to the ICAR timestep, mass conserving (temporal_cp.py), None: read the cp at the ICAR timestep
+    temporal_cp.cache_dir = None   # cache of the resampled cp per decade (stage_cache.py, e.g. local scratch), None: resample every year
+    output_registry.products_24hr = ['Prec', 'Tmax', 'Tmin', 'Wind']   # daily output variables (output_registry.py, also 'Snow', 'RH'), only their inputs are read
+    clim_dir     = None   # monthly climatology / Prec extremes accumulators per year (climatology.py, e.g. f"{path_out}/climatology"), None to switch off
 
 
     ########          correct negative variables          ########
@@ -218,22 +338,57 @@ if __name__ == '__main__':
     print(f"#   Making daily corrected ICAR files for: " )
     print(f"#      {model}   {scenario}   {year}      \n")
     print(f"#   remove GCM cp:           {remove_cp}    ")
+    print(f"#   streaming day files:     {streaming}    ")
+    print(f"#   tiled correction:        {tiled}    ")
+    print(f"#   glitch index:            {glitch_dir}    ")
+    print(f"#   quarantine list:         {quarantine_file}    ")
+    print(f"#   node-local staging:      {stage_dir}    ")
+    print(f"#   reference index:         {icar_io.reference_dir}    ")
+    print(f"#   run log:                 {run_log_dir}    ")
+    print(f"#   dask profile:            {profile_dir}    ")
+    print(f"#   conservation check:      {conservation_tol}    ")
+    print(f"#   raw GCM cp (regrid):     {regrid_cp.raw_path}    ")
+    print(f"#   cp resampled from:       {temporal_cp.source_dt}    ")
+    print(f"#   daily outputs:           {output_registry.products_24hr}    ")
+    print(f"#   climatology:             {clim_dir}    ")
+    print(f"#   noise seed:              {noise_seed}    ")
     # print(f"#   drop unwanted variables: {drop_vars}    ")
     print(f"#######################################  \n")
 
-    # determine timestep (nr of timesteps per day):
-    try:
-        files_oct = glob.glob(f"{path_in}/{model}/{scenario}/{year}/icar_out_{year}-{str(10).zfill(2)}*.nc")
-        ts_per_day = check.determine_time_step(files_oct[0])
-    except:
-        files = glob.glob(f"{path_in}/{model}/{scenario}/{year}/icar_out_{year}-{str(1).zfill(2)}*.nc")
-        ts_per_day = check.determine_time_step(files[0])
-
-    correct_to_yearly_24hr_files( path_in, path_out, model, scenario, year,
-                                 GCM_path  = GCM_path,
-                                 drop_vars = drop_vars
-                                )
-
-
+    runlog = instrument.RunLog(run_log_dir, profile_dir=profile_dir, model=model, scenario=scenario, year=year, dt='daily')
+    ledger = None if conservation_tol is None else conservation.Ledger(conservation_tol)
+
+    stage    = None
+    complete = False
+    try:   # also on sys.exit / errors: the outputs put() after their write are moved back, the run log is closed
+        # ____________ stage the year's input (+ GCM cp) to node-local disk, outputs are moved back ____________
+        if stage_dir is not None:
+            stage = staging.Stage(stage_dir)
+            stage.stage_in([ f"{path_in}/{model}/{scenario}/{year}/icar_out_{year}-*.nc", f"{path_in}/{model}/{scenario}/{year+1}/icar_out_{year+1}-01*.nc" ])
+            if remove_cp:
+                stage.stage_cp(cp.cp_files(year, model, scenario.split('_')[0], GCM_path, dt='daily'), year)
+                GCM_path = stage.local(GCM_path)
+            quarantine = stage.localize(quarantine)
+            path_in    = stage.local(path_in)
+            path_out   = stage.output(path_out)
+
+        # determine timestep (nr of timesteps per day):
+        try:
+            files_oct = glob.glob(f"{path_in}/{model}/{scenario}/{year}/icar_out_{year}-{str(10).zfill(2)}*.nc")
+            ts_per_day = check.determine_time_step(files_oct[0])
+        except:
+            files = glob.glob(f"{path_in}/{model}/{scenario}/{year}/icar_out_{year}-{str(1).zfill(2)}*.nc")
+            ts_per_day = check.determine_time_step(files[0])
 
+        correct_to_yearly_24hr_files( path_in, path_out, model, scenario, year,
+                                     GCM_path  = GCM_path,
+                                     drop_vars = drop_vars
+                                    )
 
+        if ledger is not None:
+            ledger.finish()
+        complete = True
+    finally:
+        if stage is not None:   # wait for the outputs to be moved back (after an error only the finished ones)
+            stage.finish(complete=complete)
+        runlog.finish()
@@ -45,6 +45,18 @@ import check_complete as check
 import aggregate_in_time as change_temporal_res
 import fix_neg_pcp as fix
 import remove_cp as cp
+import stage_cache
+import glitch_index
+import preflight_check as preflight
+import staging
+import icar_io
+import instrument
+import conservation
+import regrid_cp
+import temporal_cp
+import output_registry
+import climatology
+import sidecar
 
 
 ###############   CAUTION!  ###################
@@ -109,15 +121,21 @@ def correct_to_yearly_24hr_files_day_in( path_in, path_out, model, scenario, yea
         path_in_month = f"{path_in}/{model}_{scenario}/3hr"
         path_in_year = f"{path_in}/{model}_{scenario}/daily"
 
+    # a year with input files that failed the pre-flight scan (preflight_check.py) can not be corrected, stop up front:
+    bad_files = preflight.quarantined(quarantine, f"{path_in_month}/icar_*_{year}-*.nc")
+    if len(bad_files) > 0:
+        sys.exit(f"\n ! ! !   {year} has quarantined input files {bad_files}, stopping.  ! ! ! \n")
+
     if check_for_err:
         for m in range(1,13):
                 # path_m = f"{path_in_month}/icar_*_{year}-{str(m).zfill(2)}*.nc"
 
             print(f"   checking {year}-{str(m).zfill(2)}")
-            check_result = check.check_month(
-                path_to_files = f"{path_in_month}/icar_*_{year}-{str(m).zfill(2)}*.nc",
-                m = m, ts_p_day = ts_per_day
-                )
+            with runlog.stage('check', month=m):
+                check_result = check.check_month(
+                    path_to_files = f"{path_in_month}/icar_*_{year}-{str(m).zfill(2)}*.nc",
+                    m = m, ts_p_day = ts_per_day
+                    )
 
         # ________ interpolate / fill missing timesteps  __________
         # if check_result == not None:
@@ -131,36 +149,40 @@ def correct_to_yearly_24hr_files_day_in( path_in, path_out, model, scenario, yea
     if cor_neg_pcp:
         print(f"\n   **********************************************")
         print(f"   fixing neg pcp  for {year} ")
-        t0 = time.time()
 
         # find next month's file (needed to calculate timestep pcp (diff))
         try:
                 nextmonth_file_in = sorted(glob.glob(f"{path_in_month}/icar_*_{str(int(year)+1)}-01*.nc"))[0]
         except:
                 nextmonth_file_in=None  # should catch all fringe cases, ie 2005 in hist, 2050 in sspXXX_2004
+        if len(preflight.quarantined(quarantine, [nextmonth_file_in])) > 0:   # corrupt, treat as missing
+            nextmonth_file_in = None
         print( "   nextmonth_file_in ", nextmonth_file_in )
 
-        # call the correction functions (N.B. Takes 1h or 3h input!)
-        ds_fxd = fix.open_and_remove_neg_pcp(
-            f"{path_in_month}/icar_*_{year}-*.nc",
-            nextmonth_file_in,
-            vars_to_correct=vars_to_correct_24hr
-            )
-        print(f"\n   correcting  neg pcp took: {np.round(time.time()-t0,1)} sec")
+        # call the correction functions (N.B. Takes 1h or 3h input!) (or take the corrected year from the stage cache)
+        with runlog.stage('fix'):
+            ds_fxd = stage_cache.cached( cache_dir, 'fix_neg_pcp',
+                files   = sorted(glob.glob(f"{path_in_month}/icar_*_{year}-*.nc")) + [nextmonth_file_in],
+                params  = {'neg_thrsh': fix.neg_thrsh, 'vars_to_correct': vars_to_correct_24hr},
+                compute = lambda: fix.open_and_remove_neg_pcp(
+                    f"{path_in_month}/icar_*_{year}-*.nc",
+                    nextmonth_file_in,
+                    vars_to_correct=vars_to_correct_24hr,
+                    glitches=glitches
+                    )
+                )
 
         ### aggregate to 24hr
         print(f"\n   **********************************************")
         print(f"   aggregating to yearly 24hr files: {year}")
-        t0 =time.time()
-
-        ds24hr = change_temporal_res.make_yearly_24h_file( ds_fxd ) #, directory_3hr=path_out)
-        print(f"\n   aggregating to 24hr took: {np.round(time.time()-t0,1)} sec")
+        with runlog.stage('aggregate'):
+            ds24hr = change_temporal_res.make_yearly_24h_file( ds_fxd ) #, directory_3hr=path_out)
 
         ### but only save precip from this correction, since the TMaxTmin etc were calculated from 1hourly data and therefore are better.
 
         #  Open original daily  dataset
         try:
-            ds_day = xr.open_mfdataset( file_day_in , parallel=True)
+            ds_day = icar_io.open_icar( file_day_in )
         except:
             print(f"\n ! ! !     Cannot open file {file_day_in}")
 
@@ -174,7 +196,7 @@ def correct_to_yearly_24hr_files_day_in( path_in, path_out, model, scenario, yea
         ds_fxd_pcp = ds_day
 
     else:
-        ds_fxd_pcp = xr.open_mfdataset( file_day_in , parallel=True)
+        ds_fxd_pcp = icar_io.open_icar( file_day_in )
         print("! ! !  WARNING:   NOT correcting neg precip! Caution!")
         print("\n ! input is already in 24hr format! \n")
         # ds24hr = ds_fxd
@@ -210,18 +232,17 @@ def correct_to_yearly_24hr_files_day_in( path_in, path_out, model, scenario, yea
     if remove_cp:
         print(f"\n   **********************************************")
         print( f'   removing GCM cp  {year}')
-        t0 =time.time()
-        ds24hr = cp.remove_24hr_cp( ds_in       = ds_fxd_pcp, # ds24hr,  ## SHOULD BE ds_day!!!
-                                    # m           = m,
-                                    year        = year,
-                                    model       = model,
-                                    scen        = scenario.split('_')[0],
-                                    GCM_path    = GCM_path,
-                                    # noise_path  = noise_path, #'/pscratch/sd/b/bkruyt/CMIP/uniform_noise_480_480.nc',
-                                    # drop_vars   =  drop_vars
-                                    vars_to_drop=vars_to_drop  # set to None to switch of dropping
-                                    )
-        print(f"\n   removing cp took: {np.round(time.time()-t0,1)} sec")
+        with runlog.stage('remove_cp'):
+            ds24hr = cp.remove_24hr_cp( ds_in       = ds_fxd_pcp, # ds24hr,  ## SHOULD BE ds_day!!!
+                                        # m           = m,
+                                        year        = year,
+                                        model       = model,
+                                        scen        = scenario.split('_')[0],
+                                        GCM_path    = GCM_path,
+                                        noise_seed  = noise_seed,
+                                        # drop_vars   =  drop_vars
+                                        vars_to_drop=vars_to_drop  # set to None to switch of dropping
+                                        )
 
 
     # ____________ save output _____________
@@ -234,8 +255,19 @@ def correct_to_yearly_24hr_files_day_in( path_in, path_out, model, scenario, yea
     if not os.path.exists(f"{path_out}/{model}_{scenario}/daily"):
         os.makedirs(f"{path_out}/{model}_{scenario}/daily")
 
-    ds24hr.to_netcdf(file_out_24hr, encoding={'time':{'units':"days since 1900-01-01"},
-                                              'Prec':{'dtype':"float32"}} )
+    # monthly climatology / Prec extremes (from the daily data in memory)
+    if clim_dir is not None:
+        with runlog.stage('climatology'):
+            clim   = climatology.Climatology()
+            ds24hr = clim.add(ds24hr)
+            clim.write(f"{clim_dir}/{model}_{scenario}/clim_{model}_{scenario.split('_')[0]}_{year}.nc")
+
+    with runlog.stage('write'):
+        sidecar.write(ds24hr, file_out_24hr, encoding={'time':{'units':"days since 1900-01-01"},
+                                                       'Prec':{'dtype':"float32"}} )
+    if stage is not None:
+        stage.put(file_out_24hr)
+        stage.put(sidecar.sidecar_path(file_out_24hr))
 
 
     print(f"\n   - - - - -     {year}  done   - - - - - ")
@@ -266,12 +298,26 @@ if __name__ == '__main__':
 
 
     # # #  Additional settings (might become arguments )  # # #
-    # noise_path  = '/pscratch/sd/b/bkruyt/CMIP/uniform_noise_480_480.nc'
-    # noise_path   = '/glade/derecho/scratch/bkruyt/CMIP6/uniform_noise_480_480.nc'
-    noise_path   = None
+    noise_seed   = None   # add reproducible uniform noise to the dry pixels of the corrected pcp (noise.py, generated on the fly, no noise file), None: no noise
     drop_vars    = False
     cor_neg_pcp  = False #True # also does the pcp_cum -> pcp_dt (3hr), so keep set at True (for now)
     check_for_err= False # check 3hr input files for NaNs and other errors
+    cache_dir    = None  # stage cache for the corrected years (e.g. local scratch), None to switch off
+    glitch_dir   = None   # index of the negative timesteps per model/scenario (skips the detection on reruns), None to switch off
+    glitch_verify= False  # re-scan when the input files changed (size/mtime) since they were indexed
+    glitches = None if glitch_dir is None else glitch_index.GlitchIndex(glitch_dir, model, scenario, verify=glitch_verify)
+    quarantine_file= None   # list of bad input files written by preflight_check.py (skipped up front), None to switch off
+    quarantine = preflight.read_quarantine(quarantine_file)
+    stage_dir    = None   # node-local dir (e.g. /dev/shm, $TMPDIR) for the year's input + GCM cp and the outputs, None to switch off
+    icar_io.reference_dir = None   # reference indexes of the input (reference_index.py), opens the months without reading every file's metadata, None to switch off
+    run_log_dir  = None   # json lines log of time / cpu / io / peak memory per stage (instrument.py, telemetry for plan_jobs.py), None: only print
+    profile_dir  = None   # dask task stream + resource profile per stage (profiling.py: trace json + html report, e.g. f"{path_out}/profiles"), None to switch off
+    conservation_tol = 1e-4   # relative tolerance of the precipitation mass conservation checks (conservation.py, in the run log), None to switch off
+    regrid_cp.raw_path = None   # raw GCM cp (CMIP prc files), regridded to the ICAR grid in the pipeline with cached weights (regrid_cp.py) iso the cp in GCM_path, None to switch off
+    temporal_cp.source_dt = None   # resample the GCM cp from the files of this frequency ('3hr', '24hr'; raw cp also '6hr') to the ICAR timestep, mass conserving (temporal_cp.py), None: read the cp at the ICAR timestep
+    temporal_cp.cache_dir = None   # cache of the resampled cp per decade (stage_cache.py, e.g. local scratch), None: resample every year
+    output_registry.products_24hr = ['Prec', 'Tmax', 'Tmin', 'Wind']   # daily output variables (output_registry.py, also 'Snow', 'RH'), only their inputs are read
+    clim_dir     = None   # monthly climatology / Prec extremes accumulators per year (climatology.py, e.g. f"{path_out}/climatology"), None to switch off
 
     ########          correct negative variables          ########
     vars_to_correct_3hr = {'precipitation'   : 'precip_dt',
@@ -297,34 +343,70 @@ if __name__ == '__main__':
     print(f"      {model}   {scenario}   {year}      \n")
     print(f"   correcting neg pcp:      {cor_neg_pcp}    ")
     print(f"   remove GCM cp:           {remove_cp}    ")
+    print(f"   stage cache:             {cache_dir}    ")
+    print(f"   glitch index:            {glitch_dir}    ")
+    print(f"   quarantine list:         {quarantine_file}    ")
+    print(f"   node-local staging:      {stage_dir}    ")
+    print(f"   reference index:         {icar_io.reference_dir}    ")
+    print(f"   run log:                 {run_log_dir}    ")
+    print(f"   dask profile:            {profile_dir}    ")
+    print(f"   conservation check:      {conservation_tol}    ")
+    print(f"   raw GCM cp (regrid):     {regrid_cp.raw_path}    ")
+    print(f"   cp resampled from:       {temporal_cp.source_dt}    ")
+    print(f"   daily outputs:           {output_registry.products_24hr}    ")
+    print(f"   climatology:             {clim_dir}    ")
+    print(f"   noise seed:              {noise_seed}    ")
     # print(f"   drop unwanted variables: {drop_vars}    ")
     print(f"   daily file to be corrected:\n      {file_day_in}    ")
     print(f"#######################################  \n")
 
-    # determine timestep (nr of timesteps per day):
-    if "CMIP6" in path_in :
-        try:
-            files_oct = glob.glob(f"{path_in}/{model}_{scenario}/icar_*_{year}-{str(10).zfill(2)}*.nc")
-            ts_per_day = check.determine_time_step(files_oct[0])
-        except:
-            files = glob.glob(f"{path_in}/{model}_{scenario}/icar_*_{year}-{str(1).zfill(2)}*.nc")
-            ts_per_day = check.determine_time_step(files[0])
-    else:
-        try:
-            files_oct = glob.glob(f"{path_in}/{model}_{scenario}/3hr/icar_*_{year}-{str(10).zfill(2)}*.nc")
-            ts_per_day = check.determine_time_step(files_oct[0])
-        except:
-            files = glob.glob(f"{path_in}/{model}_{scenario}/3hr/icar_*_{year}-{str(1).zfill(2)}*.nc")
-            ts_per_day = check.determine_time_step(files[0])
-
-    if ts_per_day is not None:
-        correct_to_yearly_24hr_files_day_in( path_in, path_out, model, scenario, year,
-                                            file_day_in = file_day_in,
-                                            GCM_path  = GCM_path,
-                                            # drop_vars = drop_vars
-                                            )
-    else:
-         print(f" could not determine input timestep")
-
-
-
+    runlog = instrument.RunLog(run_log_dir, profile_dir=profile_dir, model=model, scenario=scenario, year=year, dt='daily')
+    ledger = None if conservation_tol is None else conservation.Ledger(conservation_tol)
+
+    stage    = None
+    complete = False
+    try:   # also on sys.exit / errors: the outputs put() after their write are moved back, the run log is closed
+        # ____________ stage the year's input (+ GCM cp) to node-local disk, outputs are moved back ____________
+        if stage_dir is not None:
+            stage = staging.Stage(stage_dir)
+            stage.stage_in([ f"{path_in}/{model}_{scenario}/**/icar_*_{year}-*.nc", f"{path_in}/{model}_{scenario}/**/icar_*_{year+1}-01*.nc", file_day_in ])
+            if remove_cp:
+                stage.stage_cp(cp.cp_files(year, model, scenario.split('_')[0], GCM_path, dt='daily'), year)
+                GCM_path = stage.local(GCM_path)
+            quarantine = stage.localize(quarantine)
+            file_day_in= stage.local(file_day_in)
+            path_in    = stage.local(path_in)
+            path_out   = stage.output(path_out)
+
+        # determine timestep (nr of timesteps per day):
+        if "CMIP6" in path_in :
+            try:
+                files_oct = glob.glob(f"{path_in}/{model}_{scenario}/icar_*_{year}-{str(10).zfill(2)}*.nc")
+                ts_per_day = check.determine_time_step(files_oct[0])
+            except:
+                files = glob.glob(f"{path_in}/{model}_{scenario}/icar_*_{year}-{str(1).zfill(2)}*.nc")
+                ts_per_day = check.determine_time_step(files[0])
+        else:
+            try:
+                files_oct = glob.glob(f"{path_in}/{model}_{scenario}/3hr/icar_*_{year}-{str(10).zfill(2)}*.nc")
+                ts_per_day = check.determine_time_step(files_oct[0])
+            except:
+                files = glob.glob(f"{path_in}/{model}_{scenario}/3hr/icar_*_{year}-{str(1).zfill(2)}*.nc")
+                ts_per_day = check.determine_time_step(files[0])
+
+        if ts_per_day is not None:
+            correct_to_yearly_24hr_files_day_in( path_in, path_out, model, scenario, year,
+                                                file_day_in = file_day_in,
+                                                GCM_path  = GCM_path,
+                                                # drop_vars = drop_vars
+                                                )
+        else:
+             print(f" could not determine input timestep")
+
+        if ledger is not None:
+            ledger.finish()
+        complete = True
+    finally:
+        if stage is not None:   # wait for the outputs to be moved back (after an error only the finished ones)
+            stage.finish(complete=complete)
+        runlog.finish()
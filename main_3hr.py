@@ -36,6 +36,18 @@ import check_complete as check
 import aggregate_in_time as change_temporal_res
 import fix_neg_pcp as fix
 import remove_cp as cp
+import stream_aggregate as stream
+import tiled_correction as tile
+import glitch_index
+import preflight_check as preflight
+import staging
+import icar_io
+import instrument
+import conservation
+import regrid_cp
+import temporal_cp
+import output_registry
+import sidecar
 
 
 # the variables to remove:
@@ -96,10 +108,17 @@ def correct_to_monthly_3hr_files( path_in, path_out_3hr, model, scenario, year,
 
         path_m = f"{path_in}/{model}/{scenario}/{year}/icar_out_{year}-{str(m).zfill(2)}*.nc"
 
-        # __________  check files for completeness  ______
-        print(f"\n**********************************************")
-        print(f"   checking {year}-{str(m).zfill(2)}")
-        check_result = check.check_month( path_to_files=path_m, m=m, ts_p_day=ts_per_day )
+        # skip months with input files that failed the pre-flight scan (preflight_check.py):
+        if len(preflight.quarantined(quarantine, path_m)) > 0:
+            print(f"\n ! ! !   skipping {year}-{str(m).zfill(2)}, quarantined input: {preflight.quarantined(quarantine, path_m)}  ! ! ! \n")
+            continue
+
+        # __________  check files for completeness  ______ (opens the whole month, so not when streaming/tiled)
+        if not (streaming or tiled):
+            print(f"\n**********************************************")
+            print(f"   checking {year}-{str(m).zfill(2)}")
+            with runlog.stage('check', month=m):
+                check_result = check.check_month( path_to_files=path_m, m=m, ts_p_day=ts_per_day )
 
         # ________ interpolate / fill missing timesteps  __________
         # if check_result == not None:
@@ -112,7 +131,6 @@ def correct_to_monthly_3hr_files( path_in, path_out_3hr, model, scenario, year,
         #__________________________________________________
         print(f"\n   **********************************************")
         print(f"   fixing neg {vars_to_correct_3hr.keys()}  for {year}-{str(m).zfill(2)}")
-        t0 = time.time()
 
         # find next month's file (needed to calculate timestep pcp (diff))
         try:
@@ -122,66 +140,106 @@ def correct_to_monthly_3hr_files( path_in, path_out_3hr, model, scenario, year,
                 nextmonth_file_in = sorted(glob.glob(f"{path_in}/{model}/{scenario}/{str(int(year)+1)}/icar_out_{str(int(year)+1)}-01*.nc"))[0]
         except:
                 nextmonth_file_in=None  # should catch all fringe cases, ie 2005 in hist, 2050 in sspXXX_2004
+        if len(preflight.quarantined(quarantine, [nextmonth_file_in])) > 0:   # corrupt, treat as missing
+            nextmonth_file_in = None
         print( "   nextmonth_file_in ", nextmonth_file_in )
 
-        # call the correction functions
-        ds_fxd = fix.open_and_remove_neg_pcp( path_m,
-                                             nextmonth_file_in,
-                                             vars_to_correct=vars_to_correct_3hr
-                                             )
-        print(f"\n   correcting  neg pcp took: {time.time()-t0} sec")
+        file_out_3hr  = f"{path_out_3hr}/{model}_{scenario}/3hr/icar_3hr_{model}_{scenario.split('_')[0]}_{year}-{str(m).zfill(2)}.nc"
+        if not os.path.exists(f"{path_out_3hr}/{model}_{scenario}/3hr"):
+            os.makedirs(f"{path_out_3hr}/{model}_{scenario}/3hr")
 
+        if streaming:
+            # ______ correct + aggregate day file by day file (one day in memory) ______
+            # without cp removal the 3hr windows are appended to file_out_3hr directly
+            try:
+                with runlog.stage('stream', month=m):
+                    ds3hr = stream.stream_aggregate( path_m, nextmonth_file_in,
+                                                     vars_to_correct = vars_to_correct_3hr,
+                                                     freq_hours      = 3,
+                                                     file_out        = None if remove_cp else file_out_3hr
+                                                     )
+            except (OSError, ValueError) as e:   # unreadable input, the partial output is removed
+                sys.exit(f"\n ! ! !   could not stream {path_m}: {e}, stopping.  ! ! ! \n")
+            if not remove_cp:
+                sidecar.from_file(file_out_3hr)   # written by the streaming / tiled writer
+                print(f"\n   - - - - -   month {m} done in {np.round((time.time()-t1)/60,1)} min - - - - - ")
+                continue
+        elif tiled:
+            # ______ two-pass correction + aggregation by lat_y/lon_x tile, written to file_out_3hr ______
+            with runlog.stage('tiled', month=m):
+                tile.correct_and_aggregate_tiled( path_m, nextmonth_file_in,
+                                                  vars_to_correct = vars_to_correct_3hr,
+                                                  freq_hours      = 3,
+                                                  file_out        = file_out_3hr,
+                                                  tile_size       = tile_size
+                                                  )
+            if not remove_cp:
+                sidecar.from_file(file_out_3hr)   # written by the streaming / tiled writer
+                print(f"\n   - - - - -   month {m} done in {np.round((time.time()-t1)/60,1)} min - - - - - ")
+                continue
+            with icar_io.open_file(file_out_3hr) as ds_tiled:   # output size, fits in memory
+                ds3hr = ds_tiled.load()
+        else:
+            # call the correction functions
+            with runlog.stage('fix', month=m):
+                ds_fxd = fix.open_and_remove_neg_pcp( path_m,
+                                                     nextmonth_file_in,
+                                                     vars_to_correct=vars_to_correct_3hr,
+                                                     glitches=glitches
+                                                     )
 
-        # ____________ aggregate to 3hr monthly files __________
-        print(f"\n   **********************************************")
-        print(f"   aggregating to monthly 3hr files: {year}-{str(m).zfill(2)}")
 
-        if int(24/ts_per_day)==1 :
-            ds3hr = change_temporal_res.make_3h_monthly_file( ds_fxd ) #, directory_3hr=path_out_3hr)
-        elif int(24/ts_per_day)==3 :  # if we already have 3hourly data, just aggregate to monthly?
-            print(f"      input data already has 3hr timestep!")
-            ds3hr = ds_fxd   #???  aggregate
+            # ____________ aggregate to 3hr monthly files __________
+            print(f"\n   **********************************************")
+            print(f"   aggregating to monthly 3hr files: {year}-{str(m).zfill(2)}")
+
+            with runlog.stage('aggregate', month=m):
+                if int(24/ts_per_day)==1 :
+                    ds3hr = change_temporal_res.make_3h_monthly_file( ds_fxd ) #, directory_3hr=path_out_3hr)
+                elif int(24/ts_per_day)==3 :  # if we already have 3hourly data, just aggregate to monthly?
+                    print(f"      input data already has 3hr timestep!")
+                    ds3hr = ds_fxd   #???  aggregate
 
 
         # _________  remove cp  ____________
         if remove_cp:
             print(f"\n   **********************************************")
             print( f'   removing GCM cp  {year}-{str(m).zfill(2)}\n')
-            t0 =time.time()
-            ds3hr = cp.remove_3hr_cp( ds_in       = ds3hr,
-                                        m           = m,
-                                        year        = year,
-                                        model       = model,
-                                        scen        = scenario.split('_')[0],
-                                        GCM_path    = GCM_path,
-                                        noise_path  = noise_path,
-                                        # drop_vars   = drop_vars, # legacy, now just vars_to_drop
-                                        vars_to_drop=vars_to_drop  # set to None to turn off
-                                        )
-            print(f"\n   removing cp took: {np.round(time.time()-t0,1)} sec")
+            with runlog.stage('remove_cp', month=m):
+                ds3hr = cp.remove_3hr_cp( ds_in       = ds3hr,
+                                            m           = m,
+                                            year        = year,
+                                            model       = model,
+                                            scen        = scenario.split('_')[0],
+                                            GCM_path    = GCM_path,
+                                            noise_seed  = noise_seed,
+                                            # drop_vars   = drop_vars, # legacy, now just vars_to_drop
+                                            vars_to_drop=vars_to_drop  # set to None to turn off
+                                            )
 
 
 
         # __________  save output  _______________
         # save 3hr dataset to disk:
-        file_out_3hr  = f"{path_out_3hr}/{model}_{scenario}/3hr/icar_3hr_{model}_{scenario.split('_')[0]}_{year}-{str(m).zfill(2)}.nc"
         print(f"\n   **********************************************")
         print( '   writing 3hfile to ', file_out_3hr )
 
-        if not os.path.exists(f"{path_out_3hr}/{model}_{scenario}/3hr"):
-            os.makedirs(f"{path_out_3hr}/{model}_{scenario}/3hr")
+        with runlog.stage('write', month=m):
+            if "snowfall_dt" in ds3hr.data_vars or "cu_precip_dt" in ds3hr.data_vars : # assuming that if one is in, they both are (this should be done better)
+                sidecar.write(ds3hr, file_out_3hr, encoding={'time'      :{'units':"days since 1900-01-01"},
+                                                             'precip_dt' :{'dtype':"float32"},
+                                                             'cu_precip_dt' :{'dtype':"float32"},
+                                                             'snowfall_dt' :{'dtype':"float32"}
+                                                             } )
+            else:
+                sidecar.write(ds3hr, file_out_3hr, encoding={'time'      :{'units':"days since 1900-01-01"},
+                                                             'precip_dt' :{'dtype':"float32"}
+                                                             } )
 
-        if "snowfall_dt" in ds3hr.data_vars or "cu_precip_dt" in ds3hr.data_vars : # assuming that if one is in, they both are (this should be done better)
-            ds3hr.to_netcdf(file_out_3hr, encoding={'time'      :{'units':"days since 1900-01-01"},
-                                                    'precip_dt' :{'dtype':"float32"},
-                                                    'cu_precip_dt' :{'dtype':"float32"},
-                                                    'snowfall_dt' :{'dtype':"float32"}
-                                                    } )
-        else:
-            ds3hr.to_netcdf(file_out_3hr, encoding={'time'      :{'units':"days since 1900-01-01"},
-                                                    'precip_dt' :{'dtype':"float32"}
-                                                    } )
 
+        if stage is not None:
+            stage.put(file_out_3hr)
+            stage.put(sidecar.sidecar_path(file_out_3hr))
 
         # end month loop:
         print(f"\n   - - - - -   month {m} done in {np.round((time.time()-t1)/60,1)} min - - - - - ")
@@ -220,38 +278,89 @@ if __name__ == '__main__':
 
     vars_to_correct_24hr = {'precipitation'   : 'precip_dt' }
 
-    # noise_path  = '/pscratch/sd/b/bkruyt/CMIP/uniform_noise_480_480.nc'
-    # noise_path   = '/glade/derecho/scratch/bkruyt/CMIP6/uniform_noise_480_480.nc'
-    noise_path   = None
+    noise_seed   = None   # add reproducible uniform noise to the dry pixels of the corrected pcp (noise.py, generated on the fly, no noise file), None: no noise
     # drop_vars    = True
+    streaming    = False  # read the day files one by one (constant memory) iso open_mfdataset of the whole month
+    tiled        = False  # two-pass correction by lat_y/lon_x tiles (for domains that do not fit in memory)
+    tile_size    = 120    # tile size (pixels) when tiled=True
+    glitch_dir   = None   # index of the negative timesteps per model/scenario (skips the detection on reruns), None to switch off
+    glitch_verify= False  # re-scan when the input files changed (size/mtime) since they were indexed
+    glitches = None if glitch_dir is None else glitch_index.GlitchIndex(glitch_dir, model, scenario, verify=glitch_verify)
+    quarantine_file= None   # list of bad input files written by preflight_check.py (skipped up front), None to switch off
+    quarantine = preflight.read_quarantine(quarantine_file)
+    stage_dir    = None   # node-local dir (e.g. /dev/shm, $TMPDIR) for the year's input + GCM cp and the outputs, None to switch off
+    icar_io.reference_dir = None   # reference indexes of the input (reference_index.py), opens the months without reading every file's metadata, None to switch off
+    run_log_dir  = None   # json lines log of time / cpu / io / peak memory per stage (instrument.py, telemetry for plan_jobs.py), None: only print
+    profile_dir  = None   # dask task stream + resource profile per stage (profiling.py: trace json + html report, e.g. f"{path_out}/profiles"), None to switch off
+    conservation_tol = 1e-4   # relative tolerance of the precipitation mass conservation checks (conservation.py, in the run log), None to switch off
+    regrid_cp.raw_path = None   # raw GCM cp (CMIP prc files), regridded to the ICAR grid in the pipeline with cached weights (regrid_cp.py) iso the cp in GCM_path, None to switch off
+    temporal_cp.source_dt = None   # resample the GCM cp from the files of this frequency ('3hr', '24hr'; raw cp also '6hr') to the ICAR timestep, mass conserving (temporal_cp.py), None: read the cp at the ICAR timestep
+    temporal_cp.cache_dir = None   # cache of the resampled cp per decade (stage_cache.py, e.g. local scratch), None: resample every year
+    output_registry.products_3hr  = None   # 3hr output variables (output_registry.py), None: all input variables
 
     print(f"\n##############################################  ")
     print(f"   Making 3-hourly corrected ICAR files for: " )
     print(f"      {model}   {scenario}   {year}         \n")
     print(f"   remove GCM cp:           {remove_cp}       ")
-    if noise_path is not None:
-        print(f"   and adding noise from:   {noise_path}       ")
+    print(f"   streaming day files:     {streaming}       ")
+    print(f"   tiled correction:        {tiled}       ")
+    print(f"   glitch index:            {glitch_dir}       ")
+    print(f"   quarantine list:         {quarantine_file}       ")
+    print(f"   node-local staging:      {stage_dir}       ")
+    print(f"   reference index:         {icar_io.reference_dir}       ")
+    print(f"   run log:                 {run_log_dir}       ")
+    print(f"   dask profile:            {profile_dir}       ")
+    print(f"   conservation check:      {conservation_tol}       ")
+    print(f"   raw GCM cp (regrid):     {regrid_cp.raw_path}       ")
+    print(f"   cp resampled from:       {temporal_cp.source_dt}       ")
+    print(f"   3hr outputs:             {output_registry.products_3hr}       ")
+    if noise_seed is not None:
+        print(f"   and adding noise, seed:  {noise_seed}       ")
     else:
         print(f" !  NOT adding noise !!! ")
     if vars_to_drop is not None:
         print(f"   drop unwanted variables: {vars_to_drop}       ")
     print(f"##############################################  \n")
 
-    # determine timestep (nr of timesteps per day): (currently diagnostic only)
-    try:
-        ts_per_day = check.determine_time_step(f"{path_in}/{model}/{scenario}/{year}/icar_out_{year}-{str(10).zfill(2)}*.nc")
-    except:  # if we don;t have month 10 (2005 / 2050 at end of period)
-        ts_per_day = check.determine_time_step(f"{path_in}/{model}/{scenario}/{year}/icar_out_{year}-*.nc")  # {str(1).zfill(2)}
-    print(f"  input timestep is {int(24/ts_per_day)} hr")
-
-    if ts_per_day is not None:
-        correct_to_monthly_3hr_files( path_in, path_out_3hr, model, scenario, year,
-                                    GCM_path   = GCM_path,
-                                    # drop_vars  = drop_vars
-                                    )
-    else:
-         print(f" could not determine input timestep")
-
+    runlog = instrument.RunLog(run_log_dir, profile_dir=profile_dir, model=model, scenario=scenario, year=year, dt='3hr')
+    ledger = None if conservation_tol is None else conservation.Ledger(conservation_tol)
+
+    stage    = None
+    complete = False
+    try:   # also on sys.exit / errors: the outputs put() after their write are moved back, the run log is closed
+        # ____________ stage the year's input (+ GCM cp) to node-local disk, outputs are moved back ____________
+        if stage_dir is not None:
+            stage = staging.Stage(stage_dir)
+            stage.stage_in([ f"{path_in}/{model}/{scenario}/{year}/icar_out_{year}-*.nc", f"{path_in}/{model}/{scenario}/{year+1}/icar_out_{year+1}-01*.nc" ])
+            if remove_cp:
+                stage.stage_cp(cp.cp_files(year, model, scenario.split('_')[0], GCM_path, dt='3hr'), year)
+                GCM_path = stage.local(GCM_path)
+            quarantine = stage.localize(quarantine)
+            path_in    = stage.local(path_in)
+            path_out_3hr = stage.output(path_out_3hr)
+
+        # determine timestep (nr of timesteps per day): (currently diagnostic only)
+        try:
+            ts_per_day = check.determine_time_step(f"{path_in}/{model}/{scenario}/{year}/icar_out_{year}-{str(10).zfill(2)}*.nc")
+        except:  # if we don;t have month 10 (2005 / 2050 at end of period)
+            ts_per_day = check.determine_time_step(f"{path_in}/{model}/{scenario}/{year}/icar_out_{year}-*.nc")  # {str(1).zfill(2)}
+        print(f"  input timestep is {int(24/ts_per_day)} hr")
+
+        if ts_per_day is not None:
+            correct_to_monthly_3hr_files( path_in, path_out_3hr, model, scenario, year,
+                                        GCM_path   = GCM_path,
+                                        # drop_vars  = drop_vars
+                                        )
+        else:
+             print(f" could not determine input timestep")
+
+        if ledger is not None:
+            ledger.finish()
+        complete = True
+    finally:
+        if stage is not None:   # wait for the outputs to be moved back (after an error only the finished ones)
+            stage.finish(complete=complete)
+        runlog.finish()
 
     print(f"\n------------------------------------------------------ ")
     print(f"     {model} {scenario.split('_')[0]} {year} took {np.round((time.time()-t00)/60,1)} min ")
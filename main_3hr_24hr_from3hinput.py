@@ -0,0 +1,399 @@
+#!usr/bin/env python
+
+#####################################################################################
+#
+# Aggregate ICAR postprocessing  -  combined 3hr + 24hr run (one read per month)
+#
+# takes 3h ICAR output files and, for every month:
+#   - check incomplete
+#   - corrects neg pcp (once)
+#   - writes the monthly (3hr) file  (optionally with GCM cp removed)
+#   - accumulates the daily Prec/Tmax/Tmin/Wind from the SAME corrected month
+# and at the end of the year:
+#   - removes GCM cp from the daily Prec (optional) and writes the yearly (24hr) file
+#
+# This replaces running main_3hr_from3hinput.py AND main_24hr_from3hinput.py for the
+# same year, which opens and corrects every month twice.
+#
+# N.B. Tmax/Tmin/Wind are calculated from the 3hr input here, NOT from the 1h data
+#      in the existing daily files (what main_24hr_from3hinput.py keeps).
+#
+# Usage:
+#       - called from submit_postprocess_3hinput.sh (dt=both)
+#       - takes arguments: path_in, path_out, year, model, scenario, remove_cp, GCM_path, CMIP
+#
+#####################################################################################
+import pandas as pd
+from datetime import datetime, timedelta
+import xarray as xr
+import numpy as np
+import glob
+import os
+import sys
+import argparse
+import time
+
+# import functions
+import check_complete as check
+import aggregate_in_time as change_temporal_res
+import fix_neg_pcp as fix
+import remove_cp as cp
+import stage_cache
+import glitch_index
+import preflight_check as preflight
+import staging
+import icar_io
+import instrument
+import conservation
+import regrid_cp
+import temporal_cp
+import output_registry
+import climatology
+import sidecar
+
+
+###############   CAUTION!  ###################
+# the variables to remove: (set to 'None' to keep all output vars)
+
+### CMIP 5/6 PNNL: #### (/glade/campaign/ral/hap/bert/CMIP6/WUS_icar_nocp_full)
+vars_to_drop=["swe", "soil_water_content", "hfls", # "hus2m",
+            "runoff_surface","runoff_subsurface",
+            "soil_column_total_water","soil_column_total_water",
+            "ivt","iwv","iwl","iwi", "snowfall_dt", "cu_precip_dt", "graupel_dt"]
+############################################################
+
+
+#################################
+#       FUNCTIONS
+#################################
+
+def process_command_line():
+    '''Parse the commandline'''
+    parser = argparse.ArgumentParser(description='Post processing of CMIP-ICAR output to 3hr monthly AND 24hr yearly files in one pass')
+    parser.add_argument('path_in',          help='path to 3h input files (should NOT have years as subdirs)')
+    parser.add_argument('path_out',         help='path to write 3hr and 24hr output to')
+    parser.add_argument('year',             help='year to process')
+    parser.add_argument('model',            help='model')
+    parser.add_argument('scenario',         help='scenario to process; one of hist, sspXXX_2004, sspXXX_2049')
+    parser.add_argument('remove_cp',        help='remove GCM cp from ICAR data, requires GCM_cp_path') # bool
+    parser.add_argument('GCM_cp_path',      help='path with the GCM cp on ICAR grid')
+    parser.add_argument('CMIP',             help='CMIP5 or CMIP6' )
+
+    return parser.parse_args()
+
+
+def write_3hr_file(ds3hr, file_out_3hr):
+    """ write the monthly 3hr dataset with precip vars encoded as float32 """
+
+    encoding = {'time' :{'units':"days since 1900-01-01"}}
+    for v in ['precip_dt', 'cu_precip_dt', 'snowfall_dt']:
+        if v in ds3hr.data_vars:
+            encoding[v] = {'dtype':"float32"}
+
+    sidecar.write(ds3hr, file_out_3hr, encoding=encoding)
+
+
+######################  3hr by month, 24hr accumulated per year   ######################
+#
+###################################################################################
+def correct_to_3hr_and_24hr_files( path_in, path_out, model, scenario, year,
+                                   GCM_path  = '/glade/derecho/scratch/bkruyt/CMIP6/GCM_Igrid',
+                                  ):
+    '''Post process 3hourly ICAR output to monthly 3hr files and a yearly 24hr file, reading each month once'''
+    t00 = time.time()
+
+    # determine start month (for first year in run starting on month 10)
+    if year==2005 and (scenario[:3]=='ssp' or scenario[:3]=='rcp') :
+        m_start = 10
+    elif year==2050 and scenario[:3]=='ssp' and scenario[-5:]=='_2049':
+        m_start = 10
+    elif year==2050 and scenario[:3]=='rcp' and scenario[-5:]=='_2100':
+        m_start = 10
+    else:
+        m_start = 1
+
+    if CMIP=="CMIP5":
+        base_path=f"{path_in}/{model}_{scenario}/3hr"
+    else:
+        base_path=f"{path_in}/{model}_{scenario}"
+
+    if CMIP=="CMIP5" and scenario[-4:]=="/3hr": # CMIP5:
+        scen_out = scenario[:-4]
+    else:
+        scen_out = scenario
+
+    ds_daily_months = []   # the daily (24hr) data of every processed month
+    quarantined_months = []   # months skipped for quarantined input: no 24hr file (as main_24hr.py)
+
+    for m in range(m_start,13):
+        t1 = time.time()
+
+        path_m = f"{base_path}/icar_*_{year}-{str(m).zfill(2)}*.nc"
+
+        # if there are no input files (e.g. 2005-12 in hist), move to next month
+        if len(glob.glob(path_m))==0:
+            print(f"\n   no input files for {year}-{str(m).zfill(2)}. ")
+            continue
+
+        # skip months with input files that failed the pre-flight scan (preflight_check.py):
+        if len(preflight.quarantined(quarantine, path_m)) > 0:
+            print(f"\n ! ! !   skipping {year}-{str(m).zfill(2)}, quarantined input: {preflight.quarantined(quarantine, path_m)}  ! ! ! \n")
+            quarantined_months.append(m)
+            continue
+
+        # __________  check files for completeness  ______
+        print(f"\n**********************************************")
+        print(f"   checking {year}-{str(m).zfill(2)}")
+        with runlog.stage('check', month=m):
+            check_result = check.check_month( path_to_files=path_m, m=m, ts_p_day=ts_per_day )
+
+        # ____________       corr neg pcp  (once)     _____________
+        print(f"\n   **********************************************")
+        print(f"   fixing neg {vars_to_correct_3hr.keys()}  for {year}-{str(m).zfill(2)}")
+
+        # find next month's file (needed to calculate timestep pcp (diff))
+        try:
+            if m<12:
+                nextmonth_file_in = sorted(glob.glob(f"{base_path}/icar_*_{year}-{str(m+1).zfill(2)}*.nc"))[0]
+            elif m==12:
+                nextmonth_file_in = sorted(glob.glob(f"{base_path}/icar_*_{str(int(year)+1)}-01*.nc"))[0]
+        except:
+                nextmonth_file_in=None  # should catch all fringe cases, ie 2005 in hist, 2050 in sspXXX_2004
+        if len(preflight.quarantined(quarantine, [nextmonth_file_in])) > 0:   # corrupt, treat as missing
+            nextmonth_file_in = None
+        print( "   nextmonth_file_in ", nextmonth_file_in )
+
+        # (or take the corrected month from the stage cache, shared with main_3hr_from3hinput.py)
+        with runlog.stage('fix', month=m):
+            ds_fxd = stage_cache.cached( cache_dir, 'fix_neg_pcp',
+                                         files   = sorted(glob.glob(path_m)) + [nextmonth_file_in],
+                                         params  = {'neg_thrsh': fix.neg_thrsh, 'vars_to_correct': vars_to_correct_3hr},
+                                         compute = lambda: fix.open_and_remove_neg_pcp( path_m,
+                                                                                        nextmonth_file_in,
+                                                                                        vars_to_correct=vars_to_correct_3hr,
+                                                                                        glitches=glitches
+                                                                                        )
+                                         )
+            # read + correct the month once (with the pending mass accounts of the correction): the daily
+            # aggregation, the cp removal and the 3hr write below all use the month in memory
+            if ds_fxd is not None:
+                ds_fxd, = conservation.compute( ds_fxd )
+
+        if ds_fxd is None:
+            sys.exit(f"\n ! ! !   could not open / correct {path_m}, stopping.  ! ! ! \n")
+
+        # ____________ daily Prec/Tmax/Tmin/Wind from the corrected month __________
+        # (computed before remove_3hr_cp, which overwrites precip_dt in place and drops vars)
+        print(f"\n   **********************************************")
+        print(f"   aggregating {year}-{str(m).zfill(2)} to 24hr")
+        with runlog.stage('aggregate', month=m):
+            # (with the pending mass accounts of the aggregation, conservation.py, in the same compute)
+            ds_daily_m, = conservation.compute( change_temporal_res.make_yearly_24h_file( ds_fxd.copy() ) )
+            ds_daily_months.append( ds_daily_m )
+
+            # ____________ 3hr monthly file __________
+            if int(24/ts_per_day)==1 :
+                ds3hr = change_temporal_res.make_3h_monthly_file( ds_fxd )
+            elif int(24/ts_per_day)==3 :
+                print(f"      input data already has 3hr timestep!")
+                ds3hr = ds_fxd
+
+        # _________  remove cp (3hr)  ____________
+        if remove_cp:
+            print(f"\n   **********************************************")
+            print( f'   removing GCM cp  {year}-{str(m).zfill(2)}  \n')
+            with runlog.stage('remove_cp', month=m):
+                ds3hr = cp.remove_3hr_cp( ds_in       = ds3hr,
+                                            m           = m,
+                                            year        = year,
+                                            model       = model,
+                                            scen        = scenario.split('_')[0],
+                                            GCM_path    = GCM_path,
+                                            noise_seed  = noise_seed,
+                                            vars_to_drop=vars_to_drop  # set to None to switch of dropping
+                                            )
+
+        # __________  save 3hr output  _______________
+        file_out_3hr  = f"{path_out}/{model}_{scen_out}/3hr/icar_3hr_{model}_{scen_out.split('_')[0]}_{year}-{str(m).zfill(2)}.nc"
+
+        print(f"\n   **********************************************")
+        print( '   writing 3hfile to ', file_out_3hr )
+
+        if not os.path.exists(f"{path_out}/{model}_{scen_out}/3hr"):
+            os.makedirs(f"{path_out}/{model}_{scen_out}/3hr")
+
+        with runlog.stage('write', month=m):
+            write_3hr_file(ds3hr, file_out_3hr)
+
+        if stage is not None:
+            stage.put(file_out_3hr)
+            stage.put(sidecar.sidecar_path(file_out_3hr))
+
+        # end month loop:
+        print(f"\n   - - - - -   month {m} done in {np.round((time.time()-t1)/60,1)} min - - - - - ")
+
+
+    # ____________ yearly 24hr file  _____________
+    if len(ds_daily_months)==0:
+        print(f"\n ! ! !   no months processed for {year}, no 24hr file written  ! ! ! ")
+        return
+    if len(quarantined_months) > 0:
+        print(f"\n ! ! !   {year} has quarantined input in months {quarantined_months}, no 24hr file written (3hr files of the other months are)  ! ! ! ")
+        return
+
+    ds24hr = xr.concat( ds_daily_months, dim='time' )
+
+    if remove_cp:
+        print(f"\n   **********************************************")
+        print( f'   removing GCM cp  {year} (24hr)')
+        with runlog.stage('remove_cp'):
+            ds24hr = cp.remove_24hr_cp( ds_in       = ds24hr,
+                                        year        = year,
+                                        model       = model,
+                                        scen        = scenario.split('_')[0],
+                                        GCM_path    = GCM_path,
+                                        noise_seed  = noise_seed,
+                                        )
+
+    file_out_24hr  = f"{path_out}/{model}_{scen_out}/daily/icar_daily_{model}_{scen_out.split('_')[0]}_{year}.nc"
+    print(f"\n   **********************************************")
+    print( '   writing 24hfile to ', file_out_24hr )
+
+    if not os.path.exists(f"{path_out}/{model}_{scen_out}/daily"):
+        os.makedirs(f"{path_out}/{model}_{scen_out}/daily")
+
+    # monthly climatology / Prec extremes (from the daily data in memory)
+    if clim_dir is not None:
+        with runlog.stage('climatology'):
+            clim   = climatology.Climatology()
+            ds24hr = clim.add(ds24hr)
+            clim.write(f"{clim_dir}/{model}_{scen_out}/clim_{model}_{scen_out.split('_')[0]}_{year}.nc")
+
+    with runlog.stage('write'):
+        sidecar.write(ds24hr, file_out_24hr, encoding={'time':{'units':"days since 1900-01-01"},
+                                                       'Prec':{'dtype':"float32"}} )
+    if stage is not None:
+        stage.put(file_out_24hr)
+        stage.put(sidecar.sidecar_path(file_out_24hr))
+
+    print(f"\n   - - - - -     {year}  done in {np.round((time.time()-t00)/60,1)} min  - - - - - ")
+
+
+
+#################################
+#           Main
+#################################
+if __name__ == '__main__':
+
+    t00 = time.time()
+
+    # process command line
+    args = process_command_line()
+    path_in         = args.path_in
+    path_out        = args.path_out
+    model           = args.model
+    scenario        = args.scenario
+    year            = int(args.year)
+    remove_cp       = True if args.remove_cp=="True" else False
+    GCM_path        = args.GCM_cp_path if args.remove_cp=="True" else None
+    CMIP            = args.CMIP
+
+
+    ########          correct negative variables          ########
+    vars_to_correct_3hr = {'precipitation'   : 'precip_dt',
+                            'snowfall'        : 'snowfall_dt',
+                            'cu_precipitation': 'cu_precip_dt',
+                            'graupel'         : 'graupel_dt'
+                            }
+
+    noise_seed   = None   # add reproducible uniform noise to the dry pixels of the corrected pcp (noise.py, generated on the fly, no noise file), None: no noise
+    cache_dir    = None  # stage cache for the corrected months (e.g. local scratch), None to switch off
+    glitch_dir   = None   # index of the negative timesteps per model/scenario (skips the detection on reruns), None to switch off
+    glitch_verify= False  # re-scan when the input files changed (size/mtime) since they were indexed
+    glitches = None if glitch_dir is None else glitch_index.GlitchIndex(glitch_dir, model, scenario, verify=glitch_verify)
+    quarantine_file= None   # list of bad input files written by preflight_check.py (skipped up front), None to switch off
+    quarantine = preflight.read_quarantine(quarantine_file)
+    stage_dir    = None   # node-local dir (e.g. /dev/shm, $TMPDIR) for the year's input + GCM cp and the outputs, None to switch off
+    icar_io.reference_dir = None   # reference indexes of the input (reference_index.py), opens the months without reading every file's metadata, None to switch off
+    run_log_dir  = None   # json lines log of time / cpu / io / peak memory per stage (instrument.py, telemetry for plan_jobs.py), None: only print
+    profile_dir  = None   # dask task stream + resource profile per stage (profiling.py: trace json + html report, e.g. f"{path_out}/profiles"), None to switch off
+    conservation_tol = 1e-4   # relative tolerance of the precipitation mass conservation checks (conservation.py, in the run log), None to switch off
+    regrid_cp.raw_path = None   # raw GCM cp (CMIP prc files), regridded to the ICAR grid in the pipeline with cached weights (regrid_cp.py) iso the cp in GCM_path, None to switch off
+    temporal_cp.source_dt = None   # resample the GCM cp from the files of this frequency ('3hr', '24hr'; raw cp also '6hr') to the ICAR timestep, mass conserving (temporal_cp.py), None: read the cp at the ICAR timestep
+    temporal_cp.cache_dir = None   # cache of the resampled cp per decade (stage_cache.py, e.g. local scratch), None: resample every year
+    output_registry.products_3hr  = None   # 3hr output variables (output_registry.py), None: all input variables
+    output_registry.products_24hr = ['Prec', 'Tmax', 'Tmin', 'Wind']   # daily output variables (output_registry.py, also 'Snow', 'RH'), only their inputs are read
+    clim_dir     = None   # monthly climatology / Prec extremes accumulators per year (climatology.py, e.g. f"{path_out}/climatology"), None to switch off
+
+    print(f"\n##############################################  ")
+    print(f"   Making 3-hourly AND daily corrected ICAR files for: " )
+    print(f"      {model}   {scenario}   {year}   {CMIP}      \n")
+    print(f"   remove GCM cp:           {remove_cp}       ")
+    print(f"   stage cache:             {cache_dir}       ")
+    print(f"   glitch index:            {glitch_dir}       ")
+    print(f"   quarantine list:         {quarantine_file}       ")
+    print(f"   node-local staging:      {stage_dir}       ")
+    print(f"   reference index:         {icar_io.reference_dir}       ")
+    print(f"   run log:                 {run_log_dir}       ")
+    print(f"   dask profile:            {profile_dir}       ")
+    print(f"   conservation check:      {conservation_tol}       ")
+    print(f"   raw GCM cp (regrid):     {regrid_cp.raw_path}       ")
+    print(f"   cp resampled from:       {temporal_cp.source_dt}       ")
+    print(f"   3hr outputs:             {output_registry.products_3hr}       ")
+    print(f"   daily outputs:           {output_registry.products_24hr}       ")
+    print(f"   climatology:             {clim_dir}       ")
+    print(f"   noise seed:              {noise_seed}       ")
+    print(f"   Tmax/Tmin/Wind from 3hr input (not from 1h daily files)")
+    if vars_to_drop is not None:
+        print(f"   drop unwanted variables (3hr): {vars_to_drop}       ")
+    print(f"##############################################  \n")
+
+    runlog = instrument.RunLog(run_log_dir, profile_dir=profile_dir, model=model, scenario=scenario, year=year, dt='both')
+    ledger = None if conservation_tol is None else conservation.Ledger(conservation_tol)
+
+    stage    = None
+    complete = False
+    try:   # also on sys.exit / errors: the outputs put() after their write are moved back, the run log is closed
+        # ____________ stage the year's input (+ GCM cp) to node-local disk, outputs are moved back ____________
+        if stage_dir is not None:
+            stage = staging.Stage(stage_dir)
+            stage.stage_in([ f"{path_in}/{model}_{scenario}/**/icar_*_{year}-*.nc", f"{path_in}/{model}_{scenario}/**/icar_*_{year+1}-01*.nc" ])
+            if remove_cp:
+                stage.stage_cp(cp.cp_files(year, model, scenario.split('_')[0], GCM_path, dt='3hr'), year)
+                stage.stage_cp(cp.cp_files(year, model, scenario.split('_')[0], GCM_path, dt='daily'), year)
+                GCM_path = stage.local(GCM_path)
+            quarantine = stage.localize(quarantine)
+            path_in    = stage.local(path_in)
+            path_out   = stage.output(path_out)
+
+        # determine timestep (nr of timesteps per day):
+        try:
+            if CMIP=="CMIP5":
+                ts_per_day = check.determine_time_step(f"{path_in}/{model}_{scenario}/3hr/icar_*_{year}-{str(10).zfill(2)}*.nc")
+            else:
+                ts_per_day = check.determine_time_step(f"{path_in}/{model}_{scenario}/icar_*_{year}-{str(10).zfill(2)}*.nc")
+        except:  # if we don;t have month 10 (2005 / 2050 at end of period)
+            if CMIP=="CMIP5":
+                ts_per_day = check.determine_time_step(f"{path_in}/{model}_{scenario}/3hr/icar_*_{year}-{str(1).zfill(2)}*.nc")
+            else:
+                ts_per_day = check.determine_time_step(f"{path_in}/{model}_{scenario}/icar_*_{year}-{str(1).zfill(2)}*.nc")
+
+        if ts_per_day is not None:
+            print(f"  input timestep is {int(24/ts_per_day)} hr")
+            correct_to_3hr_and_24hr_files( path_in, path_out, model, scenario, year,
+                                           GCM_path   = GCM_path
+                                          )
+        else:
+            print(f" could not determine input timestep")
+
+        if ledger is not None:
+            ledger.finish()
+        complete = True
+    finally:
+        if stage is not None:   # wait for the outputs to be moved back (after an error only the finished ones)
+            stage.finish(complete=complete)
+        runlog.finish()
+
+    print(f"\n------------------------------------------------------ ")
+    print(f"     {model} {scenario.split('_')[0]} {year} took {np.round((time.time()-t00)/60,1)} min ")
+    print(f"------------------------------------------------------ \n ")
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# coding: utf-8
+######################################################################################################
+#
+# Reproducible uniform noise, generated on the fly (iso reading uniform_noise_480_480.nc):
+#    - counter based random numbers (numpy Philox): the noise of a pixel only depends on the seed,
+#      the hour of the timestep (hours since 1900, time_axis.py) and its place in a fixed tile_size
+#      grid of tiles (Philox key = (seed, hour), counter = (0, 0, tile row, tile col))
+#    - so the noise is the same for every run, chunking, month split or 1h / 3hr / daily file, and
+#      a chunk only generates the tiles it overlaps (nothing is read, nothing is kept)
+#    - add_where_dry(pcp, seed) adds uniform noise [0, amplitude) to the dry pixels (pcp <= dry),
+#      lazily per dask chunk
+#
+# Usage:
+#   set noise_seed in the main_*.py drivers (passed to remove_cp.remove_3hr_cp / remove_24hr_cp)
+#   python noise.py seed 2051-01-01T00 [--ny 480 --nx 480 --nt 8]   (print statistics of the noise)
+#
+######################################################################################################
+
+import argparse
+import numpy as np
+import dask.array
+
+import time_axis
+import conservation
+
+
+#########################################
+#         SETTTINGS
+#######################################
+amplitude = 0.01    # kg m-2, the noise is uniform in [0, amplitude)
+dry       = 0.      # kg m-2, noise is added where pcp <= dry
+tile_size = 64      # pixels, the noise is generated per tile (does not depend on the dask chunks)
+
+
+def process_command_line():
+    '''Parse the commandline'''
+    parser = argparse.ArgumentParser(description='generate the uniform noise of a few timesteps and print its statistics')
+    parser.add_argument('seed',    type=int,         help='noise seed')
+    parser.add_argument('time',                      help='first timestep (e.g. 2051-01-01T00)')
+    parser.add_argument('--ny',    default=480, type=int, help='nr of lat_y pixels')
+    parser.add_argument('--nx',    default=480, type=int, help='nr of lon_x pixels')
+    parser.add_argument('--nt',    default=8,   type=int, help='nr of (3hr) timesteps')
+
+    return parser.parse_args()
+
+
+def _tile(seed, hour, iy, ix, dtype='float32'):
+    """ the uniform [0, 1) noise of tile (iy, ix) at hour"""
+    bitgen = np.random.Philox(key=np.array([seed, hour], dtype='int64').view('uint64'),
+                              counter=np.array([0, 0, iy, ix], dtype='uint64'))
+    return np.random.Generator(bitgen).random((tile_size, tile_size), dtype=dtype)
+
+
+def uniform(seed, hours, y_slice, x_slice, dtype='float32'):
+    """ uniform [0, 1) noise (len(hours), y, x) of the pixels y_slice, x_slice (slices of the full grid)"""
+    y0, y1 = y_slice.start, y_slice.stop
+    x0, x1 = x_slice.start, x_slice.stop
+    out = np.empty((len(hours), y1-y0, x1-x0), dtype=dtype)
+    for iy in range(y0 // tile_size, (y1-1) // tile_size + 1):
+        for ix in range(x0 // tile_size, (x1-1) // tile_size + 1):
+            # the part of tile (iy, ix) in the block:
+            ty0, ty1 = max(y0, iy*tile_size), min(y1, (iy+1)*tile_size)
+            tx0, tx1 = max(x0, ix*tile_size), min(x1, (ix+1)*tile_size)
+            for i, hour in enumerate(hours):
+                out[i, ty0-y0:ty1-y0, tx0-x0:tx1-x0] = _tile(seed, hour, iy, ix, dtype)[ty0-iy*tile_size:ty1-iy*tile_size,
+                                                                                        tx0-ix*tile_size:tx1-ix*tile_size]
+    return out
+
+
+def _add_block(block, hours, seed, block_info=None):
+    """ block (time, y, x) + amplitude * noise where block <= dry (location of the block from block_info)"""
+    (t0, t1), (y0, y1), (x0, x1) = block_info[0]['array-location'] if block_info is not None else [(0, s) for s in block.shape]
+    noise = uniform(seed, hours[t0:t1], slice(y0, y1), slice(x0, x1), dtype=block.dtype) * block.dtype.type(amplitude)
+    return np.where(block <= dry, block + noise, block)
+
+
+def add_where_dry(pcp, seed):
+    """ pcp (time, lat_y, lon_x) with uniform noise [0, amplitude) added to the dry pixels, lazy (per chunk) if
+        pcp is a dask array"""
+    da    = pcp.transpose('time', ...)
+    hours = time_axis.TimeAxis.from_dataarray(da.time).hours
+    if isinstance(da.data, dask.array.Array):
+        data = da.data.map_blocks(_add_block, hours=hours, seed=seed, dtype=da.dtype)
+    else:
+        data = _add_block(np.asarray(da.values), hours, seed)
+    out = da.copy(data=data).transpose(*pcp.dims)
+    out.attrs['processing_note4'] = f"added uniform noise [0, {amplitude}) kg m-2 where <= {dry} kg m-2 (counter based, seed {seed})"
+    # the added mass (not a conservation check):
+    conservation.account('noise', pcp.name, checked=False, into=pcp.sum(dtype='float64'), out=out.sum(dtype='float64'))
+    return out
+
+
+###########################
+#     MAIN
+###########################
+if __name__=="__main__":
+
+    args  = process_command_line()
+    ta    = time_axis.TimeAxis.from_values(np.array([np.datetime64(args.time, 'h')]))
+    hours = ta.hours[0] + 3*np.arange(args.nt)
+    u = uniform(args.seed, hours, slice(0, args.ny), slice(0, args.nx))
+    print(f"   {u.shape} noise, seed {args.seed}, hours {hours[0]} - {hours[-1]} since 1900-01-01")
+    print(f"   min {u.min():.4f}, max {u.max():.4f}, mean {u.mean():.4f} (0.5), std {u.std():.4f} ({1/np.sqrt(12):.4f})")
+    print(f"   lag-1 correlation in time {np.corrcoef(u[:-1].ravel(), u[1:].ravel())[0,1]:.4f}, "
+          f"between tiles {np.corrcoef(u[:, :tile_size, :tile_size].ravel(), u[:, :tile_size, tile_size:2*tile_size].ravel())[0,1]:.4f}")
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# coding: utf-8
+######################################################################################################
+#
+# Registry of the output variables of the 3hr and daily files:
+#    - every output (Output) lists its input variables (a tuple: alternatives, the first one in the
+#      dataset is used), the reduction over the output timestep (sum, mean, min, max, instantaneous),
+#      an optional derivation from the inputs (e.g. wind speed from u10m / v10m) and its attrs
+#    - the outputs are built for a requested list of names (products_3hr / products_24hr, set in the
+#      drivers); only the inputs those need are read and computed (lazy, dask), outputs whose inputs
+#      are not in the dataset are skipped with a message
+#    - used by aggregate_in_time.py (xarray), and by stream_aggregate.py / tiled_correction.py
+#      (products(): {name: (inputs, reduction, derive)})
+#
+# Usage:
+#   output_registry.products_24hr = ['Prec', 'Tmax', 'Tmin', 'Wind', 'Snow']   (in the main_*.py drivers)
+#   python output_registry.py                (list the registered outputs)
+#
+######################################################################################################
+
+import argparse
+import xarray as xr
+import numpy as np
+
+import precision
+import time_axis
+
+
+#########################################
+#         SETTTINGS
+#######################################
+products_3hr  = None                             # 3hr output variables, None: every input variable
+products_24hr = ['Prec', 'Tmax', 'Tmin', 'Wind'] # daily output variables (see outputs_24hr)
+
+# cumulative ICAR variable: its timestep amount (fix_neg_pcp.py), summed over the output timestep
+timestep_amounts = {'precipitation'   : 'precip_dt',
+                    'snowfall'        : 'snowfall_dt',
+                    'cu_precipitation': 'cu_precip_dt',
+                    'graupel'         : 'graupel_dt'
+                    }
+instantaneous_3hr = ['swe']   # taken at the start of the 3hr timestep (resample nearest) iso averaged
+
+
+def process_command_line():
+    '''Parse the commandline'''
+    parser = argparse.ArgumentParser(description='list the registered output variables')
+
+    return parser.parse_args()
+
+
+class Output:
+    """ an output variable: inputs, reduction over the output timestep, derivation, attrs"""
+
+    def __init__(self, inputs, reduction, derive=None, attrs=None):
+        self.inputs    = [(v,) if isinstance(v, str) else tuple(v) for v in inputs]
+        self.reduction = reduction
+        self.derive    = derive
+        self.attrs     = {} if attrs is None else attrs
+
+    def resolve(self, data_vars):
+        """ the input variables in data_vars (first alternative present), None if one is missing"""
+        names = []
+        for alternatives in self.inputs:
+            found = [v for v in alternatives if v in data_vars]
+            if len(found)==0:
+                return None
+            names.append(found[0])
+        return names
+
+    def output_attrs(self, ds_in, inputs):
+        """ attrs of the (first) input variable in ds_in, updated with the attrs of the output"""
+        attrs = dict(ds_in[inputs[0]].attrs) if inputs[0] in ds_in else {}
+        attrs.update(self.attrs)
+        return attrs
+
+
+##############################################################################################
+#      derivations                                                                            #
+##############################################################################################
+def wind_speed(u, v):
+    return np.abs(np.sqrt(u**2 + v**2))
+
+
+def relative_humidity(q, t, p):
+    """ relative humidity (%) from specific humidity (kg kg-1), temperature (K) and pressure (Pa)
+        (vapour pressure over saturation vapour pressure, Bolton 1980)"""
+    e  = q * p / (0.622 + 0.378 * q)
+    es = 611.2 * np.exp(17.67 * (t - 273.15) / (t - 29.65))
+    return 100. * e / es
+
+
+##############################################################################################
+#      registry                                                                               #
+##############################################################################################
+def outputs_3hr(data_vars):
+    """ the 3hr outputs of the variables in data_vars: timestep amounts summed, instantaneous_3hr
+        taken at the start of the timestep, the rest averaged"""
+    outputs = {}
+    for v in data_vars:
+        if v in timestep_amounts.values():
+            varname = [k for k, dt in timestep_amounts.items() if dt==v][0]
+            outputs[v] = Output([v], 'sum', attrs={'processing_note2': f'summed the hourly {varname} amount over 3hours',
+                                                   'units'           : 'kg m-2',
+                                                   'standard_name'   : f'{varname}_amount_dt',
+                                                   'long_name'       : f'timestep {varname} amount ' })
+        elif v in instantaneous_3hr:
+            outputs[v] = Output([v], 'instantaneous', attrs={'processing_note': 'took the instantaneous value from hourly output to three hourly data'})
+        else:
+            outputs[v] = Output([v], 'mean', attrs={'processing_note2': 'computed the average over three hour from hourly output. Average include time stamp plus next two time steps.'})
+    return outputs
+
+
+outputs_24hr = {
+    'Prec': Output([('precip_dt', 'precipitation', 'Prec')], 'sum',
+                   attrs={'units'           : 'kg m-2 d-1',
+                          'standard_name'   : 'precipitation_flux',
+                          'long_name'       : 'precipitation flux per day',
+                          'processing_note2': 'calculated from timestep precipitation by summation - precipitation equals the total amount of precipitation that occured throughout the day. e.g. If time stamp is 1950-01-01 00:00:00 then it is the precipitation that occured between 1950-01-01 00:00 and 1950-01-02 00:00'}),
+    'Tmax': Output(['ta2m'], 'max',
+                   attrs={'non-standard_name': 'maximum_daily_air_temperature',
+                          'long_name'        : 'Bulk maximum daily air temperature at 2m'}),
+    'Tmin': Output(['ta2m'], 'min',
+                   attrs={'non-standard_name': 'minimum_daily_air_temperature',
+                          'long_name'        : 'Bulk minimum daily air temperature at 2m'}),
+    'Wind': Output(['u10m', 'v10m'], 'mean', derive=wind_speed,
+                   attrs={'standard_name': 'wind_speed',
+                          'long_name'    : '10-m wind speed independent of direction calculated as abs(sqrt(u10m^2 + v10m^2)): Daily Average'}),
+    'Snow': Output(['snowfall_dt'], 'sum',
+                   attrs={'units'           : 'kg m-2 d-1',
+                          'standard_name'   : 'snowfall_flux',
+                          'long_name'       : 'snowfall (liquid equivalent) per day',
+                          'processing_note2': 'calculated from timestep snowfall by summation, over the day that starts at the time stamp'}),
+    'RH':   Output(['hus2m', 'ta2m', 'psfc'], 'mean', derive=relative_humidity,
+                   attrs={'units'           : '%',
+                          'standard_name'   : 'relative_humidity',
+                          'long_name'       : '2-m relative humidity: Daily Average',
+                          'processing_note2': 'calculated from hus2m, ta2m and psfc per timestep (Bolton 1980), then averaged over the day'}),
+    }
+
+
+def outputs(freq_hours, data_vars):
+    """ the registry of freq_hours (3: from the variables in data_vars, 24: outputs_24hr)"""
+    return outputs_24hr if freq_hours==24 else outputs_3hr(data_vars)
+
+
+def select(freq_hours, data_vars, requested=None):
+    """ {name: (Output, input names)} of the requested outputs (default: products_3hr / products_24hr)
+        whose inputs are in data_vars"""
+    registry  = outputs(freq_hours, data_vars)
+    requested = (products_24hr if freq_hours==24 else products_3hr) if requested is None else requested
+    requested = list(registry) if requested is None else requested
+    selected  = {}
+    for name in requested:
+        if name not in registry:
+            raise KeyError(f"no output '{name}' in the {freq_hours}hr registry (output_registry.py): {list(registry)}")
+        inputs = registry[name].resolve(data_vars)
+        if inputs is None:
+            print(f"   ! {name}: input {registry[name].inputs} not in the dataset, not in the output")
+            continue
+        selected[name] = (registry[name], inputs)
+    return selected
+
+
+def products(freq_hours, data_vars, requested=None):
+    """ {name: (inputs, reduction, derive)} (stream_aggregate.py / tiled_correction.py)"""
+    return {name: (inputs, out.reduction, out.derive) for name, (out, inputs) in select(freq_hours, data_vars, requested).items()}
+
+
+def attrs(name, ds_in, freq_hours, inputs=None):
+    """ attrs of output name, based on the input dataset ds_in"""
+    out = outputs(freq_hours, [name])[name]
+    return out.output_attrs(ds_in, out.resolve(ds_in.data_vars) if inputs is None else inputs)
+
+
+##############################################################################################
+#      build (xarray, lazy)                                                                   #
+##############################################################################################
+def reduce(x, reduction, freq_hours, name):
+    """ x resampled to freq_hours with reduction, in the dtype of the policy (sums compensated).
+        Windows from the integer time axis (any calendar), empty windows NaN (as resample)"""
+    if 'time' not in x.dims:
+        return precision.apply_policy(x, name)
+    if reduction=='sum':
+        return precision.resample_sum(x, freq_hours, name=name)
+
+    t_axis = time_axis.TimeAxis.from_dataarray(x.time)
+    labels = t_axis.window_starts(freq_hours)
+    times  = time_axis.TimeAxis(labels, t_axis.calendar).decode()
+    if reduction=='instantaneous':
+        # the timestep nearest to every window start (as resample().nearest(), ties to the later one)
+        right = np.clip(np.searchsorted(t_axis.hours, labels), 0, len(t_axis)-1)
+        left  = np.clip(right-1, 0, None)
+        idx   = np.where(labels - t_axis.hours[left] < np.abs(t_axis.hours[right] - labels), left, right)
+        return precision.apply_policy(x.isel(time=idx).assign_coords(time=times), name)
+
+    grouped = x.assign_coords(window=('time', t_axis.window_index(freq_hours))).groupby('window')
+    out     = getattr(grouped, reduction)(dim='time').reindex(window=labels)
+    out     = out.rename(window='time').assign_coords(time=times).transpose(*x.dims)
+    return out.astype(precision.policy_dtype(name))
+
+
+def build(ds, freq_hours, selected=None):
+    """ Dataset of the selected outputs (default: select(), the requested ones) of ds, lazy if ds is;
+        only the needed inputs are used"""
+    selected = select(freq_hours, list(ds.data_vars)) if selected is None else selected
+    out      = xr.Dataset()
+    for name, (output, inputs) in selected.items():
+        x = ds[inputs[0]] if output.derive is None else output.derive(*[ds[v] for v in inputs])
+        out[name] = reduce(x, output.reduction, freq_hours, name)
+        out[name].attrs = output.output_attrs(ds, inputs)
+    out.attrs = ds.attrs
+    return out
+
+
+###########################
+#     MAIN
+###########################
+if __name__=="__main__":
+
+    args = process_command_line()
+    print(f"   3hr (per input variable, requested: {products_3hr}):")
+    for name, out in outputs_3hr(list(timestep_amounts.values()) + instantaneous_3hr + ['ta2m']).items():
+        print(f"      {name:<14} {out.reduction:<14} {out.inputs}")
+    print(f"   24hr (requested: {products_24hr}):")
+    for name, out in outputs_24hr.items():
+        print(f"      {name:<14} {out.reduction:<14} {out.inputs}{'  derived: '+out.derive.__name__ if out.derive else ''}")
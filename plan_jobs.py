@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# coding: utf-8
+######################################################################################################
+#
+# Job planner: sizes and packs the (model, scenario, year) postprocessing tasks into job arrays
+#    - enumerates all tasks from the input directory (the same layouts the drivers read)
+#    - predicts peak memory and wall time per task from the grid size, timestep and number of
+#      variables (the uncompressed size of the data one driver step holds: a month for 3hr, a year
+#      for daily), scaled with past run telemetry where available
+#    - groups the tasks in memory classes (mem_steps) and packs the tasks of each class into array
+#      elements of at most max_walltime (first fit decreasing), so no class requests more memory
+#      than its largest task needs and short tasks share one element
+#    - writes per class a task list + a PBS and a SLURM array script, and tasks.csv with the predictions
+#
+#   telemetry: json lines, one per finished task:
+#       {"model": .., "scenario": .., "year": .., "dt": "3hr", "wall_s": 4210, "peak_rss_mb": 35120}
+#   (the 'total' lines of the run logs of instrument.py, e.g. --telemetry "run_log_dir/*.jsonl")
+#
+#   without telemetry the default coefficients (mem_factor, wall_s_per_gb) are a rough guess,
+#   based on the ~1.5 hr per scenario-year of the submit scripts.
+#
+# Usage:
+#   python plan_jobs.py path_in path_out plan_dir --layout 3h --dt 3hr [--telemetry runs.jsonl]
+#          [--models A B] [--scenarios ssp245_2004 ...] [--remove_cp True --GCM_cp_path ..] [--CMIP CMIP6]
+#   then submit the scripts in plan_dir:  qsub plan_dir/pbs_3hr_mem40GB.sh  or  sbatch plan_dir/slurm_3hr_mem40GB.sh
+#
+######################################################################################################
+
+import argparse
+import numpy as np
+import pandas as pd
+import glob
+import json
+import os
+import re
+import sys
+
+import time_axis
+import icar_io
+
+
+# memory classes (GB) a task is rounded up to:
+mem_steps = [10, 20, 40, 70, 100, 150, 250, 350]
+
+# defaults without telemetry: peak memory = mem_base_gb + mem_factor * working set, wall = wall_base_s + wall_s_per_gb * year of data
+mem_base_gb   = 2.
+mem_factor    = {'3hr': 3.0, 'daily': 1.5, 'both': 3.5}
+wall_base_s   = 120.
+wall_s_per_gb = {'3hr': 150., 'daily': 100., 'both': 180.}
+
+# margin on top of the prediction:
+safety = 1.25
+
+scen_pattern = re.compile(r'^(.*?)_((hist|historical|ssp|rcp).*)$')
+
+
+def process_command_line():
+    '''Parse the commandline'''
+    parser = argparse.ArgumentParser(description='size and pack postprocessing tasks into PBS / SLURM job arrays')
+    parser.add_argument('path_in',          help='path to the ICAR input')
+    parser.add_argument('path_out',         help='path_out argument of the drivers')
+    parser.add_argument('plan_dir',         help='directory to write the task lists and job scripts to')
+    parser.add_argument('--layout',         default='3h',   help="'1h' ({path_in}/{model}/{scenario}/{year}/) or '3h' ({path_in}/{model}_{scenario}[/3hr]/)")
+    parser.add_argument('--dt',             default='3hr',  help="'3hr', 'daily' or 'both'")
+    parser.add_argument('--models',         nargs='*', default=None, help='models to plan (default: all)')
+    parser.add_argument('--scenarios',      nargs='*', default=None, help='scenarios to plan (default: all)')
+    parser.add_argument('--telemetry',      default=None,   help='json lines with wall_s / peak_rss_mb of past runs (file or glob, quoted)')
+    parser.add_argument('--remove_cp',      default='True', help='remove_cp argument of the drivers')
+    parser.add_argument('--GCM_cp_path',    default='None', help='GCM_cp_path argument of the drivers')
+    parser.add_argument('--CMIP',           default='CMIP6',help='CMIP argument of the drivers')
+    parser.add_argument('--path_day_in',    default=None,   help='path_day_in argument (daily, 3h input)')
+    parser.add_argument('--max_walltime_h', default=12., type=float, help='max wall time of one array element')
+    parser.add_argument('--account',        default='P48500028')
+    parser.add_argument('--queue',          default='casper', help='PBS queue / SLURM qos')
+
+    return parser.parse_args()
+
+
+##############################################################################################
+#      enumerate tasks                                                                        #
+##############################################################################################
+def enumerate_tasks(path_in, layout='3h', CMIP='CMIP6', models=None, scenarios=None):
+    """ DataFrame of (model, scenario, year, files pattern) in path_in"""
+    rows = []
+    if layout=='1h':
+        for d in sorted(glob.glob(f"{path_in}/*/*/[0-9][0-9][0-9][0-9]")):
+            model, scenario, year = d.split('/')[-3:]
+            rows.append((model, scenario, int(year), f"{d}/icar_out_{year}-*.nc"))
+    else:
+        for d in sorted(glob.glob(f"{path_in}/*_*")):
+            match = scen_pattern.match(os.path.basename(d))
+            if match is None or not os.path.isdir(d): continue
+            model, scenario = match.group(1), match.group(2)
+            base = f"{d}/3hr" if CMIP=="CMIP5" else d
+            years = sorted(set( re.findall(r'_(\d{4})-\d{2}', os.path.basename(f))[0]
+                                for f in glob.glob(f"{base}/icar_*_*.nc") if re.findall(r'_(\d{4})-\d{2}', os.path.basename(f)) ))
+            for year in years:
+                rows.append((model, scenario, int(year), f"{base}/icar_*_{year}-*.nc"))
+
+    tasks = pd.DataFrame(rows, columns=['model', 'scenario', 'year', 'files'])
+    if models is not None:    tasks = tasks[tasks.model.isin(models)]
+    if scenarios is not None: tasks = tasks[tasks.scenario.isin(scenarios)]
+    return tasks.reset_index(drop=True)
+
+
+def task_size(files):
+    """ grid size, timestep (h), nr of (time, y, x) variables and bytes per value, from one file header"""
+    flist = sorted(glob.glob(files))
+    with icar_io.open_file(flist[0]) as ds:
+        ny, nx   = ds.sizes.get('lat_y', 0), ds.sizes.get('lon_x', 0)
+        vars_3d  = [v for v in ds.data_vars if ds[v].dims[:1]==('time',) and ds[v].ndim==3]
+        itemsize = int(np.mean([ds[v].dtype.itemsize for v in vars_3d])) if vars_3d else 4
+        step_h   = time_axis.TimeAxis.from_dataarray(ds.time).step_hours()
+    if step_h is None and len(flist) > 1:   # one timestep per file
+        with icar_io.open_icar(flist[:2]) as ds:
+            step_h = time_axis.TimeAxis.from_dataarray(ds.time).step_hours()
+    if step_h is None:
+        sys.exit(f"   ! could not determine the timestep of {files}")
+    return dict(ny=ny, nx=nx, step_h=step_h, n_vars=len(vars_3d), itemsize=itemsize, n_files=len(flist))
+
+
+def add_sizes(tasks, dt):
+    """ add the uncompressed GB of the working set (month for 3hr, year for daily) and of the whole year"""
+    sizes = {}
+    for (model, scenario), g in tasks.groupby(['model', 'scenario']):
+        sizes[(model, scenario)] = task_size(g.files.iloc[0])   # one header read per model/scenario
+    cols = []
+    for _, t in tasks.iterrows():
+        s = sizes[(t.model, t.scenario)]
+        gb_per_day = 24 / s['step_h'] * s['ny'] * s['nx'] * s['n_vars'] * s['itemsize'] / 1024**3
+        cols.append(dict(ny=s['ny'], nx=s['nx'], step_h=s['step_h'], n_vars=s['n_vars'],
+                         ws_gb  = gb_per_day * (365 if dt=='daily' else 31),
+                         year_gb= gb_per_day * 365))
+    return pd.concat([tasks, pd.DataFrame(cols, index=tasks.index)], axis=1)
+
+
+##############################################################################################
+#      predict memory and wall time                                                          #
+##############################################################################################
+def read_telemetry(file_in, dt):
+    """ DataFrame of the telemetry lines of this dt (of the run totals for instrument.py run logs)"""
+    files = [] if file_in is None else sorted(glob.glob(file_in))
+    lines = []
+    for f_in in files:
+        with open(f_in) as f:
+            lines += [json.loads(l) for l in f if l.strip()]
+    if len(lines)==0:
+        return pd.DataFrame(columns=['model', 'scenario', 'year', 'dt', 'wall_s', 'peak_rss_mb'])
+    tel = pd.DataFrame(lines)
+    if 'stage' in tel.columns:
+        tel = tel[tel.stage.fillna('total')=='total']
+    if 'dt' in tel.columns:
+        tel = tel[tel.dt.fillna(dt)==dt]
+    return tel.dropna(subset=['wall_s', 'peak_rss_mb'])
+
+
+def predict(tasks, telemetry, dt):
+    """ add mem_gb and wall_s predictions (incl. safety margin) to tasks.
+        Coefficients are fitted on the telemetry (90th percentile of measured / size), tasks that ran
+        before use their own (max) measurement."""
+    mem_f, wall_f = mem_factor[dt], wall_s_per_gb[dt]
+    if len(telemetry) > 0:
+        tel = telemetry.merge(tasks[['model', 'scenario', 'year', 'ws_gb', 'year_gb']], on=['model', 'scenario', 'year'])
+        if len(tel) > 0:
+            mem_f  = np.percentile( (tel.peak_rss_mb/1024 - mem_base_gb).clip(lower=0.1) / tel.ws_gb, 90 )
+            wall_f = np.percentile( (tel.wall_s - wall_base_s).clip(lower=1) / tel.year_gb, 90 )
+            print(f"   fitted on {len(tel)} telemetry lines: mem {np.round(mem_f,2)} x working set, {np.round(wall_f,1)} s/GB")
+
+    tasks = tasks.copy()
+    tasks['mem_gb'] = (mem_base_gb + mem_f  * tasks.ws_gb)   * safety
+    tasks['wall_s'] = (wall_base_s + wall_f * tasks.year_gb) * safety
+
+    if len(telemetry) > 0:   # measured tasks: their own max
+        own = telemetry.groupby(['model', 'scenario', 'year'])[['peak_rss_mb', 'wall_s']].max().reset_index()
+        tasks = tasks.merge(own.rename(columns={'wall_s': 'wall_meas'}), on=['model', 'scenario', 'year'], how='left')
+        has = tasks.peak_rss_mb.notna()
+        tasks.loc[has, 'mem_gb'] = tasks.peak_rss_mb[has]/1024 * safety
+        tasks.loc[has, 'wall_s'] = tasks.wall_meas[has] * safety
+        tasks = tasks.drop(columns=['peak_rss_mb', 'wall_meas'])
+    return tasks
+
+
+##############################################################################################
+#      pack                                                                                   #
+##############################################################################################
+def mem_class(mem_gb):
+    """ smallest of mem_steps >= mem_gb"""
+    for m in mem_steps:
+        if mem_gb <= m: return m
+    print(f"   ! task needs {np.round(mem_gb)} GB, more than the largest mem_step {mem_steps[-1]} GB")
+    return int(np.ceil(mem_gb))
+
+
+def pack(tasks, max_wall_s):
+    """ {mem class: [[task index, ..], ..]}: first fit decreasing of the tasks of a class into
+        array elements of at most max_wall_s (tasks longer than max_wall_s get their own element)"""
+    tasks   = tasks.assign(mem_class=[mem_class(m) for m in tasks.mem_gb])
+    classes = {}
+    for mc, g in tasks.groupby('mem_class'):
+        bins, load = [], []
+        for i, w in g.wall_s.sort_values(ascending=False).items():
+            fit = [b for b in range(len(bins)) if load[b] + w <= max_wall_s]
+            if fit:
+                b = min(fit, key=lambda b: max_wall_s - load[b] - w)   # best fit: least space left
+                bins[b].append(i); load[b] += w
+            else:
+                bins.append([i]); load.append(w)
+        classes[mc] = (bins, load)
+    return tasks, classes
+
+
+##############################################################################################
+#      write job scripts                                                                      #
+##############################################################################################
+def driver_command(args):
+    """ the python call of one task (model, scen, year as shell variables), as in the submit scripts"""
+    if args.layout=='1h':
+        script = 'main_24hr.py' if args.dt=='daily' else 'main_3hr.py'
+        return f"python -u {script} {args.path_in} {args.path_out} $year $model $scen {args.remove_cp} {args.GCM_cp_path}"
+    if args.dt=='daily':
+        return f"python -u main_24hr_from3hinput.py {args.path_in} {args.path_day_in} {args.path_out} $year $model $scen {args.remove_cp} {args.GCM_cp_path}"
+    script = 'main_3hr_24hr_from3hinput.py' if args.dt=='both' else 'main_3hr_from3hinput.py'
+    return f"python -u {script} {args.path_in} {args.path_out} $year $model $scen {args.remove_cp} {args.GCM_cp_path} {args.CMIP}"
+
+
+def hhmmss(seconds):
+    seconds = int(np.ceil(seconds/600)*600)   # round up to 10 min
+    return f"{seconds//3600:02d}:{(seconds%3600)//60:02d}:00"
+
+
+def write_plan(tasks, classes, args):
+    """ task list + PBS / SLURM array script per memory class"""
+    os.makedirs(args.plan_dir, exist_ok=True)
+    os.makedirs(f"{args.plan_dir}/job_output", exist_ok=True)
+    cmd = driver_command(args)
+    for mc, (bins, load) in classes.items():
+        name       = f"{args.dt}_mem{mc}GB"
+        file_tasks = os.path.abspath(f"{args.plan_dir}/tasks_{name}.txt")
+        with open(file_tasks, 'w') as f:   # one array element per line: model,scen,year model,scen,year ...
+            for b in bins:
+                f.write( ' '.join(f"{tasks.model[i]},{tasks.scenario[i]},{tasks.year[i]}" for i in b) + '\n' )
+
+        wall = hhmmss(max(load))
+        n    = len(bins)
+        run  = f'''
+cd {os.path.dirname(os.path.abspath(__file__))}
+mkdir -p job_output_plan
+
+# ____________  tasks of this array element: ______________
+for task in $(sed -n "$((IDX+1))p" {file_tasks}); do
+    IFS=, read model scen year <<< "$task"
+    echo "Launching {args.dt} for $model $scen $year"
+    mkdir -p job_output_plan/${{model}}_${{scen}}
+    {cmd} >& job_output_plan/${{model}}_${{scen}}/${{year}}_{args.dt}
+done
+'''
+        with open(f"{args.plan_dir}/pbs_{name}.sh", 'w') as f:
+            f.write(f'''#!/bin/bash
+#PBS -l select=1:ncpus=1:mem={mc}GB
+#PBS -l walltime={wall}
+#PBS -A {args.account}
+#PBS -q {args.queue}
+#PBS -N PP_{name}
+#PBS -J 0-{max(n-1, 1)}
+#PBS -o {os.path.abspath(args.plan_dir)}/job_output/pbs_{name}.out
+#PBS -j oe
+#PBS -r y
+
+# generated by plan_jobs.py: {sum(len(b) for b in bins)} tasks in {n} array elements
+module load conda
+conda activate npl
+
+IDX=$PBS_ARRAY_INDEX
+''' + run)
+        with open(f"{args.plan_dir}/slurm_{name}.sh", 'w') as f:
+            f.write(f'''#!/bin/bash
+#SBATCH --job-name="PP_{name}"
+#SBATCH --qos={args.queue}
+#SBATCH --nodes=1
+#SBATCH --mem={mc}G
+#SBATCH --time={wall}
+#SBATCH --array=0-{n-1}
+#SBATCH --account={args.account}
+#SBATCH --output={os.path.abspath(args.plan_dir)}/job_output/slurm_{name}_%a.out
+
+# generated by plan_jobs.py: {sum(len(b) for b in bins)} tasks in {n} array elements
+conda activate myenv
+
+IDX=$SLURM_ARRAY_TASK_ID
+''' + run)
+        print(f"   {name}: {sum(len(b) for b in bins):>4} tasks in {n:>4} array elements, walltime {wall}")
+
+
+###########################
+#     MAIN
+###########################
+if __name__=="__main__":
+
+    args = process_command_line()
+
+    tasks = enumerate_tasks(args.path_in, layout=args.layout, CMIP=args.CMIP, models=args.models, scenarios=args.scenarios)
+    if len(tasks)==0:
+        sys.exit(f"   no tasks found in {args.path_in} (layout {args.layout})")
+    print(f"   {len(tasks)} tasks, {tasks.model.nunique()} models, {tasks.scenario.nunique()} scenarios")
+
+    tasks = add_sizes(tasks, args.dt)
+    tasks = predict(tasks, read_telemetry(args.telemetry, args.dt), args.dt)
+    tasks, classes = pack(tasks, args.max_walltime_h*3600)
+
+    write_plan(tasks, classes, args)
+    tasks.to_csv(f"{args.plan_dir}/tasks_{args.dt}.csv", index=False)
+    print(f"   requested {np.round((tasks.mem_class*tasks.wall_s).sum()/3600)} GB-hours "
+          f"(predicted need {np.round((tasks.mem_gb*tasks.wall_s).sum()/3600)} GB-hours)")
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# coding: utf-8
+######################################################################################################
+#
+# dtype policy for the postprocessing:
+#    - all data variables stay float32 from input to output (no float64 intermediates)
+#    - sums over time (3hr / daily precip) accumulate in float64 inside each dask block (one vectorized
+#      reduce per block, windows never split over blocks) and return float32, so the output does not
+#      lose accuracy compared to the float64 sums we used to do, without float64 copies of the input
+#    - compensated (Neumaier/Kahan) summation in float32 for the numpy sums (tiled_correction)
+#    - validation mode (validate=True) repeats every sum in float64 and prints the max error
+#
+# Usage:
+#   - imported by fix_neg_pcp, aggregate_in_time, remove_cp and stream_aggregate
+#
+######################################################################################################
+
+import xarray as xr
+import numpy as np
+import dask.array
+
+import time_axis
+
+
+# dtype per variable ('default' for all others):
+dtype_policy = {'default': 'float32'}
+
+# repeat sums in float64 and report the max difference (costs an extra (float64) sum!)
+validate = False
+
+
+def policy_dtype(varname):
+    """ dtype that varname should have according to dtype_policy"""
+    return dtype_policy.get(varname, dtype_policy['default'])
+
+
+def apply_policy(da, varname=None):
+    """ cast a (floating point) DataArray to the dtype of the policy, lazily"""
+    varname = da.name if varname is None else varname
+    if not np.issubdtype(da.dtype, np.floating):
+        return da
+    dtype = policy_dtype(varname)
+    return da if da.dtype==dtype else da.astype(dtype)
+
+
+##############################################################################################
+#      compensated summation                                                                  #
+##############################################################################################
+def kahan_add(s, c, x):
+    """ one Neumaier step: add x to the running sum s with compensation c. Returns (s, c).
+        Works on numpy and dask arrays; NaNs in x propagate (as in a plain sum)."""
+    t = s + x
+    c = c + np.where( np.abs(s) >= np.abs(x), (s - t) + x, (x - t) + s )
+    return t, c
+
+
+def compensated_sum(x, axis=0, skipna=True, **kwargs):
+    """ compensated sum of x along axis, in the dtype of x (numpy or dask array).
+        skipna: NaNs count as 0 (as xarray's sum), else they propagate (kahan_add)."""
+    if isinstance(axis, (tuple, list)):
+        axis = axis[0]
+    n = x.shape[axis]
+    idx = [slice(None)] * x.ndim
+
+    idx[axis] = 0
+    s = x[tuple(idx)]
+    if skipna: s = np.where(np.isnan(s), 0, s).astype(x.dtype)
+    c = np.zeros_like(s)
+    for i in range(1, n):
+        idx[axis] = i
+        xi = x[tuple(idx)]
+        if skipna: xi = np.where(np.isnan(xi), 0, xi).astype(x.dtype)
+        s, c = kahan_add(s, c, xi)
+    return (s + c).astype(x.dtype)
+
+
+def window_sum(x, codes, axis=0, dtype='float32'):
+    """ sums of x (numpy) over the runs of equal codes along axis, accumulated in float64, NaNs as 0"""
+    starts = np.flatnonzero(np.r_[True, np.diff(codes)!=0])
+    x64    = np.where(np.isnan(x), 0, x).astype('float64')
+    return np.add.reduceat(x64, starts, axis=axis).astype(dtype)
+
+
+def resample_sum(da, freq_hours, name=None):
+    """ da.resample(time=freq_hours).sum() (NaNs as 0, empty windows NaN) in the policy dtype, accumulated
+        in float64 per block: time chunks are aligned to the windows and every block is summed with
+        one reduceat (map_blocks). Windows from the integer time axis (any calendar)"""
+    name    = da.name if name is None else name
+    dtype   = policy_dtype(name)
+    axis    = da.get_axis_num('time')
+    t_axis  = time_axis.TimeAxis.from_dataarray(da.time)
+    windows = t_axis.window_index(freq_hours)                                         # window of every timestep
+    labels  = t_axis.window_starts(freq_hours)                                        # all window starts
+    codes   = np.searchsorted(labels, windows)
+    first   = np.flatnonzero(np.r_[True, np.diff(codes)!=0])                         # first timestep of every window
+
+    if isinstance(da.data, dask.array.Array):
+        # move the chunk boundaries along time to the start of their window
+        bounds = np.cumsum(da.data.chunks[axis])[:-1]
+        bounds = np.unique(first[np.searchsorted(first, bounds, side='right') - 1])
+        bounds = np.r_[0, bounds[bounds > 0], len(windows)]
+        data   = da.data.rechunk({axis: tuple(np.diff(bounds))})
+        block_codes = [codes[b0:b1] for b0, b1 in zip(bounds[:-1], bounds[1:])]
+        chunks = list(data.chunks)
+        chunks[axis] = tuple(len(np.unique(c)) for c in block_codes)
+        summed = data.map_blocks(lambda x, block_id=None: window_sum(x, block_codes[block_id[axis]], axis, dtype),
+                                 chunks=tuple(chunks), dtype=dtype)
+    else:
+        summed = window_sum(da.values, codes, axis, dtype)
+
+    coords = {c: da[c] for c in da.coords if 'time' not in da[c].dims}
+    coords['time'] = time_axis.TimeAxis(windows[first], t_axis.calendar).decode()
+    out = xr.DataArray(summed, dims=da.dims, coords=coords, name=da.name)
+    if len(first) < len(labels):   # windows without timesteps: NaN (as resample().sum())
+        out = out.reindex(time=time_axis.TimeAxis(labels, t_axis.calendar).decode())
+
+    if validate:
+        ref = da.astype('float64').assign_coords(window=('time', windows)).groupby('window').sum()
+        ref = ref.reindex(window=labels).rename(window='time').transpose(*da.dims)
+        report_error(name, out, ref)
+
+    return out
+
+
+##############################################################################################
+#      validation                                                                             #
+##############################################################################################
+def report_error(name, result, reference):
+    """ print the max absolute (and relative) error of result compared to a float64 reference"""
+    result    = np.asarray(result, dtype='float64')
+    reference = np.asarray(reference, dtype='float64')
+    abs_err   = np.nanmax(np.abs(result - reference)) if result.size>0 else 0.
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rel_err = np.nanmax( np.abs(result - reference) / np.abs(reference) ) if result.size>0 else 0.
+    print(f"   precision check {name}: max abs error {abs_err:.3g}, max rel error {rel_err:.3g} (vs float64)")
+    return abs_err
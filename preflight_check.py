@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# coding: utf-8
+######################################################################################################
+#
+# Pre-flight integrity scan of the ICAR input files, before the (array) jobs start:
+#    - opens every file's header in parallel (multiprocessing) and reads data blocks, so a corrupt
+#      HDF5 chunk fails here and not after a job already spent minutes on the earlier months
+#    - mode 'header' only opens the files, 'sampled' reads the first, last and n_sample random
+#      chunk slabs (along time) of every variable, 'full' reads (decompresses) everything
+#    - the bad files are written to a quarantine list (path <tab> error), which the main_*.py
+#      drivers read (quarantine_file) to skip those months (3hr) / years (24hr) up front
+#    - rescanning the same quarantine list keeps the entries of files that were not scanned again
+#
+# Usage:
+#   python preflight_check.py "path_in/MODEL_ssp245_2004/icar_*.nc" [more globs] --quarantine quarantine.txt
+#                             [--mode sampled|header|full] [--n_sample 3] [--nproc 8]
+#
+######################################################################################################
+
+import argparse
+import netCDF4 as nc
+import numpy as np
+import multiprocessing as mp
+import glob
+import zlib
+import time
+import os
+
+
+def process_command_line():
+    '''Parse the commandline'''
+    parser = argparse.ArgumentParser(description='scan input files for unreadable headers / data and write a quarantine list')
+    parser.add_argument('files',        nargs='+',         help='file globs (quoted)')
+    parser.add_argument('--quarantine', required=True,     help='quarantine list to write')
+    parser.add_argument('--mode',       default='sampled', help="'header', 'sampled' or 'full'")
+    parser.add_argument('--n_sample',   default=3, type=int, help='random slabs per variable in sampled mode')
+    parser.add_argument('--nproc',      default=None, type=int, help='processes (default: all cpus)')
+
+    return parser.parse_args()
+
+
+##############################################################################################
+#      scan                                                                                   #
+##############################################################################################
+def _slabs(var, mode, n_sample, rng):
+    """ slices along the first dimension, one per chunk (the whole variable for contiguous vars)"""
+    n = var.shape[0]
+    chunking = var.chunking()
+    step = n if chunking=='contiguous' or chunking is None else max(chunking[0], 1)
+    starts = np.arange(0, n, step)
+    if mode=='sampled' and len(starts) > n_sample+2:
+        starts = np.unique(np.concatenate([starts[[0, -1]], rng.choice(starts[1:-1], n_sample, replace=False)]))
+    return [slice(int(s), int(min(s+step, n))) for s in starts]
+
+
+def scan_file(file, mode='sampled', n_sample=3):
+    """ (file, error or None): open the file and read its data blocks"""
+    rng = np.random.default_rng(zlib.crc32(os.path.basename(file).encode()))   # same sample on a rescan
+    try:
+        with nc.Dataset(file) as ds:
+            if 'time' not in ds.dimensions:
+                return file, "no time dimension"
+            if mode=='header':
+                return file, None
+            for name, var in ds.variables.items():
+                if var.ndim==0 or var.size==0:
+                    var[...]
+                    continue
+                for s in _slabs(var, mode, n_sample, rng):
+                    var[s]
+    except Exception as e:   # OSError / RuntimeError (HDF error) / ValueError / ...
+        return file, f"{type(e).__name__}: {str(e).splitlines()[0] if str(e) else ''}"
+    return file, None
+
+
+def _scan(args):
+    return scan_file(*args)
+
+
+def scan(files, mode='sampled', n_sample=3, nproc=None):
+    """ {file: error} of the bad files"""
+    bad = {}
+    with mp.Pool(nproc) as pool:
+        for i, (file, err) in enumerate(pool.imap_unordered(_scan, [(f, mode, n_sample) for f in files], chunksize=4)):
+            if err is not None:
+                bad[file] = err
+                print(f"   ! {file}: {err}")
+            if (i+1) % 500 == 0:
+                print(f"   scanned {i+1} of {len(files)} files, {len(bad)} bad")
+    return bad
+
+
+##############################################################################################
+#      quarantine list                                                                        #
+##############################################################################################
+def read_quarantine(file_in):
+    """ {abs path: error} of the quarantined files ({} if file_in is None / does not exist)"""
+    if file_in is None or not os.path.exists(file_in):
+        return {}
+    quarantine = {}
+    with open(file_in) as f:
+        for line in f:
+            if line.strip()=='' or line.startswith('#'): continue
+            path, _, err = line.rstrip('\n').partition('\t')
+            quarantine[os.path.abspath(path)] = err
+    return quarantine
+
+
+def write_quarantine(file_out, bad, scanned):
+    """ write the bad files, keeping the old entries of files that were not scanned now"""
+    scanned    = set(os.path.abspath(f) for f in scanned)
+    quarantine = {f: e for f, e in read_quarantine(file_out).items() if f not in scanned}
+    quarantine.update({os.path.abspath(f): e for f, e in bad.items()})
+    tmp = f"{file_out}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as f:
+        f.write(f"# preflight_check.py {time.strftime('%Y/%m/%d %H:%M:%S')}: {len(quarantine)} files\n")
+        for path in sorted(quarantine):
+            f.write(f"{path}\t{quarantine[path]}\n")
+    os.replace(tmp, file_out)
+    return quarantine
+
+
+def quarantined(quarantine, files):
+    """ the files (a glob or list, None entries ignored) that are in the quarantine list"""
+    if isinstance(files, str):
+        files = glob.glob(files)
+    return [f for f in files if f is not None and os.path.abspath(f) in quarantine]
+
+
+###########################
+#     MAIN
+###########################
+if __name__=="__main__":
+
+    args = process_command_line()
+    t0   = time.time()
+
+    files = sorted(set(f for g in args.files for f in glob.glob(g)))
+    print(f"   scanning {len(files)} files ({args.mode})")
+
+    bad        = scan(files, args.mode, args.n_sample, args.nproc)
+    quarantine = write_quarantine(args.quarantine, bad, files)
+
+    print(f"   {len(bad)} of {len(files)} files bad, {len(quarantine)} in {args.quarantine}. "
+          f"Took {np.round(time.time()-t0,1)} sec")
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# coding: utf-8
+######################################################################################################
+#
+# Opt-in dask profiling of the driver stages (profile_dir in the main_*.py drivers):
+#    - per (top level) stage of the instrument.py run log: the dask task stream (dask.diagnostics
+#      Profiler: every task with its start / end and worker thread) and a resource profile (process
+#      cpu % and RSS, sampled by a thread every sample_dt sec; no psutil / distributed needed)
+#    - works with the local threaded scheduler (the default of the drivers)
+#    - written at the end of the run to profile_dir/{model}_{scenario}_{year}_{dt}:
+#        .trace.json   Chrome trace (open in https://ui.perfetto.dev or chrome://tracing): stages,
+#                      one track per worker thread, cpu % and RSS counters
+#        .html         self-contained report: per stage the task time vs wall time (parallelism),
+#                      mean cpu %, the longest task, the task groups (key prefix) and a task stream plot
+#    - how to read it: parallelism ~ nr of threads but cpu ~ 100% -> GIL bound; tasks busy but low
+#      cpu -> waiting on I/O (or locks, e.g. the netcdf write lock); one task covering most of the
+#      stage -> a single giant task (rechunk); wall >> task time -> work outside dask (numpy / eager)
+#
+# Usage:
+#   set profile_dir in the main_*.py drivers (with the run log of instrument.py)
+#   python profiling.py profile_dir/MODEL_ssp245_2049_2051_3hr.trace.json   (summary of a trace)
+#
+######################################################################################################
+
+import argparse
+import numpy as np
+import contextlib
+import threading
+import timeit
+import resource
+import html
+import json
+import time
+import os
+
+from dask.diagnostics import Profiler
+from dask.utils import key_split
+
+
+sample_dt      = 0.2     # sec between resource samples
+max_svg_tasks  = 20000   # longest tasks drawn in the html task stream (all are in the trace)
+
+
+def process_command_line():
+    '''Parse the commandline'''
+    parser = argparse.ArgumentParser(description='summary of a profile trace written by profiling.py')
+    parser.add_argument('trace', help='.trace.json file')
+
+    return parser.parse_args()
+
+
+def _rss_mb():
+    """ current RSS of the process (MB)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 1024**2
+    except OSError:
+        return np.nan
+
+
+class _ResourceSampler(threading.Thread):
+    """ samples (time, cpu %, rss MB) of the process until stopped"""
+
+    def __init__(self, dt=sample_dt):
+        super().__init__(daemon=True)
+        self.dt      = dt
+        self.samples = []
+        self._done   = threading.Event()
+
+    def run(self):
+        ru = resource.getrusage(resource.RUSAGE_SELF)
+        t_prev, cpu_prev = time.time(), ru.ru_utime + ru.ru_stime
+        while not self._done.wait(self.dt):
+            ru  = resource.getrusage(resource.RUSAGE_SELF)
+            t, cpu = time.time(), ru.ru_utime + ru.ru_stime
+            self.samples.append( (t, 100 * (cpu - cpu_prev) / max(t - t_prev, 1e-6), _rss_mb()) )
+            t_prev, cpu_prev = t, cpu
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        return self.samples
+
+
+class RunProfile:
+    """ dask task stream + resource profile of the stages of one run """
+
+    def __init__(self, profile_dir, name):
+        os.makedirs(profile_dir, exist_ok=True)
+        self.prefix    = f"{profile_dir}/{name.replace('/', '-')}"
+        self.name      = name
+        self.t0        = time.time()
+        self.stages    = []   # dicts: name, tags, start, end
+        self.tasks     = []   # (stage index, group (key prefix), key, start, end, worker)
+        self.resources = []   # (time, cpu %, rss MB)
+
+    @contextlib.contextmanager
+    def stage(self, name, **tags):
+        """ capture the dask tasks and resources of the block"""
+        sampler = _ResourceSampler()
+        sampler.start()
+        start  = time.time()
+        offset = start - timeit.default_timer()   # the Profiler stamps the tasks with timeit.default_timer (perf_counter)
+        try:
+            with Profiler() as prof:
+                yield self
+        finally:
+            end = time.time()
+            self.resources += sampler.stop()
+            i = len(self.stages)
+            self.stages.append( {'name': name, 'tags': tags, 'start': start, 'end': end} )
+            self.tasks += [ (i, key_split(t.key), str(t.key), t.start_time + offset, t.end_time + offset, t.worker_id) for t in prof.results ]
+
+    # ________ summaries ________
+    def stage_summary(self):
+        """ per stage: wall, nr of tasks, task time, parallelism, mean cpu %, peak rss, longest task"""
+        res  = np.array(self.resources).reshape(-1, 3)
+        rows = []
+        for i, st in enumerate(self.stages):
+            tasks = [t for t in self.tasks if t[0]==i]
+            wall  = st['end'] - st['start']
+            dur   = np.array([t[4] - t[3] for t in tasks])
+            in_st = (res[:, 0] >= st['start']) & (res[:, 0] <= st['end'])
+            longest = tasks[int(np.argmax(dur))] if len(tasks) > 0 else None
+            rows.append( {'stage'       : st['name'],
+                          **st['tags'],
+                          'wall_s'      : wall,
+                          'n_tasks'     : len(tasks),
+                          'task_s'      : dur.sum(),
+                          'parallelism' : dur.sum() / max(wall, 1e-6),
+                          'threads'     : len(set(t[5] for t in tasks)),
+                          'cpu_pct'     : res[in_st, 1].mean() if in_st.any() else np.nan,
+                          'peak_rss_mb' : res[in_st, 2].max() if in_st.any() else np.nan,
+                          'longest_s'   : dur.max() if len(tasks) > 0 else 0.,
+                          'longest_task': longest[1] if longest else '' } )
+        return rows
+
+    def task_groups(self):
+        """ per stage and task group (key prefix): count, total, mean and max duration"""
+        groups = {}
+        for i, group, key, start, end, worker in self.tasks:
+            g = groups.setdefault( (self.stages[i]['name'], group), [] )
+            g.append(end - start)
+        return [ {'stage': s, 'group': k, 'n': len(d), 'total_s': np.sum(d), 'mean_s': np.mean(d), 'max_s': np.max(d)}
+                 for (s, k), d in sorted(groups.items(), key=lambda x: -np.sum(x[1])) ]
+
+    # ________ output ________
+    def trace_events(self):
+        """ Chrome trace events (µs since the start of the run)"""
+        us = lambda t: (t - self.t0) * 1e6
+        workers = {w: j for j, w in enumerate(sorted(set(t[5] for t in self.tasks)))}
+        events  = [ {'ph': 'M', 'name': 'process_name', 'pid': 0, 'args': {'name': 'stages'}},
+                    {'ph': 'M', 'name': 'process_name', 'pid': 1, 'args': {'name': 'dask tasks'}},
+                    {'ph': 'M', 'name': 'process_name', 'pid': 2, 'args': {'name': 'resources'}} ]
+        events += [ {'ph': 'M', 'name': 'thread_name', 'pid': 1, 'tid': j, 'args': {'name': f"worker {j}"}}
+                    for w, j in workers.items() ]
+        for st in self.stages:
+            events.append( {'ph': 'X', 'cat': 'stage', 'name': st['name'], 'pid': 0, 'tid': 0,
+                            'ts': us(st['start']), 'dur': (st['end'] - st['start']) * 1e6, 'args': st['tags']} )
+        for i, group, key, start, end, worker in self.tasks:
+            events.append( {'ph': 'X', 'cat': self.stages[i]['name'], 'name': group, 'pid': 1,
+                            'tid': workers[worker], 'ts': us(start), 'dur': (end - start) * 1e6, 'args': {'key': key}} )
+        for t, cpu, rss in self.resources:
+            events.append( {'ph': 'C', 'name': 'cpu %', 'pid': 2, 'ts': us(t), 'args': {'cpu': round(cpu, 1)}} )
+            events.append( {'ph': 'C', 'name': 'rss MB', 'pid': 2, 'ts': us(t), 'args': {'rss': round(rss, 1)}} )
+        return events
+
+    def write(self):
+        """ write the trace json and the html report, returns their paths"""
+        with open(f"{self.prefix}.trace.json", 'w') as f:
+            stages = [ {k: (None if isinstance(v, float) and np.isnan(v) else v) for k, v in st.items()}
+                       for st in self.stage_summary() ]   # no NaN in the json
+            json.dump({'traceEvents': self.trace_events(), 'displayTimeUnit': 'ms',
+                       'otherData': {'run': self.name, 'stages': stages}}, f, default=float)
+        with open(f"{self.prefix}.html", 'w') as f:
+            f.write(self.html())
+        print(f"   profile written to {self.prefix}.trace.json / .html")
+        return f"{self.prefix}.trace.json", f"{self.prefix}.html"
+
+    def html(self):
+        """ self-contained html report: stage and task group tables, task stream + resources plot"""
+        def table(rows, fmt='{:.2f}'):
+            if len(rows)==0:
+                return '<p>no dask tasks</p>'
+            cols = list(dict.fromkeys(k for r in rows for k in r))
+            head = ''.join(f"<th>{html.escape(str(c))}</th>" for c in cols)
+            body = ''.join( '<tr>' + ''.join( f"<td>{fmt.format(r[c]) if isinstance(r.get(c), (float, np.floating)) else html.escape(str(r.get(c, '')))}</td>"
+                                              for c in cols) + '</tr>' for r in rows )
+            return f"<table><tr>{head}</tr>{body}</table>"
+
+        return ( f"<!DOCTYPE html><html><head><meta charset='utf-8'><title>{html.escape(self.name)}</title>"
+                 "<style>body{font-family:sans-serif;font-size:13px} table{border-collapse:collapse;margin-bottom:20px}"
+                 "td,th{border:1px solid #ccc;padding:2px 6px;text-align:right} th{background:#eee}</style></head><body>"
+                 f"<h2>profile {html.escape(self.name)}</h2>"
+                 f"<h3>stages</h3>{table(self.stage_summary())}"
+                 f"<h3>task stream</h3>{self._svg()}"
+                 f"<h3>task groups</h3>{table(self.task_groups()[:100], '{:.3f}')}"
+                 "</body></html>" )
+
+    def _svg(self, width=1400, row_h=12):
+        """ stages, tasks per worker thread (colored by group, longest max_svg_tasks) and cpu / rss lines"""
+        if len(self.stages)==0:
+            return ''
+        t_end   = max(st['end'] for st in self.stages)
+        x       = lambda t: 60 + (t - self.t0) / max(t_end - self.t0, 1e-6) * (width - 70)
+        color   = lambda s: f"hsl({sum(map(ord, s)) * 47 % 360},60%,55%)"
+        workers = {w: j for j, w in enumerate(sorted(set(t[5] for t in self.tasks)))}
+        y_tasks = 2 * row_h
+        y_res   = y_tasks + (len(workers) + 1) * row_h
+        height  = y_res + 80
+        parts   = [f"<svg width='{width}' height='{height}' xmlns='http://www.w3.org/2000/svg' font-size='10'>"]
+        for st in self.stages:
+            label = html.escape(f"{st['name']} {st['tags']} {st['end']-st['start']:.1f} s")
+            parts.append( f"<rect x='{x(st['start']):.1f}' y='0' width='{max(x(st['end'])-x(st['start']),0.5):.1f}' height='{row_h}' "
+                          f"fill='{color(st['name'])}' stroke='white'><title>{label}</title></rect>" )
+        parts.append(f"<text x='0' y='{row_h-2}'>stages</text>")
+        tasks = sorted(self.tasks, key=lambda t: t[3] - t[4])[:max_svg_tasks]
+        for i, group, key, start, end, worker in tasks:
+            y = y_tasks + workers[worker] * row_h
+            parts.append( f"<rect x='{x(start):.1f}' y='{y}' width='{max(x(end)-x(start),0.3):.1f}' height='{row_h-1}' "
+                          f"fill='{color(group)}'><title>{html.escape(group)} {end-start:.3f} s</title></rect>" )
+        for w, j in workers.items():
+            parts.append(f"<text x='0' y='{y_tasks + j*row_h + row_h - 2}'>worker {j}</text>")
+        if len(self.resources) > 1:
+            res = np.array(self.resources)
+            for col, name, c in [(1, 'cpu %', 'red'), (2, 'rss MB', 'blue')]:
+                top = max(np.nanmax(res[:, col]), 1e-6)
+                pts = ' '.join(f"{x(t):.1f},{y_res + 70 - v/top*65:.1f}" for t, v in zip(res[:, 0], res[:, col]) if np.isfinite(v))
+                parts.append(f"<polyline points='{pts}' fill='none' stroke='{c}'/>")
+                parts.append(f"<text x='0' y='{y_res + (15 if col==1 else 30)}' fill='{c}'>{name} (max {top:.0f})</text>")
+        parts.append('</svg>')
+        return ''.join(parts)
+
+
+###########################
+#     MAIN
+###########################
+if __name__=="__main__":
+
+    args = process_command_line()
+    with open(args.trace) as f:
+        trace = json.load(f)
+    print(f"   {trace['otherData']['run']}:")
+    for st in trace['otherData']['stages']:
+        print( f"   {st['stage']:<10} {str({k: v for k, v in st.items() if k in ['month']}):<14} "
+               f"wall {st['wall_s']:8.1f} s   tasks {st['n_tasks']:6d}   parallelism {st['parallelism']:5.2f}   "
+               f"cpu {st['cpu_pct'] or np.nan:6.1f} %   longest {st['longest_s']:6.1f} s ({st['longest_task']})" )
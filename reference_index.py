@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# coding: utf-8
+######################################################################################################
+#
+# Reference index (kerchunk) of the ICAR output files of a model/scenario directory:
+#    - maps every variable chunk to its byte range in the source netcdf (HDF5) files, so a month /
+#      year opens as one virtual (zarr) dataset without parsing the HDF5 metadata of every file
+#    - the references of every file are cached as json (reference_dir/<index>/refs/<file>.json);
+#      an update only translates the new / changed (size, mtime) files, then combines all of them
+#      along time (MultiZarrToZarr) into reference_dir/<index>.json; the combined index is rebuilt when
+#      files were added, changed or removed, and records its files (<index>/combined.json), so a stale
+#      index is never used with a newer manifest
+#    - icar_io.open_icar uses the index when icar_io.reference_dir is set (reference_dir in the
+#      main_*.py drivers) and all requested files are in the index unchanged, else it opens the files
+#    - requires kerchunk (+ h5py, zarr, fsspec): pip install kerchunk h5py
+#
+# Usage:
+#   python reference_index.py reference_dir "path_in/MODEL_ssp245_2004/icar_*.nc" [--nproc 8]
+#      (rerun to add new files; one index per directory)
+#
+######################################################################################################
+
+import argparse
+import xarray as xr
+import numpy as np
+import multiprocessing as mp
+import json
+import glob
+import time
+import os
+
+try:
+    import kerchunk.hdf
+    import kerchunk.combine
+except ImportError:
+    kerchunk = None
+
+inline_threshold = 300   # bytes, smaller chunks (e.g. time of a day file) are stored in the json
+
+
+def process_command_line():
+    '''Parse the commandline'''
+    parser = argparse.ArgumentParser(description='build / update the reference index of a directory of ICAR files')
+    parser.add_argument('reference_dir',          help='directory for the indexes')
+    parser.add_argument('files',                  help='file glob (quoted), all files in one directory')
+    parser.add_argument('--nproc', default=None, type=int, help='processes for the translation of new files')
+
+    return parser.parse_args()
+
+
+def index_name(directory):
+    """ name of the index of a directory (its absolute path, / -> __)"""
+    return os.path.abspath(directory).strip('/').replace('/', '__')
+
+
+def _stat(f):
+    st = os.stat(f)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _write_json(file_out, obj):
+    tmp = f"{file_out}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp, file_out)
+
+
+def _read_json(file_in, default=None):
+    if not os.path.exists(file_in):
+        return default
+    with open(file_in) as f:
+        return json.load(f)
+
+
+##############################################################################################
+#      build                                                                                  #
+##############################################################################################
+def _translate(args):
+    """ references of one file, written to ref_file; returns the nr of timesteps"""
+    file_in, ref_file = args
+    refs = kerchunk.hdf.SingleHdf5ToZarr(file_in, inline_threshold=inline_threshold).translate()
+    _write_json(ref_file, refs)
+    return json.loads(refs['refs']['time/.zarray'])['shape'][0]
+
+
+def build_index(reference_dir, files, nproc=None):
+    """ add the new / changed files to the index of their directory and rebuild the combined references.
+        Returns the path of the combined index."""
+    if kerchunk is None:
+        raise ImportError("reference_index requires kerchunk (and h5py): pip install kerchunk h5py")
+    files = sorted(os.path.abspath(f) for f in files)
+    dirs  = set(os.path.dirname(f) for f in files)
+    if len(dirs) != 1:
+        raise ValueError(f"files of one directory per index, got {dirs}")
+    directory = dirs.pop()
+    name      = index_name(directory)
+    os.makedirs(f"{reference_dir}/{name}/refs", exist_ok=True)
+
+    manifest_file = f"{reference_dir}/{name}/manifest.json"
+    manifest = _read_json(manifest_file, default={})
+    # drop removed files:
+    removed  = [b for b in manifest if not os.path.exists(f"{directory}/{b}")]
+    manifest = {b: e for b, e in manifest.items() if b not in removed}
+
+    todo = [f for f in files if manifest.get(os.path.basename(f), {}).get('stat') != _stat(f)]
+    t0 = time.time()
+    if len(todo) > 0:
+        with mp.Pool(nproc) as pool:
+            n_times = pool.map(_translate, [(f, f"{reference_dir}/{name}/refs/{os.path.basename(f)}.json") for f in todo])
+        for f, n in zip(todo, n_times):
+            manifest[os.path.basename(f)] = {'stat': _stat(f), 'n_time': n}
+    print(f"   translated {len(todo)} new / changed files in {np.round(time.time()-t0,1)} sec, {len(removed)} removed, {len(manifest)} files in the index")
+
+    index_file    = f"{reference_dir}/{name}.json"
+    combined_file = f"{reference_dir}/{name}/combined.json"
+    if len(todo) > 0 or _read_json(combined_file) != sorted(manifest) or not os.path.exists(index_file):
+        t0   = time.time()
+        refs = [f"{reference_dir}/{name}/refs/{b}.json" for b in sorted(manifest)]
+        first = _read_json(refs[0])['refs']
+        # variables without time (lat, lon, hgt, ...) are taken from the first file:
+        identical = [k.split('/')[0] for k, v in first.items() if k.endswith('/.zattrs')
+                     and 'time' not in json.loads(v).get('_ARRAY_DIMENSIONS', ['time'])]
+        combined = kerchunk.combine.MultiZarrToZarr( refs,
+                                                     remote_protocol = 'file',
+                                                     concat_dims     = ['time'],
+                                                     identical_dims  = identical,
+                                                     coo_map         = {'time': 'cf:time'}
+                                                     ).translate()
+        _write_json(index_file, combined)
+        _write_json(combined_file, sorted(manifest))   # the files (and order) of the combined index
+        print(f"   combined {len(refs)} files into {index_file} in {np.round(time.time()-t0,1)} sec")
+    # written last: open_files only trusts files that are in the manifest
+    _write_json(manifest_file, manifest)
+    return index_file
+
+
+##############################################################################################
+#      open                                                                                   #
+##############################################################################################
+def open_index(index_file, chunks={}):
+    """ lazy dataset of all files in the index. chunks={}: the on-disk chunks"""
+    return xr.open_dataset( "reference://", engine='zarr', chunks=chunks,
+                            backend_kwargs={'consolidated'   : False,
+                                            'storage_options': {'fo': index_file, 'remote_protocol': 'file'}} )
+
+
+def open_files(reference_dir, files, chunks={}):
+    """ the files (sorted, consecutive, one directory) as a time slice of the index, or None if they are
+        not all in the index (unchanged). chunks['time']=-1 means one chunk per file"""
+    if kerchunk is None:
+        return None
+    files = sorted(os.path.abspath(f) for f in files)
+    directory = os.path.dirname(files[0])
+    name      = index_name(directory)
+    manifest  = _read_json(f"{reference_dir}/{name}/manifest.json")
+    if manifest is None or not os.path.exists(f"{reference_dir}/{name}.json"):
+        return None
+    if _read_json(f"{reference_dir}/{name}/combined.json") != sorted(manifest):   # offsets would not match
+        print(f"   reference index {name} does not match its manifest (rerun reference_index.py), opening the files")
+        return None
+
+    names = sorted(manifest)
+    pos   = {b: i for i, b in enumerate(names)}
+    for f in files:
+        b = os.path.basename(f)
+        if os.path.dirname(f) != directory or b not in pos or manifest[b]['stat'] != _stat(f):
+            print(f"   {f} not (unchanged) in the reference index, opening the files")
+            return None
+    i0, i1 = pos[os.path.basename(files[0])], pos[os.path.basename(files[-1])]
+    if i1 - i0 + 1 != len(files):   # not consecutive
+        return None
+
+    offsets = np.concatenate([[0], np.cumsum([manifest[b]['n_time'] for b in names])])
+    if isinstance(chunks, dict) and chunks.get('time')==-1:
+        chunks = {**chunks, 'time': manifest[names[i0]]['n_time']}
+    ds = open_index(f"{reference_dir}/{name}.json", chunks=chunks)
+    print(f"   opened {len(files)} files from the reference index {name}")
+    return ds.isel(time=slice(int(offsets[i0]), int(offsets[i1+1])))
+
+
+###########################
+#     MAIN
+###########################
+if __name__=="__main__":
+
+    args  = process_command_line()
+    files = glob.glob(args.files)
+    if len(files)==0:
+        print(f"   no files found for {args.files}")
+    else:
+        build_index(args.reference_dir, files, args.nproc)
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+# coding: utf-8
+######################################################################################################
+#
+# Regrid raw GCM convective precipitation to the ICAR grid in the pipeline (iso the offline
+# regridded GCM_Igrid files):
+#    - weights from the (rectilinear: 1D lat / lon) GCM grid to the ICAR lat / lon (2D), computed
+#      once per GCM grid / ICAR grid / method and cached as a sparse matrix (npz) in weights_dir
+#        bilinear:     the 4 surrounding GCM grid points
+#        conservative: the area fractions of every ICAR cell in the GCM cells, from sub_samples x
+#                      sub_samples points per ICAR cell (first order conservative, ICAR cells are
+#                      much smaller than GCM cells)
+#    - applied per time chunk as one sparse matmul (n_icar x n_gcm) @ (n_gcm x n_time), NaN aware
+#    - the raw time stamps (CMIP: middle of the 3hr / daily interval) are set to the start of the
+#      interval, as the ICAR timestep amounts (label='lower')
+#    - remove_cp.py regrids the raw cp (same units as GCM_Igrid: kg m-2 s-1) when raw_path is set
+#      in the main_*.py drivers
+#
+# Usage:
+#   regrid_cp.raw_path = "/glade/.../CMIP6/prc"     (files {raw_path}/{3hr|day}/{scen}/{model}/prc_{3hr|day}_{model}_*.nc)
+#   python regrid_cp.py gcm_file icar_file [--method bilinear] [--weights_dir dir]   (build / check the weights)
+#
+######################################################################################################
+
+import argparse
+import xarray as xr
+import numpy as np
+import dask.array
+import hashlib
+import glob
+import re
+import os
+try:
+    import scipy.sparse
+except ImportError:
+    scipy = None
+
+import time_axis
+import icar_io
+
+
+#########################################
+#         SETTTINGS
+#######################################
+raw_path    = None             # raw GCM cp files, None: use the regridded cp in GCM_path (remove_cp.py)
+variable    = 'prc'            # cp variable in the raw files (CMIP: convective precipitation flux)
+method      = 'conservative'   # or 'bilinear'
+weights_dir = None             # cache of the weights, None: {raw_path}/weights
+sub_samples = 5                # points per ICAR cell side for the conservative weights
+time_chunk  = 248              # timesteps per sparse matmul (a month of 3hr data)
+cmip_table  = {'3hr': '3hr', '6hr': '6hrPlev', '24hr': 'day', 'daily': 'day'}
+experiment  = {'hist': 'historical'}   # scenario -> raw directory, if different
+
+
+def process_command_line():
+    '''Parse the commandline'''
+    parser = argparse.ArgumentParser(description='build (cache) and check the GCM -> ICAR grid weights')
+    parser.add_argument('gcm_file',                       help='a raw GCM file (1D lat / lon)')
+    parser.add_argument('icar_file',                      help='an ICAR file (2D lat / lon)')
+    parser.add_argument('--method',  default=method,      help='conservative or bilinear')
+    parser.add_argument('--weights_dir', default='.',     help='cache of the weights')
+
+    return parser.parse_args()
+
+
+##############################################################################################
+#      weights                                                                                #
+##############################################################################################
+def _is_global(slon):
+    """ whether the (sorted) GCM lon go round the globe"""
+    dlon = np.median(np.diff(slon))
+    return bool(np.isclose(slon[-1] - slon[0] + dlon, 360, atol=dlon/2))
+
+
+def _wrap(lon, slon):
+    """ lon in the 360 degree range of the (sorted) GCM lon: from the first lon (global), or centered on the GCM lon"""
+    lo = slon[0] if _is_global(slon) else (slon[0] + slon[-1])/2 - 180
+    return (np.asarray(lon, dtype='float64') - lo) % 360 + lo
+
+
+def _sorted(src_lat, src_lon):
+    """ the GCM lat / lon sorted ascending (lon in 0-360), with the order of the original indices"""
+    lat_order = np.argsort(src_lat)
+    lon_order = np.argsort(np.asarray(src_lon) % 360)
+    return np.asarray(src_lat)[lat_order], np.asarray(src_lon)[lon_order] % 360, lat_order, lon_order
+
+
+def bilinear_weights(src_lat, src_lon, dst_lat, dst_lon):
+    """ sparse (n_dst x n_src) bilinear weights, src index = lat_index * n_lon + lon_index"""
+    slat, slon, lat_order, lon_order = _sorted(src_lat, src_lon)
+    n_lon = len(slon)
+    y = np.asarray(dst_lat, dtype='float64').ravel()
+    x = _wrap(np.asarray(dst_lon).ravel(), slon)
+    if _is_global(slon):   # the cell between the last and the first lon
+        slon = np.append(slon, slon[0] + 360)
+
+    i  = np.clip(np.searchsorted(slat, y) - 1, 0, len(slat)-2)
+    wy = np.clip((y - slat[i]) / (slat[i+1] - slat[i]), 0, 1)
+    j  = np.clip(np.searchsorted(slon, x) - 1, 0, len(slon)-2)
+    wx = np.clip((x - slon[j]) / (slon[j+1] - slon[j]), 0, 1)
+    j1 = (j + 1) % n_lon
+
+    rows = np.repeat(np.arange(len(y)), 4)
+    cols = np.stack([ lat_order[i]  *n_lon + lon_order[j], lat_order[i]  *n_lon + lon_order[j1],
+                      lat_order[i+1]*n_lon + lon_order[j], lat_order[i+1]*n_lon + lon_order[j1] ], axis=1).ravel()
+    vals = np.stack([ (1-wy)*(1-wx), (1-wy)*wx, wy*(1-wx), wy*wx ], axis=1).ravel()
+    return scipy.sparse.coo_matrix((vals, (rows, cols)), shape=(len(y), len(src_lat)*n_lon)).tocsr()
+
+
+def _subsample(grid, n):
+    """ n x n points per cell of a 2D coordinate (bilinear in index space, extrapolated at the edges),
+        shape (ny, nx, n*n)"""
+    ny, nx = grid.shape
+    f  = (np.arange(n) + 0.5) / n - 0.5                     # offsets in the cell, in index units
+    fy = (np.arange(ny)[:, None] + f[None, :]).ravel()      # (ny*n)
+    fx = (np.arange(nx)[:, None] + f[None, :]).ravel()
+    i0 = np.clip(np.floor(fy).astype(int), 0, max(ny-2, 0)); t = fy - i0
+    j0 = np.clip(np.floor(fx).astype(int), 0, max(nx-2, 0)); s = fx - j0
+    i1 = np.minimum(i0+1, ny-1); j1 = np.minimum(j0+1, nx-1)
+    g  = ( (1-t)[:, None]*(1-s)[None, :]*grid[i0][:, j0] + (1-t)[:, None]*s[None, :]*grid[i0][:, j1]
+          + t[:, None]*(1-s)[None, :]*grid[i1][:, j0]    + t[:, None]*s[None, :]*grid[i1][:, j1] )
+    return g.reshape(ny, n, nx, n).transpose(0, 2, 1, 3).reshape(ny, nx, n*n)
+
+
+def conservative_weights(src_lat, src_lon, dst_lat, dst_lon, n=None):
+    """ sparse (n_dst x n_src) area fractions of the ICAR cells in the GCM cells, from n x n points per ICAR cell"""
+    n = sub_samples if n is None else n
+    slat, slon, lat_order, lon_order = _sorted(src_lat, src_lon)
+    n_lon = len(slon)
+    # GCM cell edges halfway between the grid points:
+    edges = lambda c: np.concatenate([[c[0] - (c[1]-c[0])/2], (c[1:] + c[:-1]) / 2, [c[-1] + (c[-1]-c[-2])/2]])
+    lat_edges = np.clip(edges(slat), -90, 90)
+    lon_edges = edges(slon)
+
+    dst_lat, dst_lon = np.asarray(dst_lat, dtype='float64'), np.asarray(dst_lon, dtype='float64')
+    y = _subsample(dst_lat, n)
+    x = _wrap(_subsample(dst_lon, n), slon)
+    i = np.clip(np.searchsorted(lat_edges, y) - 1, 0, len(slat)-1)
+    j = np.searchsorted(lon_edges, x) - 1
+    j = (j % n_lon) if _is_global(slon) else np.clip(j, 0, n_lon-1)
+
+    area = np.cos(np.deg2rad(y))                               # sub-points are ~ equal in index space
+    area = area / area.sum(axis=-1, keepdims=True)
+    rows = np.repeat(np.arange(dst_lat.size), n*n)
+    cols = (lat_order[i]*n_lon + lon_order[j]).ravel()
+    return scipy.sparse.coo_matrix((area.ravel(), (rows, cols)), shape=(dst_lat.size, len(src_lat)*n_lon)).tocsr()
+
+
+def _grid_key(src_lat, src_lon, dst_lat, dst_lon, method):
+    h = hashlib.sha1(f"{method}-{sub_samples}".encode())
+    for a in [src_lat, src_lon, dst_lat, dst_lon]:
+        a = np.ascontiguousarray(a, dtype='float64')
+        h.update(str(a.shape).encode())
+        h.update(a.tobytes())
+    return h.hexdigest()[:16]
+
+
+def weights(src_lat, src_lon, dst_lat, dst_lon, how=None, cache_dir=None):
+    """ the (cached) sparse weights from the GCM grid to the ICAR grid (how: method, default the setting)"""
+    if scipy is None:
+        raise ImportError("regrid_cp requires scipy: pip install scipy")
+    how       = method if how is None else how
+    cache_dir = weights_dir if cache_dir is None else cache_dir
+    if cache_dir is None and raw_path is not None:
+        cache_dir = f"{raw_path}/weights"
+
+    weights_file = None
+    if cache_dir is not None:
+        weights_file = f"{cache_dir}/{how}_{_grid_key(src_lat, src_lon, dst_lat, dst_lon, how)}.npz"
+        if os.path.exists(weights_file):
+            return scipy.sparse.load_npz(weights_file)
+
+    print(f"   computing {how} weights {len(src_lat)}x{len(src_lon)} -> {np.shape(dst_lat)}")
+    if how=='bilinear':
+        W = bilinear_weights(src_lat, src_lon, dst_lat, dst_lon)
+    elif how=='conservative':
+        W = conservative_weights(src_lat, src_lon, dst_lat, dst_lon)
+    else:
+        raise ValueError(f"unknown regrid method {how}")
+
+    if weights_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = f"{weights_file}.{os.getpid()}.tmp.npz"
+        scipy.sparse.save_npz(tmp, W)
+        os.replace(tmp, weights_file)
+        print(f"   weights cached in {weights_file}")
+    return W
+
+
+##############################################################################################
+#      apply                                                                                  #
+##############################################################################################
+def _apply_block(block, W, shape):
+    """ (time, lat, lon) GCM block -> (time, ny, nx) ICAR block, weights renormalized over the valid GCM cells"""
+    flat  = block.reshape(len(block), -1).T                   # (n_src, time)
+    valid = np.isfinite(flat)
+    num   = W @ np.where(valid, flat, 0).astype('float64')
+    den   = W @ valid.astype('float64')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out = np.where(den > 0, num / den, np.nan)
+    return out.T.reshape((len(block),) + shape).astype(block.dtype)
+
+
+def regrid(da, W, shape, dims=('lat_y', 'lon_x')):
+    """ da (time, lat, lon) on the GCM grid -> (time, *dims) on the ICAR grid (shape), per time_chunk (lazy if dask)"""
+    da = da.transpose('time', ...)
+    if isinstance(da.data, dask.array.Array):
+        src  = da.data.rechunk({0: time_chunk, 1: -1, 2: -1})
+        data = src.map_blocks(_apply_block, W=W, shape=shape, chunks=(src.chunks[0],) + tuple((s,) for s in shape), dtype=da.dtype)
+    else:
+        values = np.asarray(da.values)
+        data   = np.concatenate([ _apply_block(values[t:t+time_chunk], W, shape) for t in range(0, len(values), time_chunk) ]
+                                 + [np.empty((0,) + shape, dtype=values.dtype)])
+    return xr.DataArray(data, dims=('time',) + tuple(dims), coords={'time': da.time}, attrs=da.attrs)
+
+
+##############################################################################################
+#      raw GCM cp                                                                             #
+##############################################################################################
+def cp_files(model, scen, dt, years):
+    """ the raw files of model / scen that (by their CMIP name, ..._YYYYMM...-YYYYMM....nc) overlap years"""
+    table = cmip_table[dt]
+    files = sorted(glob.glob(f"{raw_path}/{table}/{experiment.get(scen, scen)}/{model}/{variable}_{table}_{model}_*.nc"))
+    keep  = []
+    for f in files:
+        period = re.search(r"_(\d{4})\d*-(\d{4})\d*\.nc$", f)
+        if period is None or (int(period.group(1)) <= max(years) and int(period.group(2)) >= min(years)):
+            keep.append(f)
+    return keep
+
+
+def open_cp(model, scen, year, month=None, grid=None, dt='3hr', load=True):
+    """ raw GCM cp of a month (3hr) or year (daily) regridded to the ICAR grid (grid: dataset with 2D lat / lon), loaded
+        (or lazy: load=False)"""
+    if grid is None or 'lat' not in grid.coords or 'lon' not in grid.coords:
+        raise ValueError("regridding the raw GCM cp needs the ICAR lat / lon (2D coordinates of the ICAR dataset)")
+    files = cp_files(model, scen, dt, [int(year)])
+    if len(files)==0:
+        raise FileNotFoundError(f"no raw GCM cp files for {model} {scen} {year} in {raw_path}")
+    print(f"   regridding ({method}) GCM cp from {len(files)} raw file(s): {files[0]} ...")
+    ds  = icar_io.open_icar(files)
+
+    # the month / year, on the integer time axis, time set to the start of the interval:
+    ta  = time_axis.TimeAxis.from_dataarray(ds.time)
+    sel = ta.month_slice(year, month) if month is not None else ta.year_slice(year)
+    src = ds[variable].isel(time=sel)
+    step  = {'3hr': 3, '6hr': 6}.get(dt, 24)
+    start = time_axis.TimeAxis(ta.window_index(step)[sel], ta.calendar)
+    src   = src.assign_coords(time=start.decode())
+
+    lat_name = 'lat' if 'lat' in src.dims else 'latitude'
+    lon_name = 'lon' if 'lon' in src.dims else 'longitude'
+    src = src.transpose('time', lat_name, lon_name)
+    W   = weights(src[lat_name].values, src[lon_name].values, grid.lat.values, grid.lon.values)
+    cp  = regrid(src, W, grid.lat.shape, dims=grid.lat.dims).rename('cp')
+    if load:
+        cp = cp.load()
+    cp.attrs['processing_note'] = f"regridded ({method}) from {os.path.basename(files[0])} (regrid_cp.py)"
+    return cp
+
+
+###########################
+#     MAIN
+###########################
+if __name__=="__main__":
+
+    args  = process_command_line()
+    gcm   = xr.open_dataset(args.gcm_file)
+    icar  = xr.open_dataset(args.icar_file)
+    lat_name = 'lat' if 'lat' in gcm.dims else 'latitude'
+    lon_name = 'lon' if 'lon' in gcm.dims else 'longitude'
+    W = weights(gcm[lat_name].values, gcm[lon_name].values, icar.lat.values, icar.lon.values,
+                how=args.method, cache_dir=args.weights_dir)
+    sums = np.asarray(W.sum(axis=1)).ravel()
+    print(f"   {W.shape[0]} ICAR cells, {W.shape[1]} GCM cells, {W.nnz} weights ({W.nnz/W.shape[0]:.1f} per ICAR cell)")
+    print(f"   row sums {sums.min():.6f} - {sums.max():.6f}")
+    # a smooth field (cos lat) should be reproduced:
+    field = np.cos(np.deg2rad(gcm[lat_name].values))[:, None] * np.ones(len(gcm[lon_name]))[None, :]
+    out   = _apply_block(field[None], W, icar.lat.shape)[0]
+    print(f"   cos(lat) test: max abs error {np.nanmax(np.abs(out - np.cos(np.deg2rad(icar.lat.values)))):.2e}")
@@ -28,6 +28,14 @@ import multiprocessing as mp
 import time
 import sys
 
+import precision
+import time_axis
+import icar_io
+import conservation
+import noise
+import regrid_cp
+import temporal_cp
+
 dask.config.set(**{'array.slicing.split_large_chunks': True})
 
 
@@ -81,47 +89,105 @@ def drop_unwanted_vars(ds_in, vars_to_drop=None):
 
 
 ##############################
-#  remove convective pcp 3hr
+#  GCM cp units
 ##############################
-def remove_3hr_cp(ds_in, m, year, model, scen,
-                  GCM_path='/glade/derecho/scratch/bkruyt/CMIP6/GCM_Igrid',
-                  noise_path = "/glade/derecho/scratch/bkruyt/CMIP6/uniform_noise_480_480.nc", # remove from func call in main.py
-                  vars_to_drop=None,
-                #   drop_vars=False, #  should just check for vars_to_drop=None ?
-                  ):
+def default_units_conv(GCM_path, dt='3hr'):
+    """ factor to go from GCM cp (kg m-2 s-1) to kg m-2 per ICAR timestep, depending on where the GCM cp comes from"""
+    # 2024 08 14: notebook GCM_cp_check.ipynb shows comparison CMIP5/6 cp and how the units are different
+    if regrid_cp.raw_path is not None:   # raw CMIP prc: mean flux over the 3hr / 6hr / daily interval
+        return 60*60*temporal_cp.step_hours[dt]
+    if dt=='3hr':
+        if "CMIP6" in GCM_path:
+            return 60*60*3 # no idea why this is reduced to 1h, maybe by Abby?
+        elif "CMIP5" in GCM_path:
+            return 60*60*3/4 # Ryan's GCM cp has different units?
+    else:
+        if "CMIP6" in GCM_path:
+            return 60*60*24 # no idea why this is reduced to 1h, maybe by Abby?
+        elif "CMIP5" in GCM_path or "currierw" in GCM_path :
+            return 60*60*6 # org GCM data has 6h timestep, daily is summed(?) so to convert to kg m-2 mult. by 6
+    sys.exit(f"! ! !  ERROR:  cannot determine GCM cp units from GCM_path {GCM_path}, set units_conv")
 
-    # for legacy code?
-    dt='3hr'
 
-    # ## N.B> Noise is only added if Noise path is not None
-    # if noise_path is not None:
-    #     print(f"\n   Adding noise from {noise_path} \n")
-    #     u_noise = xr.open_dataset(f"{noise_path}" ).uniform_noise  #.load() # 55000 x 480 x480
+def get_precip_var(ds_in):
+    """ name of the precipitation variable in the ICAR dataset"""
+    for precip_var in ['precip_dt', 'precipitation', 'Prec']:
+        if precip_var in ds_in.data_vars:
+            return precip_var
+    print( f"! ! !  ERROR:  define precip variable in ICAR  dataset")
+    sys.exit()
 
 
-    #___________ GCM cp ____________
+def subtract_cp(pcp, cp, units_conv):
+    """ pcp - cp*units_conv, with negative values set to 0, in the dtype of the policy"""
+    dsP_raw=pcp - cp * units_conv
+    # # somehow subtracting the GCM cp does introduce negative values again, so we make sure those are set to zero: (this was probably because we subtracted 60*60*24 iso 60*60*6)?
+    dsP_out=xr.where(dsP_raw<0,0, dsP_raw)  # not in all daily data! only files processed after November 1st 2023
+    dsP_out=precision.apply_policy(dsP_out, pcp.name).rename(pcp.name)  # GCM cp (float64) * units_conv would upcast
+    # mass account (conservation.py): removed cp (where there is pcp) and the mass added by setting < 0 to 0
+    conservation.account('remove_cp', pcp.name,
+                         into    = pcp.sum(dtype='float64'),
+                         removed = (pcp - dsP_raw).sum(dtype='float64'),
+                         clipped = -dsP_raw.where(dsP_raw<0).sum(dtype='float64'),
+                         out     = dsP_out.sum(dtype='float64') )
+    return dsP_out
+
+
+##############################
+#  open GCM cp 3hr
+##############################
+def cp_files(year, model, scen, GCM_path, dt='3hr'):
+    """ the GCM cp files open_3hr_cp / open_24hr_cp read for year (e.g. to stage them); not the raw cp
+        (regrid_cp.raw_path), which is on the GCM grid and small"""
+    if dt=='3hr':
+        if "CMIP5" in GCM_path:
+            scen_dir = "rcp45" if scen=="historical" or scen=="historical/3hr" else scen
+            patterns = [f"{GCM_path}/{scen_dir}/{model}/{model}*_cp_3hr_Igrid_{year}.nc"]
+        else:
+            decades  = [myround(year, base=10)]
+            if year==2019 and ("ssp" in scen or scen=="hist"):   # 2019 is spread over 2 files
+                decades.append(myround(year+1, base=10))
+            patterns = [f'{GCM_path}/3hr/{scen}/{model}*_cp_3hr_Igrid_{yr_10}-*.nc' for yr_10 in decades]
+    elif "CMIP6" in GCM_path:
+        scen_dir = 'ssp245' if scen=='hist' else scen
+        patterns = [f'{GCM_path}/daily/{scen_dir}/{ model}_bias_corr_convective_prec_regrid_{scen_dir}_1950-2099.nc']
+    else:   # CMIP5 daily: the paths are set in open_24hr_cp
+        patterns = []
+    return sorted(f for p in patterns for f in glob.glob(p))
+
+
+def open_3hr_cp(m, year, model, scen,
+                GCM_path='/glade/derecho/scratch/bkruyt/CMIP6/GCM_Igrid',
+                grid=None,   # ICAR dataset (lat / lon), to regrid the raw GCM cp to
+                load=True,   # False: lazy (temporal_cp.py resamples the whole decade)
+                ):
+    """ GCM cp on the ICAR grid for one month (m=None: the whole year)"""
+
+    if regrid_cp.raw_path is not None:   # regrid the raw GCM cp iso reading GCM_path
+        return regrid_cp.open_cp(model, scen, year, m, grid=grid, dt='3hr', load=load)
+
     print("GCM_path[-4:]: ", GCM_path[-4:], " scen=", scen)
 
     if "CMIP5" in GCM_path:
         if scen=="historical" or scen=="historical/3hr": # no historical subfolder, in rcp45/85
             print(f'historical; opening  "{GCM_path}/rcp45/{model}/{model}*_cp_3hr_Igrid_{year}.nc')
-            ds_convective_p= xr.open_mfdataset(
+            ds_convective_p= icar_io.open_icar(
                 f"{GCM_path}/rcp45/{model}/{model}*_cp_3hr_Igrid_{year}.nc"
             )
         else:
             print(f' opening  "{GCM_path}/{scen}/{model}/{model}*_cp_3hr_Igrid_{year}.nc')
-            ds_convective_p= xr.open_mfdataset(
+            ds_convective_p= icar_io.open_icar(
                 f"{GCM_path}/{scen}/{model}/{model}*_cp_3hr_Igrid_{year}.nc"
             )
     else:  #CMIP6
         yr_10 = myround(year, base=10)  # the decade in which the year falls
-        ds_cp1  = xr.open_mfdataset(
+        ds_cp1  = icar_io.open_icar(
             f'{GCM_path}/3hr/{scen}/{model}*_cp_3hr_Igrid_{yr_10}-*.nc'
             )
         if year==2019 and ("ssp" in scen or scen=="hist"): # somehow the year 2019 is spread over the files 2010-2019 and 2020-2029 (CMIP6 only), so:
             print(f"   merging 2019 from 2 files...")
             yr_10 = myround(year+1, base=10)  # the (next) decade
-            ds_cp2 = xr.open_mfdataset(
+            ds_cp2 = icar_io.open_icar(
                 f'{GCM_path}/3hr/{scen}/{model}*_cp_3hr_Igrid_{yr_10}-*.nc'
                 )
             ds_convective_p = xr.concat( [ds_cp1, ds_cp2], dim='time')
@@ -129,44 +195,62 @@ def remove_3hr_cp(ds_in, m, year, model, scen,
         else:
             ds_convective_p = ds_cp1
 
-    ds_convective_p = ds_convective_p.sel(time=ds_convective_p.time.dt.year==int(year))
+    # select year & month on the integer time axis (iso .dt.year / .dt.month on cftime objects):
+    cp_time = time_axis.TimeAxis.from_dataarray(ds_convective_p.time)
+    ds_convective_p_sub = ds_convective_p.cp.isel(time=cp_time.month_slice(year, m) if m is not None else cp_time.year_slice(year))
+    if not load:
+        return ds_convective_p_sub
+    ds_convective_p_sub = ds_convective_p_sub.load()
 
-    # ______ ICAR _______
-    if 'precip_dt' in ds_in.data_vars:
-        precip_var='precip_dt'
-    elif 'precipitation' in ds_in.data_vars:
-        precip_var='precipitation'
-    elif 'Prec' in ds_in.data_vars:
-        precip_var='Prec'
-    else:
-        print( f"! ! !  ERROR:  define precip variable in ICAR  dataset")
-        sys.exit()
+    print(f"    ...loaded GCM convective precipitation for year {year} month{m}")
+    print(f"    GCM cp shape: {ds_convective_p_sub.shape }")
+    print(f"    GCM times: {ds_convective_p_sub.time.values.min() } to {ds_convective_p_sub.time.values.max()}")
+    return ds_convective_p_sub
+
+
+##############################
+#  remove convective pcp 3hr
+##############################
+def remove_3hr_cp(ds_in, m, year, model, scen,
+                  GCM_path='/glade/derecho/scratch/bkruyt/CMIP6/GCM_Igrid',
+                  noise_seed = None,   # add uniform noise to the dry pixels (noise.py, generated per chunk) with this seed, None: no noise
+                  vars_to_drop=None,
+                  units_conv=None,  # None: depends on GCM_path (default_units_conv)
+                #   drop_vars=False, #  should just check for vars_to_drop=None ?
+                  ):
 
+    # for legacy code?
+    dt='3hr'
 
-    ds_convective_p_sub = ds_convective_p.cp.sel(time=ds_convective_p.time.dt.month==int(m)).load()  #?
+    #___________ GCM cp ____________
+    if temporal_cp.source_dt is not None:   # resampled to 3hr, already in kg m-2 per timestep
+        ds_convective_p_sub = open_resampled_cp(year, model, scen, dt, m=m, GCM_path=GCM_path, grid=ds_in)
+        units_conv = 1 if units_conv is None else units_conv
+    else:
+        ds_convective_p_sub = open_3hr_cp(m, year, model, scen, GCM_path=GCM_path, grid=ds_in)
+
+    # ______ ICAR _______
+    precip_var = get_precip_var(ds_in)
 
-    print(f"    ...loaded GCM convective precipitation for year {year} month{m}")
-    print(f"    GCM cp shape: {ds_convective_p_sub.shape }")
     print(f"    ICAR pcp shape: {ds_in[precip_var].shape }")
-    print(f"    GCM times: {ds_convective_p_sub.time.values.min() } to {ds_convective_p_sub.time.values.max()}")
     print(f"    ICAR times: {ds_in.time.values.min() } to {ds_in.time.values.max()}")
 
 
     #----------------- subtract -----------------
     # Units are modified rom GCM kg m-2 s-1 to kg m-2
-        # 2024 08 14: notebook GCM_cp_check.ipynb shows comparison CMIP5/6 cp and how the units are different
-    if "CMIP6" in GCM_path:
-        units_conv = 60*60*3 # no idea why this is reduced to 1h, maybe by Abby?
-    elif "CMIP5" in GCM_path:
-        units_conv = 60*60*3/4 # Ryan's GCM cp has different units?
+    if units_conv is None:
+        units_conv = default_units_conv(GCM_path, dt)
 
-    dsP_out=ds_in[precip_var]-ds_convective_p_sub * units_conv
+    dsP_out = subtract_cp(ds_in[precip_var], ds_convective_p_sub, units_conv)
     print(f"   timestep is {dt}, so multiplying GCM-cp by {units_conv} to obtain kg m-2")
     print(f"   Be sure to check GCM cp units in input!!!!! ")
-    print(f"    GCM cp sum for {year} {m}: {ds_convective_p_sub.sum().values} kg m-2 s-1 or {ds_convective_p_sub.sum().values*units_conv/10e3} 10e3 kg m-2 ")
-    print(f"    ICAR pcp sum (inc GCMcp): {ds_in[precip_var].sum().values/10e3 } 10e3 kg m-2")
-    # # somehow subtracting the GCM cp does introduce negative values again, so we make sure those are set to zero: (this was probably because we subtracted 60*60*24 iso 60*60*6)?
-    dsP_out=xr.where(dsP_out<0,0, dsP_out)  # not in all daily data! only files processed after November 1st 2023
+
+    # ## N.B> Noise is only added if noise_seed is not None
+    if noise_seed is not None:
+        print(f"   adding uniform noise [0, {noise.amplitude}) kg m-2 to the dry pixels, seed {noise_seed}")
+        dsP_out = noise.add_where_dry(dsP_out, noise_seed)
+    # computed once, the GCM cp / ICAR pcp sums (mass accounts, conservation.py) in the same compute:
+    dsP_out, = conservation.compute(dsP_out)
 
     try:
         print("   Min ICAR (out) prec: ", np.nanmin(dsP_out.values)   ," kg/m-2"   )
@@ -183,6 +267,8 @@ def remove_3hr_cp(ds_in, m, year, model, scen,
     # ------- add corrected precip to dataset ----------
     ds_in[precip_var].values = dsP_out.values
     ds_in[precip_var].attrs["processing_note3"] = "Removed GCM's convective precipitation from total precipitation"
+    if noise_seed is not None:
+        ds_in[precip_var].attrs["processing_note4"] = dsP_out.attrs["processing_note4"]
 
     # ----- return result  -----
     return ds_in
@@ -193,39 +279,31 @@ def remove_3hr_cp(ds_in, m, year, model, scen,
 # -  --- - -- -- - - - - - -
 
 ##############################
-#  remove convective pcp 24hr
+#  open GCM cp 24hr
 ##############################
-def remove_24hr_cp(ds_in, year, model, scen,
-                  GCM_path='/glade/derecho/scratch/bkruyt/CMIP6/GCM_Igrid',
-                #   noise_path = "/glade/derecho/scratch/bkruyt/CMIP6/uniform_noise_480_480.nc",
-                #   drop_vars=False,
-                  vars_to_drop=None
-                  ):
-
-
-    # ______ ICAR pcp var _______
-    if 'precip_dt' in ds_in.data_vars:
-        precip_var='precip_dt'
-    elif 'precipitation' in ds_in.data_vars:
-        precip_var='precipitation'
-    elif 'Prec' in ds_in.data_vars:
-        precip_var='Prec'
-    else:
-        print( f"! ! !  ERROR:  define precip variable in ICAR  dataset")
-        sys.exit()
+def open_24hr_cp(year, model, scen,
+                 GCM_path='/glade/derecho/scratch/bkruyt/CMIP6/GCM_Igrid',
+                 grid=None,   # ICAR dataset (lat / lon), to regrid the raw GCM cp to
+                 load=True,   # False: lazy (temporal_cp.py resamples the whole decade)
+                 ):
+    """ daily GCM cp on the ICAR grid for one year"""
 
+    if regrid_cp.raw_path is not None:   # regrid the raw GCM cp iso reading GCM_path
+        return regrid_cp.open_cp(model, scen, year, grid=grid, dt='24hr', load=load)
 
     # -----------------open GCM on ICARgrid --------------
     print(f"   opening GCM cp from: {GCM_path}"   )
     print(f"   ! ! !   CHECK input units of GCM cp thoroughly  ! ! ! " )
     if "CMIP6" in GCM_path: # one file per scen
         if scen=='hist': # hist is included in the scen folder
-            ds_convective_p=xr.open_dataset(
-                f'{GCM_path}/daily/ssp245/{ model}_bias_corr_convective_prec_regrid_ssp245_1950-2099.nc'
+            ds_convective_p=icar_io.open_file(
+                f'{GCM_path}/daily/ssp245/{ model}_bias_corr_convective_prec_regrid_ssp245_1950-2099.nc',
+                decode_times=False
                 )
         else:
-            ds_convective_p=xr.open_dataset(
-                f'{GCM_path}/daily/{scen}/{ model}_bias_corr_convective_prec_regrid_{scen}_1950-2099.nc'
+            ds_convective_p=icar_io.open_file(
+                f'{GCM_path}/daily/{scen}/{ model}_bias_corr_convective_prec_regrid_{scen}_1950-2099.nc',
+                decode_times=False
                 )
     elif "CMIP5" in GCM_path: # one file per scen
         if scen == 'rcp45' and  model=='MRI-CGCM3':
@@ -236,40 +314,100 @@ def remove_24hr_cp(ds_in, year, model, scen,
         scen_temp="rcp85" if scen=="historical" else scen
         print(f"  scen_temp={scen_temp}")
 
-        ds_convective_p=xr.open_dataset(
-                f'{GCM_path}/{model}_bias_corr_convective_prec_regrid_{scen_temp}_1950-2099.nc'
+        ds_convective_p=icar_io.open_file(
+                f'{GCM_path}/{model}_bias_corr_convective_prec_regrid_{scen_temp}_1950-2099.nc',
+                decode_times=False
                 ) # e.g.  MRI-CGCM3_bias_corr_convective_prec_regrid_rcp85_1950-2099.nc
         if "y" in ds_convective_p.dims:
             ds_convective_p=ds_convective_p.rename({"y":"lat_y", "x":"lon_x"})
             print(f"   dimensions changed from y to lat_y and x to lon_x")
 
 
-    ds_convective_p_sub = ds_convective_p.cp.sel(time=ds_convective_p.time.dt.year==int(year)).load()  #?
+    # (opened with decode_times=False): select the year on the integer time axis, only decode that year
+    cp_time = time_axis.TimeAxis.from_raw(ds_convective_p.time)
+    ds_convective_p_sub = xr.decode_cf( ds_convective_p[['cp']].isel(time=cp_time.year_slice(year)) ).cp
+    if not load:
+        return ds_convective_p_sub
+    ds_convective_p_sub = ds_convective_p_sub.load()
     print(f"    ...loaded GCM convective precipitation for year {year}")
     print(f"    GCM cp shape: {ds_convective_p_sub.shape }")
-    print(f"    ICAR pcp shape: {ds_in[precip_var].shape }")
-
     print(f"    GCM times: {ds_convective_p_sub.time.values.min() } to {ds_convective_p_sub.time.values.max()}")
+    return ds_convective_p_sub
+
+
+##############################
+#  open GCM cp resampled
+##############################
+def open_resampled_cp(year, model, scen, dt, m=None,
+                      GCM_path='/glade/derecho/scratch/bkruyt/CMIP6/GCM_Igrid',
+                      grid=None,   # ICAR dataset (lat / lon), to regrid the raw GCM cp to
+                      ):
+    """ GCM cp in kg m-2 per ICAR timestep (dt) for month m (None: the year), resampled from the
+        temporal_cp.source_dt cp (temporal_cp.py), loaded"""
+    source = temporal_cp.source_dt
+    if regrid_cp.raw_path is None and source not in ['3hr', '24hr', 'daily']:
+        sys.exit(f"! ! !  ERROR:  no {source} GCM cp in GCM_path, only 3hr / daily (or raw cp: regrid_cp.raw_path)")
+    units_conv = default_units_conv(GCM_path, source)   # to kg m-2 per native step
+
+    def files(years):
+        if regrid_cp.raw_path is not None:
+            return regrid_cp.cp_files(model, scen, source, years)
+        return sorted(set(f for yr in years for f in cp_files(yr, model, scen, GCM_path, dt=source)))
+
+    def open_year(yr, load):
+        if (regrid_cp.raw_path is not None or source=='3hr') and len(files([yr]))==0:   # e.g. the rest of the decade
+            return xr.DataArray(np.zeros((0,)), dims=['time'])
+        if regrid_cp.raw_path is not None:
+            cp = regrid_cp.open_cp(model, scen, yr, grid=grid, dt=source, load=load)
+        elif source=='3hr':
+            cp = open_3hr_cp(None, yr, model, scen, GCM_path=GCM_path, load=load)
+        else:
+            cp = open_24hr_cp(yr, model, scen, GCM_path=GCM_path, load=load)
+        return cp * units_conv
+
+    params = {'model': model, 'scen': scen, 'units_conv': units_conv, 'raw_path': regrid_cp.raw_path,
+              'regrid': regrid_cp.method, 'grid': None if grid is None else list(grid.lat.shape)}
+    return temporal_cp.open_cp(year, m, dt, open_year, files, params)
+
+
+##############################
+#  remove convective pcp 24hr
+##############################
+def remove_24hr_cp(ds_in, year, model, scen,
+                  GCM_path='/glade/derecho/scratch/bkruyt/CMIP6/GCM_Igrid',
+                  noise_seed = None,   # add uniform noise to the dry pixels (noise.py) with this seed, None: no noise
+                #   drop_vars=False,
+                  vars_to_drop=None,
+                  units_conv=None,  # None: depends on GCM_path (default_units_conv)
+                  ):
+
+
+    # ______ ICAR pcp var _______
+    precip_var = get_precip_var(ds_in)
+
+    # ______ GCM cp _______
+    if temporal_cp.source_dt is not None:   # resampled to daily, already in kg m-2 per day
+        ds_convective_p_sub = open_resampled_cp(year, model, scen, '24hr', GCM_path=GCM_path, grid=ds_in)
+        units_conv = 1 if units_conv is None else units_conv
+    else:
+        ds_convective_p_sub = open_24hr_cp(year, model, scen, GCM_path=GCM_path, grid=ds_in)
+    print(f"    ICAR pcp shape: {ds_in[precip_var].shape }")
     print(f"    ICAR times: {ds_in.time.values.min() } to {ds_in.time.values.max()}")
 
 
     #----------------- subtract -----------------
     # Units are modified rom GCM kg m-2 s-1 to kg m-2
-    # 2024 08 14: notebook GCM_cp_check.ipynb shows comparison CMIP5/6 cp and how the units are different
-    if "CMIP6" in GCM_path:
-        units_conv = 60*60*24 # no idea why this is reduced to 1h, maybe by Abby?
-    elif "CMIP5" in GCM_path or "currierw" in GCM_path :
-        units_conv = 60*60*6 # org GCM data has 6h timestep, daily is summed(?) so to convert to kg m-2 mult. by 6
+    if units_conv is None:
+        units_conv = default_units_conv(GCM_path, '24hr')
 
-    dsP_out=ds_in[precip_var]-ds_convective_p_sub * units_conv
+    dsP_out = subtract_cp(ds_in[precip_var], ds_convective_p_sub, units_conv)
 
     print(f"   multiplying GCM-cp by {units_conv} to go from kg m-2 s-1 to kg m-2")
-    print(f"    GCM cp sum for year {year}: {ds_convective_p_sub.sum().values} kg m-2 s-1 or {ds_convective_p_sub.sum().values*units_conv/10e6} 10e6 kg m-2 ")
-    print(f"    ICAR pcp sum (inc GCMcp): {ds_in[precip_var].sum().values/10e6 } 10e6 kg m-2")
-
-
-    # # somehow subtracting the GCM cp does introduce negative values again, so we make sure those are set to zero: (this was probably because we subtracted 60*60*24 iso 60*60*6)?
-    dsP_out=xr.where(dsP_out<0,0, dsP_out)  # not in all daily data! only files processed after November 1st 2023
+    if noise_seed is not None:
+        print(f"   adding uniform noise [0, {noise.amplitude}) kg m-2 to the dry pixels, seed {noise_seed}")
+        dsP_out = noise.add_where_dry(dsP_out, noise_seed)
+    # computed once, the GCM cp / ICAR pcp sums (mass accounts, conservation.py) in the same compute:
+    dsP_out, = conservation.compute(dsP_out)
 
     try:
         print("   Min ICAR (out) prec, after post processing: ", np.nanmin(dsP_out.values)   ," kg/m-2"   )
@@ -287,6 +425,8 @@ def remove_24hr_cp(ds_in, year, model, scen,
     # ------- save ----------
     ds_in[precip_var].values = dsP_out.values
     ds_in[precip_var].attrs["processing_note3"] = "Removed GCM's convective precipitation from total precipitation"
+    if noise_seed is not None:
+        ds_in[precip_var].attrs["processing_note4"] = dsP_out.attrs["processing_note4"]
 
     # print("   Max ICAR (out) prec: ", np.nanmax(ds_in[precip_var].values) ," kg/m-2"   )
 
@@ -317,7 +457,7 @@ if __name__=="__main__":
     # CMIP        = args.CMIP
 
     # Not tested in stand-alone:
-    ds_in = xr.open_mfdataset( f"{path_in}/{model}_{scenario}/{year}/*.nc")
+    ds_in = icar_io.open_icar( f"{path_in}/{model}_{scenario}/{year}/*.nc")
 
     for m in range(1,13):
 
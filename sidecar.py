@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# coding: utf-8
+######################################################################################################
+#
+# Statistics sidecars of the output files, so check_results.py does not have to open them:
+#    - write(ds, file_out, encoding) writes the netcdf file with to_netcdf(compute=False) and computes
+#      the statistics (per variable nan count, min, max, sum) in the same dask compute as the
+#      write (with the pending mass accounts of conservation.py), so every chunk is computed once;
+#      then writes file_out + '.json' with the time count / range / step / calendar, dims, coords,
+#      data_vars, the statistics and the size + mtime of file_out
+#    - read(file_out) returns the sidecar, or None when it is missing or stale (file_out changed)
+#    - from_file(file_out): sidecar of an existing file (reads it; streamed / tiled outputs, backfill)
+#    - json, one small file next to every output file (no parquet / pyarrow dependency)
+#
+# Usage:
+#   sidecar.write(ds3hr, file_out_3hr, encoding=...)         (in the main_*.py drivers)
+#   python sidecar.py "path_out/*/3hr/*.nc" [--nproc 8]       (backfill missing / stale sidecars)
+#
+######################################################################################################
+
+import argparse
+import netCDF4 as nc
+import numpy as np
+import multiprocessing as mp
+import datetime
+import dask
+import json
+import glob
+import os
+
+import time_axis
+import icar_io
+import conservation
+
+
+def process_command_line():
+    '''Parse the commandline'''
+    parser = argparse.ArgumentParser(description='write the missing / stale statistics sidecars of output files')
+    parser.add_argument('files',                      help='output files (glob, quoted)')
+    parser.add_argument('--nproc',  default=4, type=int, help='files in parallel')
+
+    return parser.parse_args()
+
+
+def sidecar_path(file_out):
+    return f"{file_out}.json"
+
+
+def _stats(ds):
+    """ lazy (dask) or numpy statistics per numeric data variable"""
+    stats = {}
+    for v, da in ds.data_vars.items():
+        if not np.issubdtype(da.dtype, np.number):
+            continue
+        stats[v] = {'n_nan': da.isnull().sum().data,
+                    'min'  : da.min().data,
+                    'max'  : da.max().data,
+                    'sum'  : da.sum(dtype='float64').data }
+    return stats
+
+
+def _num(x):
+    """ json number (None for nan / inf)"""
+    x = float(x)
+    return x if np.isfinite(x) else None
+
+
+def _describe(ds, stats, file_out):
+    """ the sidecar dict of ds (written to file_out) with the computed statistics"""
+    info = {'file': os.path.basename(file_out), 'n_time': 0, 'time_start': None, 'time_end': None, 'step_hours': None, 'calendar': None}
+    if 'time' in ds.dims and ds.sizes['time'] > 0:
+        ta = time_axis.TimeAxis.from_dataarray(ds.time)
+        info.update( n_time     = len(ta),
+                     time_start = str(ds.time.values[0]),
+                     time_end   = str(ds.time.values[-1]),
+                     step_hours = ta.step_hours() )
+        with nc.Dataset(file_out) as f:   # calendar as written (header only)
+            info['calendar'] = getattr(f.variables['time'], 'calendar', 'standard')
+    st = os.stat(file_out)
+    info.update( dims      = {d: int(n) for d, n in ds.sizes.items()},
+                 coords    = list(ds.coords),
+                 data_vars = list(ds.data_vars),
+                 stats     = {v: {'n_nan': int(s['n_nan']), 'min': _num(s['min']), 'max': _num(s['max']), 'sum': _num(s['sum'])}
+                              for v, s in stats.items()},
+                 size      = st.st_size,
+                 mtime_ns  = st.st_mtime_ns,
+                 written   = datetime.datetime.now().isoformat(timespec='seconds') )
+    return info
+
+
+def _write_json(file_out, info):
+    tmp = f"{sidecar_path(file_out)}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(info, f, indent=1)
+    os.replace(tmp, sidecar_path(file_out))
+
+
+def write(ds, file_out, encoding=None, **kwargs):
+    """ ds.to_netcdf(file_out) + sidecar, the statistics computed in the same graph as the write"""
+    store = ds.to_netcdf(file_out, encoding=encoding, compute=False, **kwargs)
+    _, stats = conservation.compute(store, _stats(ds))   # (+ the pending mass accounts, same compute)
+    info = _describe(ds, stats, file_out)
+    _write_json(file_out, info)
+    return info
+
+
+def from_file(file_out):
+    """ (re)write the sidecar of an existing file"""
+    with icar_io.open_file(file_out, chunks='aligned') as ds:
+        stats, = dask.compute(_stats(ds))
+        info = _describe(ds, stats, file_out)
+    _write_json(file_out, info)
+    return info
+
+
+def read(file_out):
+    """ the sidecar of file_out, None if missing or stale (size / mtime of file_out changed)"""
+    try:
+        with open(sidecar_path(file_out)) as f:
+            info = json.load(f)
+        st = os.stat(file_out)
+    except (OSError, ValueError):
+        return None
+    if info.get('size')!=st.st_size or info.get('mtime_ns')!=st.st_mtime_ns:
+        return None
+    return info
+
+
+def _backfill(file_out):
+    if read(file_out) is not None:
+        return file_out, 'ok'
+    try:
+        from_file(file_out)
+        return file_out, 'written'
+    except (OSError, RuntimeError, ValueError) as e:
+        return file_out, f"error: {e}"
+
+
+###########################
+#     MAIN
+###########################
+if __name__=="__main__":
+
+    args  = process_command_line()
+    files = sorted(glob.glob(args.files))
+    print(f"   {len(files)} files")
+    with mp.Pool(args.nproc) as pool:
+        for file_out, result in pool.imap_unordered(_backfill, files):
+            if result!='ok':
+                print(f"   {file_out}: {result}")
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# coding: utf-8
+######################################################################################################
+#
+# Local cache for intermediate (stage) results, e.g. the corrected monthly precip_dt:
+#    - the key is a sha256 of the fingerprints (path, size, mtime) of the input files + the stage's
+#      parameters (neg_thrsh, vars_to_correct, ...), so a rerun with only different remove_cp
+#      settings reuses the corrected data, and a changed input file or parameter is a cache miss
+#    - entries are netcdf files in cache_dir/<2 chars of key>/<key>.nc, written atomically
+#      (tmp file + rename), so several jobs can share one cache_dir
+#    - the cache is bounded by max_bytes; the least recently used entries are removed first
+#
+# Usage:
+#   - set cache_dir in main_3hr_from3hinput.py / main_24hr_from3hinput.py / main_3hr_24hr_from3hinput.py
+#   - stand-alone to list / trim a cache:  python stage_cache.py cache_dir [--max_gb 50]
+#
+######################################################################################################
+
+import argparse
+import numpy as np
+import hashlib
+import json
+import glob
+import os
+import time
+
+import icar_io
+import conservation
+
+
+# bump when the cached data of a stage changes without a parameter change (new correction code etc.):
+cache_version = 1
+
+max_bytes_default = 50 * 1024**3
+
+
+def process_command_line():
+    '''Parse the commandline'''
+    parser = argparse.ArgumentParser(description='list / trim a stage cache')
+    parser.add_argument('cache_dir',             help='cache directory')
+    parser.add_argument('--max_gb', default=None, help='remove least recently used entries until the cache is below max_gb')
+
+    return parser.parse_args()
+
+
+##############################################################################################
+#      keys                                                                                   #
+##############################################################################################
+def fingerprint(files):
+    """ (path, size, mtime) of every input file, None for missing files / no file"""
+    fp = []
+    for f in files:
+        if f is None or not os.path.exists(f):
+            fp.append([f, None, None])
+        else:
+            st = os.stat(f)
+            fp.append([os.path.abspath(f), st.st_size, st.st_mtime_ns])
+    return fp
+
+
+def _jsonable(x):
+    """ parameters as json (dicts sorted, numpy scalars as python)"""
+    if isinstance(x, dict):
+        return {str(k): _jsonable(v) for k, v in sorted(x.items(), key=lambda kv: str(kv[0]))}
+    if isinstance(x, (list, tuple)):
+        return [_jsonable(v) for v in x]
+    if isinstance(x, np.generic):
+        return x.item()
+    return x
+
+
+def cache_key(stage, files, params):
+    """ sha256 of stage name, input fingerprints and stage parameters"""
+    desc = {'version': cache_version,
+            'stage'  : stage,
+            'files'  : fingerprint(files),
+            'params' : _jsonable(params)}
+    return hashlib.sha256( json.dumps(desc, sort_keys=True, default=str).encode() ).hexdigest()
+
+
+##############################################################################################
+#      cache                                                                                  #
+##############################################################################################
+class StageCache:
+    """ size bounded (LRU) cache of netcdf stage results """
+
+    def __init__(self, cache_dir, max_bytes=max_bytes_default):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key):
+        return f"{self.cache_dir}/{key[:2]}/{key}.nc"
+
+    def get(self, key):
+        """ the cached dataset (lazy) or None"""
+        f = self.path(key)
+        if not os.path.exists(f):
+            return None
+        try:
+            ds = icar_io.open_file(f, chunks={})
+        except (OSError, ValueError):
+            print(f"   ! could not open cache entry {f}, ignoring it")
+            return None
+        os.utime(f)   # mtime = last use (LRU)
+        print(f"   stage cache hit: {key[:12]}")
+        return ds
+
+    def put(self, key, ds):
+        """ write ds (computes it, with the pending mass accounts of conservation.py, so those do not
+            re-read the input), evict old entries, return the dataset read back from the cache"""
+        f = self.path(key)
+        os.makedirs(os.path.dirname(f), exist_ok=True)
+        tmp = f"{f}.{os.getpid()}.tmp"
+        t0 = time.time()
+        conservation.compute( ds.to_netcdf(tmp, compute=False) )
+        os.replace(tmp, f)
+        print(f"   stage cache write: {key[:12]} ({np.round(os.path.getsize(f)/1024**2,1)} MB, {np.round(time.time()-t0,1)} sec)")
+        self.evict(keep=f)
+        return self.get(key)
+
+    def entries(self):
+        """ [(mtime, size, path)] of all entries, oldest first"""
+        out = []
+        for f in glob.glob(f"{self.cache_dir}/*/*.nc"):
+            try:
+                st = os.stat(f)
+            except FileNotFoundError:   # removed by another job
+                continue
+            out.append((st.st_mtime, st.st_size, f))
+        return sorted(out)
+
+    def evict(self, keep=None, max_bytes=None):
+        """ remove the least recently used entries until the cache is below max_bytes"""
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = self.entries()
+        total   = sum(e[1] for e in entries)
+        for mtime, size, f in entries:
+            if total <= max_bytes: break
+            if f == keep: continue
+            try:
+                os.remove(f)
+                total -= size
+                print(f"   stage cache: removed {f.split('/')[-1][:12]} ({np.round(size/1024**2,1)} MB)")
+            except FileNotFoundError:
+                pass
+        return total
+
+    def cached(self, stage, files, params, compute):
+        """ cached result of compute() for these input files and parameters, None (not cached) if
+            compute() returns None (e.g. input that could not be opened)"""
+        key = cache_key(stage, files, params)
+        ds  = self.get(key)
+        if ds is None:
+            ds = compute()
+            if ds is None:
+                return None
+            ds = self.put(key, ds)
+        return ds
+
+
+def cached(cache_dir, stage, files, params, compute, max_bytes=max_bytes_default):
+    """ compute() through the cache in cache_dir, or just compute() if cache_dir is None"""
+    if cache_dir is None:
+        return compute()
+    return StageCache(cache_dir, max_bytes).cached(stage, files, params, compute)
+
+
+###########################
+#     MAIN
+###########################
+if __name__=="__main__":
+
+    args  = process_command_line()
+    cache = StageCache(args.cache_dir)
+
+    entries = cache.entries()
+    print(f"   {len(entries)} entries, {np.round(sum(e[1] for e in entries)/1024**3,2)} GB in {args.cache_dir}")
+    for mtime, size, f in entries:
+        print(f"      {time.strftime('%Y-%m-%d %H:%M', time.localtime(mtime))}   {np.round(size/1024**2,1):>10} MB   {f.split('/')[-1]}")
+
+    if args.max_gb is not None:
+        total = cache.evict(max_bytes=float(args.max_gb)*1024**3)
+        print(f"   trimmed to {np.round(total/1024**3,2)} GB")
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# coding: utf-8
+######################################################################################################
+#
+# Node-local staging of the inputs and outputs of one job (model / scenario / year):
+#    - copies the year's input files to stage_dir (node-local disk, $TMPDIR or /dev/shm) with
+#      parallel streams, so the stages read locally iso many small reads on glade
+#    - the GCM cp files are staged as the slice of the year only (the daily cp files are 1950-2099)
+#    - paths are mirrored below stage_dir (stage_dir + absolute path), so 'CMIP5' / 'CMIP6' and the
+#      model_scenario directories stay in the path and the drivers' path logic works unchanged
+#    - copies keep their size and mtime (the glitch index stays valid)
+#    - outputs are written below stage_dir and moved back (copy to tmp + rename) by a background
+#      thread while the next month is processed; finish() waits for the moves and cleans up
+#    - after an error (finish(complete=False)) only the outputs put() after their write are moved
+#      back; the rest may be cut off and is left in stage_dir (reported), never over a good output
+#
+# Usage:
+#   - set stage_dir in the main_*.py drivers
+#   - stand-alone to test the copy speed:  python staging.py stage_dir "files_glob" [--nthreads 8]
+#
+######################################################################################################
+
+import argparse
+import numpy as np
+import concurrent.futures
+import threading
+import queue
+import tempfile
+import shutil
+import glob
+import time
+import os
+
+import time_axis
+import icar_io
+
+
+def process_command_line():
+    '''Parse the commandline'''
+    parser = argparse.ArgumentParser(description='copy files to a node-local directory (copy speed test)')
+    parser.add_argument('stage_dir',                   help='local directory')
+    parser.add_argument('files',      nargs='+',       help='file globs (quoted)')
+    parser.add_argument('--nthreads', default=8, type=int, help='parallel copies')
+
+    return parser.parse_args()
+
+
+def _copy(src, dst):
+    """ copy src to dst (with mtime); returns bytes copied"""
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    shutil.copy2(src, dst)
+    return os.path.getsize(dst)
+
+
+def _move(src, dst):
+    """ move src to dst on another filesystem: copy to dst tmp + rename, then remove src"""
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = f"{dst}.{os.getpid()}.tmp"
+    shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+    os.remove(src)
+
+
+class Stage:
+    """ local copies of a job's inputs, and outputs moved back in the background """
+
+    def __init__(self, stage_dir, nthreads=8):
+        # own subdirectory, several jobs can run on one node:
+        os.makedirs(stage_dir, exist_ok=True)
+        self.stage_dir = tempfile.mkdtemp(prefix='stage_', dir=os.path.abspath(stage_dir))
+        self.nthreads  = nthreads
+        self.outputs   = []            # (local, remote) output roots
+        self._moves    = queue.Queue()
+        self._mover    = None
+        self._queued   = set()
+        self._errors   = []
+
+    def local(self, path):
+        """ the local (mirrored) path of path (a file, directory or glob)"""
+        if path is None:
+            return None
+        return f"{self.stage_dir}{os.path.abspath(path)}"
+
+    def remote(self, path):
+        """ the original path of a local path"""
+        return os.path.abspath(path)[len(self.stage_dir):]
+
+    def localize(self, paths):
+        """ a dict / set of original paths (e.g. the quarantine list) with the local paths added"""
+        if isinstance(paths, dict):
+            return {**paths, **{self.local(p): v for p, v in paths.items()}}
+        return set(paths) | set(self.local(p) for p in paths)
+
+    # ________ inputs ________
+    def stage_in(self, patterns):
+        """ copy the files matching the globs to the local disk, nthreads in parallel"""
+        t0 = time.time()
+        files = sorted(set(f for p in patterns for f in glob.glob(p, recursive=True)))
+        with concurrent.futures.ThreadPoolExecutor(self.nthreads) as pool:
+            n_bytes = sum(pool.map(lambda f: _copy(f, self.local(f)), files))
+        dt = max(time.time()-t0, 1e-3)
+        print(f"   staged {len(files)} files ({np.round(n_bytes/1024**3,2)} GB copied, "
+              f"{np.round(n_bytes/1024**2/dt,1)} MB/s) to {self.stage_dir}")
+        return files
+
+    def stage_cp(self, files, year):
+        """ stage the GCM cp files as the slice of year only (full copy if the time axis can not be read)"""
+        t0 = time.time()
+        for f in files:
+            dst = self.local(f)
+            if os.path.exists(dst):
+                continue
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            tmp = f"{dst}.{os.getpid()}.tmp"
+            try:
+                with icar_io.open_file(f, decode_times=False) as ds:
+                    t_slice = time_axis.TimeAxis.from_raw(ds.time).year_slice(year)
+                    ds.isel(time=t_slice).load().to_netcdf(tmp)
+            except (KeyError, ValueError) as e:
+                print(f"   ! could not slice {f} ({e}), copying the whole file")
+                shutil.copy2(f, tmp)
+            os.replace(tmp, dst)
+        print(f"   staged {len(files)} GCM cp files ({year}) in {np.round(time.time()-t0,1)} sec")
+
+    # ________ outputs ________
+    def output(self, path_out):
+        """ local directory to write the outputs to, moved back to path_out by put() / finish()"""
+        self.outputs.append( (self.local(path_out), os.path.abspath(path_out)) )
+        return self.local(path_out)
+
+    def put(self, file_local):
+        """ move a finished local output file back (in the background)"""
+        if file_local in self._queued:
+            return
+        self._queued.add(file_local)
+        if self._mover is None:
+            self._mover = threading.Thread(target=self._move_worker, daemon=True)
+            self._mover.start()
+        self._moves.put(file_local)
+
+    def _move_worker(self):
+        while True:
+            f = self._moves.get()
+            if f is None:
+                return
+            try:
+                t0 = time.time()
+                _move(f, self.remote(f))
+                print(f"   moved back {os.path.basename(f)} in {np.round(time.time()-t0,1)} sec")
+            except OSError as e:
+                print(f"   ! could not move back {f}: {e}")
+                self._errors.append(f)
+
+    def finish(self, complete=True, cleanup=True):
+        """ move back the remaining outputs, wait for the moves and remove the staged inputs.
+            complete=False (the run stopped on an error): only the outputs already put() (written
+            completely) are moved back, the others may be cut off and stay in stage_dir"""
+        left = []
+        for local, remote in self.outputs:
+            for root, dirs, files in os.walk(local):
+                for f in files:
+                    if f"{root}/{f}" in self._queued:
+                        continue
+                    if complete and not f.endswith('.tmp'):
+                        self.put(f"{root}/{f}")
+                    elif not complete:
+                        left.append(f"{root}/{f}")
+        if self._mover is not None:
+            self._moves.put(None)
+            self._mover.join()
+            self._mover = None
+        for f in left:
+            print(f"   ! not moved back (run not complete, may be incomplete): {f}")
+        if len(self._errors) > 0:
+            print(f"   ! {len(self._errors)} outputs could not be moved back, they are still in {self.stage_dir}")
+        elif len(left) > 0:
+            print(f"   ! {len(left)} outputs of the incomplete run are still in {self.stage_dir}")
+        elif cleanup:
+            shutil.rmtree(self.stage_dir, ignore_errors=True)
+
+
+###########################
+#     MAIN
+###########################
+if __name__=="__main__":
+
+    args  = process_command_line()
+    stage = Stage(args.stage_dir, nthreads=args.nthreads)
+    stage.stage_in(args.files)
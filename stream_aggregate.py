@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+# coding: utf-8
+######################################################################################################
+#
+# Streaming (constant memory) version of fix_neg_pcp + aggregate_in_time for 1h ICAR day files:
+#    - ICAR day files are read one at a time, in time order
+#    - cumulative variables are differenced on the fly (the last timestep of a day is kept
+#      until the first timestep of the next day is read), negative timesteps (restart errors)
+#      are set to NaN and linearly interpolated, exactly like fix_neg_pcp.correct_var
+#    - every output window (3hr or 24hr) keeps running accumulators (sum, min, max, mean,
+#      first/last value) per variable, in float32 with compensated sums (see precision.py)
+#    - completed windows are flushed to the output file after every day file
+#
+#   peak memory is about one day of hourly data, whatever the length of the month/year.
+#
+# Usage:
+#   - called from main_3hr.py / main_24hr.py (streaming=True)
+#
+######################################################################################################
+
+import xarray as xr
+import numpy as np
+import glob
+import os
+import datetime
+import netCDF4
+
+import fix_neg_pcp as fix
+import precision
+import time_axis
+import icar_io
+import output_registry
+
+
+time_units = "days since 1900-01-01"   # time encoding of the output files (as in main_Xhr.py)
+                                       # (same reference as time_axis.epoch: hours/24 when appending)
+
+
+##############################################################################################
+#      output products: {output var: (input vars, reduction, derivation of inputs)}          #
+#      (output_registry.py, as aggregate_in_time.make_3h_monthly_file / make_yearly_24h_file) #
+##############################################################################################
+def product_attrs(name, ds_in, freq_hours, inputs):
+    """ attributes of output variable name, based on the (first) input dataset """
+    return output_registry.attrs(name, ds_in, freq_hours, inputs=inputs)
+
+
+##############################################################################################
+#      running correction of cumulative variables (day by day)                               #
+##############################################################################################
+class StreamCorrector:
+    """ Turns cumulative variables into timestep (_dt) variables block by block, and repairs the
+        timesteps where any pixel is below neg_thrsh (linear interpolation in time). Timesteps are
+        only released once their right-hand neighbour needed for the diff/interpolation was read. """
+
+    def __init__(self, vars_to_correct, neg_thrsh=fix.neg_thrsh):
+        self.vars_to_correct = vars_to_correct
+        self.neg_thrsh       = neg_thrsh
+        self.prev      = None   # last timestep read (its _dt needs the next timestep)
+        self.held      = None   # timesteps held back because they end in a bad _dt timestep
+        self.last_good = {}     # last released good _dt row per variable (left anchor)
+        self.n_bad     = {v: 0 for v in vars_to_correct.values()}
+
+    def _diff(self, hours, data):
+        """ prepend self.prev, return the rows whose _dt can be calculated """
+        if self.prev is not None:
+            hours = np.concatenate([self.prev[0], hours])
+            data  = {k: np.concatenate([self.prev[1][k], a]) for k, a in data.items()}
+
+        self.prev = (hours[-1:], {k: a[-1:] for k, a in data.items()})
+        if len(hours) < 2:
+            return hours[:0], {k: a[:0] for k, a in data.items()}
+
+        out = {k: a[:-1] for k, a in data.items() if k not in self.vars_to_correct}
+        for varname, varname_dt in self.vars_to_correct.items():
+            if varname in data:
+                out[varname_dt] = np.diff(data[varname], axis=0)
+        return hours[:-1], out
+
+    def _repair(self, hours, data, final=False):
+        """ NaN + interpolate bad timesteps, hold back a trailing run of bad timesteps """
+        if self.held is not None:
+            hours = np.concatenate([self.held[0], hours])
+            data  = {k: np.concatenate([self.held[1][k], a]) for k, a in data.items()}
+            self.held = None
+
+        n_release = len(hours)
+        for v in self.vars_to_correct.values():
+            if v not in data: continue
+            bad = (data[v] < self.neg_thrsh).reshape(len(hours), -1).any(axis=1)
+            if not final and bad.any() and bad[-1]:
+                # trailing bad run: wait for the next good timestep
+                n_release = min(n_release, len(bad) - np.argmin(bad[::-1]) if not bad.all() else 0)
+
+        if n_release < len(hours):
+            # keep the trailing bad run unrepaired, it is repaired once its right-hand anchor is read
+            self.held = (hours[n_release:], {k: a[n_release:].copy() for k, a in data.items()})
+
+        # release rows [0:n_release], interpolate over the full block so the anchors are known
+        for v in self.vars_to_correct.values():
+            if v not in data: continue
+            a   = data[v]
+            bad = (a < self.neg_thrsh).reshape(len(hours), -1).any(axis=1)
+            if bad.any():
+                for i in np.where(bad[:n_release])[0]:
+                    print( '      ', v, ' negative timestep at hour', hours[i], '   ', np.round(np.nanmin(a[i]),2) )
+                self.n_bad[v] += int(bad[:n_release].sum())
+            # NaN + interpolate the bad timesteps and set small negative values to 0, in place:
+            fix.repair_rows(a, bad, left=self.last_good.get(v))
+            good = np.where(~bad[:n_release])[0]
+            if len(good) > 0:
+                self.last_good[v] = a[good[-1]].copy()
+
+        return hours[:n_release], {k: a[:n_release] for k, a in data.items()}
+
+    def push(self, hours, data):
+        """ add a block of timesteps (data is dict of (time, lat_y, lon_x) arrays), return ready timesteps"""
+        hours, data = self._diff(hours, data)
+        return self._repair(hours, data)
+
+    def finish(self, hours_next=None, data_next=None):
+        """ flush, using the first timestep(s) of the next month/year if available"""
+        if hours_next is None:
+            if self.held is None:
+                return None, None
+            hours, data = self.held[0][:0], {k: a[:0] for k, a in self.held[1].items()}
+            return self._repair(hours, data, final=True)
+
+        t_end = hours_next[0]
+        hours, data = self._diff(hours_next, data_next)
+        hours, data = self._repair(hours, data, final=True)
+        keep = hours < t_end
+        return hours[keep], {k: a[keep] for k, a in data.items()}
+
+
+##############################################################################################
+#      running accumulators per output window                                               #
+##############################################################################################
+class WindowAccumulator:
+    """ keeps a running sum/min/max/mean/first/last per output variable for the current window
+        (freq_hours long), and returns the completed windows """
+
+    def __init__(self, products, freq_hours):
+        self.products   = products
+        self.freq_hours = freq_hours
+        self.key        = None
+        self.state      = {}
+        self.comp       = {}
+        self.ref        = {}
+        self.nvalid     = {}
+
+    def _start(self, key):
+        self.key    = key
+        self.state  = {}
+        self.comp   = {}   # compensation of the (float32) running sums, see precision.kahan_add
+        self.ref    = {}   # float64 running sums (precision.validate only)
+        self.nvalid = {}   # nr of non-NaN values per pixel (mean skips NaNs, like resample().mean())
+
+    def _window(self):
+        out = {}
+        for name, (inputs, reduction, derive) in self.products.items():
+            if name not in self.state: continue
+            dtype = precision.policy_dtype(name)
+            if reduction in ['sum', 'mean']:
+                total = self.state[name] + self.comp[name]
+                if precision.validate:
+                    precision.report_error(name, total, self.ref[name])
+            if reduction=='mean':
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    out[name] = np.where(self.nvalid[name]>0, total / self.nvalid[name], np.nan).astype(dtype)
+            elif reduction=='sum':
+                out[name] = total.astype(dtype)
+            else:
+                out[name] = self.state[name].astype(dtype)
+        return self.key, out
+
+    def add(self, hours, data):
+        """ accumulate timesteps, return list of completed (window_start_hour, {var: 2D array})"""
+        completed = []
+        for i, h in enumerate(hours):
+            key = (h // self.freq_hours) * self.freq_hours
+            if self.key is not None and key != self.key:
+                completed.append(self._window())
+                self._start(key)
+            elif self.key is None:
+                self._start(key)
+
+            for name, (inputs, reduction, derive) in self.products.items():
+                if any(v not in data for v in inputs): continue
+                x = data[inputs[0]][i] if derive is None else derive(*[data[v][i] for v in inputs])
+                if reduction in ['sum', 'mean']:
+                    # NaNs are skipped, as in resample().sum() / .mean()
+                    valid = ~np.isnan(x)
+                    x = np.where(valid, x, 0)
+                if name not in self.state:
+                    self.state[name] = x.astype(precision.policy_dtype(name))
+                    if reduction in ['sum', 'mean']:
+                        self.comp[name] = np.zeros_like(self.state[name])
+                        if precision.validate: self.ref[name] = x.astype('float64')
+                    if reduction=='mean': self.nvalid[name] = valid.astype('int32')
+                elif reduction in ['sum', 'mean']:
+                    self.state[name], self.comp[name] = precision.kahan_add(self.state[name], self.comp[name],
+                                                                            x.astype(self.state[name].dtype))
+                    if precision.validate: self.ref[name] = self.ref[name] + x
+                    if reduction=='mean': self.nvalid[name] += valid
+                elif reduction=='min':
+                    self.state[name] = np.fmin(self.state[name], x)
+                elif reduction=='max':
+                    self.state[name] = np.fmax(self.state[name], x)
+                elif reduction=='last':
+                    self.state[name] = x.copy()
+                # 'instantaneous' / 'first': keep what is there
+        return completed
+
+    def close(self):
+        """ return the last (possibly incomplete) window"""
+        if self.key is None: return []
+        return [self._window()]
+
+
+##############################################################################################
+#      output:  append completed windows to a netcdf file with unlimited time dimension      #
+##############################################################################################
+class NetCDFAppender:
+    """ writes the first windows with xarray (attrs, coords, encoding), appends the rest with netCDF4"""
+
+    def __init__(self, file_out, template, products, freq_hours, calendar):
+        self.file_out   = file_out
+        self.template   = template     # first input dataset (coords/attrs)
+        self.products   = products
+        self.freq_hours = freq_hours
+        self.calendar   = calendar
+        self.n_written  = 0
+
+    def to_dataset(self, windows):
+        times = time_axis.TimeAxis([k for k, _ in windows], self.calendar).decode()
+        ds = xr.Dataset(coords={'time': times})
+        for c in ['lat', 'lon']:
+            if c in self.template.coords: ds.coords[c] = self.template[c]
+        for name in self.products:
+            if name not in windows[0][1]: continue
+            ds[name] = (('time', 'lat_y', 'lon_x'), np.stack([w[name] for _, w in windows]))
+            ds[name].attrs = product_attrs(name, self.template, self.freq_hours, self.products[name][0])
+        ds.attrs = dict(self.template.attrs)
+        res = '3 hourly' if self.freq_hours==3 else 'daily'
+        ds.attrs['history'] = ds.attrs.get('history', '') + f', modified to {res} data (streaming) on '+str(datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
+        return ds
+
+    def write(self, windows):
+        if len(windows)==0: return
+        if self.n_written==0:
+            ds = self.to_dataset(windows)
+            encoding = {'time': {'units': time_units, 'calendar': self.calendar, 'dtype': 'float64'}}
+            for v in ds.data_vars: encoding[v] = {'dtype': 'float32'}
+            ds.to_netcdf(self.file_out, unlimited_dims=['time'], encoding=encoding)
+        else:
+            with netCDF4.Dataset(self.file_out, 'a') as nc:
+                n = len(nc.dimensions['time'])
+                k = len(windows)
+                nc['time'][n:n+k] = np.array([w[0] for w in windows]) / 24.   # hours -> days since 1900-01-01
+                for name in self.products:
+                    if name not in windows[0][1]: continue
+                    nc[name][n:n+k, :, :] = np.stack([w[1][name] for w in windows])
+        self.n_written += len(windows)
+
+    def discard(self):
+        """ remove the partly written output file"""
+        if self.n_written > 0 and os.path.exists(self.file_out):
+            os.remove(self.file_out)
+            print(f"   removed the incomplete {self.file_out}")
+
+
+class DatasetCollector(NetCDFAppender):
+    """ same as NetCDFAppender, but keeps the windows in memory (e.g. to remove GCM cp before writing)"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(None, *args, **kwargs)
+        self.windows = []
+
+    def write(self, windows):
+        self.windows.extend(windows)
+        self.n_written += len(windows)
+
+    def discard(self):
+        self.windows = []
+
+    def result(self):
+        return self.to_dataset(self.windows) if len(self.windows)>0 else None
+
+
+##############################################################################################
+#      driver:  stream day files -> corrected -> aggregated -> output                        #
+##############################################################################################
+def _read_block(file_in, needed, n=None):
+    """ read (the first n timesteps of) the needed variables of one day file"""
+    with icar_io.open_file(file_in) as ds:
+        if n is not None: ds = ds.isel(time=slice(0, n))
+        ds = ds[[v for v in needed if v in ds.data_vars]].load()
+    return ds
+
+
+def stream_aggregate(files_in, nextfile_in, vars_to_correct, freq_hours,
+                     file_out=None, neg_thrsh=fix.neg_thrsh):
+    """ Aggregate 1h ICAR day files (in time order) to freq_hours (3 or 24) windows with constant memory.
+        files_in is a glob string or list of files. If file_out is given the windows are appended to it
+        after every day file and None is returned, otherwise the aggregated dataset is returned.
+        A file that cannot be read raises (OSError / ValueError) and the partly written file_out is removed."""
+
+    files = sorted(glob.glob(files_in)) if isinstance(files_in, str) else sorted(files_in)
+    if len(files)==0:
+        print(f"   no files found for {files_in}")
+        return
+
+    with icar_io.open_file(files[0]) as ds0:
+        template = ds0.isel(time=0).load()
+        calendar = ds0.time.encoding.get('calendar', 'standard')
+        data_vars = list(ds0.data_vars)
+
+    dt_vars  = [vars_to_correct.get(v, v) for v in data_vars]
+    products = output_registry.products(freq_hours, dt_vars)
+    needed = set(vars_to_correct.keys())
+    for inputs, _, _ in products.values():
+        needed.update([k for k, v in vars_to_correct.items() if v in inputs] + inputs)
+    needed = sorted(v for v in needed if v in data_vars)
+
+    print(f"   streaming {len(files)} files to {freq_hours}hr, products: {list(products)}")
+
+    corrector   = StreamCorrector({k: v for k, v in vars_to_correct.items() if k in data_vars}, neg_thrsh=neg_thrsh)
+    accumulator = WindowAccumulator(products, freq_hours)
+    if file_out is not None:
+        sink = NetCDFAppender(file_out, template, products, freq_hours, calendar)
+    else:
+        sink = DatasetCollector(template, products, freq_hours, calendar)
+
+    def to_arrays(ds):
+        hours = time_axis.TimeAxis.from_values(ds.time.values, calendar).hours
+        return hours, {v: ds[v].values for v in ds.data_vars}
+
+    n_steps = 0
+    try:
+        for f in files:
+            try:
+                ds = _read_block(f, needed)
+            except (OSError, ValueError) as e:
+                print('\n   !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!')
+                print(  '   !!! Error in file: ',f,' !!!', e)
+                print(  '   !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!! \n')
+                raise
+            n_steps += len(ds.time)
+            hours, data = corrector.push(*to_arrays(ds))
+            sink.write( accumulator.add(hours, data) )
+
+        # last timestep(s): diff with the first timesteps of next month/year
+        if nextfile_in is not None:
+            hours, data = corrector.finish(*to_arrays(_read_block(nextfile_in, needed, n=2)))
+        else:
+            hours, data = corrector.finish()
+        if hours is not None:
+            sink.write( accumulator.add(hours, data) )
+        sink.write( accumulator.close() )
+    except BaseException:
+        sink.discard()   # no truncated output that looks complete
+        raise
+
+    print(f"   {n_steps} input timesteps -> {sink.n_written} windows, negative timesteps repaired: {corrector.n_bad}")
+
+    if file_out is None:
+        return sink.result()
@@ -46,6 +46,7 @@ remove_cp=True                    # in case ICAR was run with rain_var=cp !
 
 dt=daily   # "daily" or "3hr"
 # dt=3hr   # "daily" or "3hr"
+# dt=both  # 3hr AND daily from one read of the 3h input (Tmax/Tmin/Wind from 3hr data!)
 
 if [[ "${CMIP}" == "CMIP5" ]]; then
 
@@ -95,6 +96,16 @@ elif [[ "${CMIP}" == "CMIP6" ]]; then
     # allScens=( ssp370_2004 ssp370_2049 ssp585_2004 ssp585_2049 )
 fi
 
+# ____________   work queue mode (optional, see work_queue.py): ______________
+# instead of year = PBS_ARRAY_INDEX + start_year, every array job runs a worker that claims tasks
+# (model, scen, year) from queue_dir until none are left; failed / killed tasks are retried.
+# fill the queue once with:  python work_queue.py init $queue_dir "python -u main_3hr_from3hinput.py ... {year} {model} {scen} ..." --models .. --scenarios .. --years ..
+# queue_dir=/glade/derecho/scratch/bkruyt/queue_${dt}
+if [[ -n "${queue_dir}" ]]; then
+    python -u work_queue.py worker $queue_dir
+    exit 0
+fi
+
 #_______________ launch the python script _____________
 for model in ${allModels[@]}; do
 for scen in ${allScens[@]}; do
@@ -134,6 +145,11 @@ for scen in ${allScens[@]}; do
         mkdir -p job_output_3hr_4/${model}_${scen}
         python -u main_3hr_from3hinput.py  $path_in $path_out $year $model  $scen $remove_cp $GCM_cp_path $CMIP >& job_output_3hr_4/${model}_${scen}/${year} & pid1=$!
         wait $pid1  # wait for this process to finish before going to next model/scen
+
+    # # # # # # Launch the combined 3h + 24h script (corrects every month only once):
+    elif [[ "${dt}" == "both" ]]; then
+        mkdir -p job_output_both/${model}_${scen}
+        python -u main_3hr_24hr_from3hinput.py  $path_in $path_out $year $model  $scen $remove_cp $GCM_cp_path $CMIP >& job_output_both/${model}_${scen}/${year}
     fi
 
     echo " "
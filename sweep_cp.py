@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# coding: utf-8
+######################################################################################################
+#
+# Parameter sweep for the GCM cp removal (and the neg pcp threshold), sharing a single read:
+#    - every month of (3h) ICAR input is read once and kept in memory
+#    - it is corrected (fix_neg_pcp) once per distinct neg_thrsh in the sweep
+#    - the GCM cp is opened once per month (3hr) / year (24hr)
+#    - every parameter set then only subtracts cp * units_conv from the shared corrected precip, and
+#      writes its output (optional) and its summary statistics (one csv for the whole sweep)
+#
+#   sweep_file is a json list of parameter sets; missing keys get the defaults of the drivers:
+#       [ {"name": "cmip6_3h",  "units_conv": 10800},
+#         {"name": "cmip5_3h",  "units_conv": 2700},
+#         {"name": "thrsh_001", "units_conv": 10800, "neg_thrsh": -0.001} ]
+#       keys: name, units_conv (default: remove_cp.default_units_conv), neg_thrsh (default: fix_neg_pcp.neg_thrsh),
+#             vars_to_drop (default: None, only used when writing output)
+#
+# Usage:
+#   python sweep_cp.py path_in path_out year model scenario GCM_cp_path CMIP dt sweep_file [--stats_only]
+#       dt: '3hr' (monthly 3hr output) or '24hr' (yearly daily output)
+#       output: path_out/sweep_cp_{model}_{scen}_{year}_{dt}.csv  (+ path_out/{name}/... unless --stats_only)
+#
+######################################################################################################
+
+import argparse
+import xarray as xr
+import numpy as np
+import pandas as pd
+import glob
+import json
+import os
+import time
+
+import aggregate_in_time as change_temporal_res
+import fix_neg_pcp as fix
+import remove_cp as cp
+import time_axis
+import icar_io
+
+
+vars_to_correct_3hr = {'precipitation'   : 'precip_dt',
+                       'snowfall'        : 'snowfall_dt',
+                       'cu_precipitation': 'cu_precip_dt',
+                       'graupel'         : 'graupel_dt'
+                       }
+
+vars_to_correct_24hr = {'precipitation'  : 'precip_dt' }
+
+
+def process_command_line():
+    '''Parse the commandline'''
+    parser = argparse.ArgumentParser(description='sweep over GCM cp removal parameters, reading the ICAR input once')
+    parser.add_argument('path_in',          help='path input files (3h, CMIP6: {path_in}/{model}_{scenario}, CMIP5: .../3hr)')
+    parser.add_argument('path_out',         help='path to write the sweep statistics (and outputs) to')
+    parser.add_argument('year',             help='year to process')
+    parser.add_argument('model',            help='model')
+    parser.add_argument('scenario',         help='scenario to process; one of hist, sspXXX_2004, sspXXX_2049')
+    parser.add_argument('GCM_cp_path',      help='path with the GCM cp on ICAR grid')
+    parser.add_argument('CMIP',             help='CMIP5 or CMIP6' )
+    parser.add_argument('dt',               help="'3hr' or '24hr'")
+    parser.add_argument('sweep_file',       help='json file with a list of parameter sets')
+    parser.add_argument('--stats_only',     action='store_true', help='only write the statistics, no output files')
+
+    return parser.parse_args()
+
+
+def read_sweep(sweep_file, GCM_path, dt):
+    """ list of parameter sets (dicts) with all keys filled in"""
+    with open(sweep_file) as f:
+        sets = json.load(f)
+    for i, p in enumerate(sets):
+        p.setdefault('name',         f"set{i}")
+        p.setdefault('neg_thrsh',    fix.neg_thrsh)
+        p.setdefault('vars_to_drop', None)
+        if p.get('units_conv', None) is None:
+            p['units_conv'] = cp.default_units_conv(GCM_path, dt)
+    return sets
+
+
+##############################################################################################
+#      read once, correct once per neg_thrsh                                                  #
+##############################################################################################
+def read_month(path_m, nextmonth_file_in, vars_to_correct):
+    """ one month of ICAR output (+ first 2 timesteps of next month) in memory"""
+    ds = icar_io.open_icar(path_m).load()
+    ds_next = None
+    if nextmonth_file_in is not None:
+        ds_next = icar_io.open_file(nextmonth_file_in)[list(vars_to_correct)].isel(time=slice(0, 2)).load()
+    return ds, ds_next
+
+
+def correct_month(ds, ds_next, vars_to_correct, neg_thrsh):
+    """ fix_neg_pcp on the in-memory month (ds is not modified), aggregated to 3hr if the input is 1h"""
+    ds_fxd = ds.copy()
+    for varname, varname_dt in vars_to_correct.items():
+        ds_fxd = fix.correct_var(ds_fxd, varname, varname_dt, ds_next, neg_thrsh=neg_thrsh)
+    if time_axis.TimeAxis.from_dataarray(ds.time).step_hours() < 3:
+        ds_fxd = change_temporal_res.make_3h_monthly_file( ds_fxd )
+    return ds_fxd.load()
+
+
+##############################################################################################
+#      per parameter set                                                                      #
+##############################################################################################
+def cp_stats(pcp_in, cp_sub, pcp_out, units_conv):
+    """ domain / period totals (mean over the grid) of the ICAR pcp, the cp removed and the result"""
+    cp_amount = (cp_sub * units_conv).values
+    pcp_in    = pcp_in.values
+    pcp_out   = pcp_out.values
+    n_t       = pcp_in.shape[0]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return {'pcp_in'      : np.nanmean(pcp_in)  * n_t,
+                'cp'          : np.nanmean(cp_amount) * n_t,
+                'pcp_out'     : np.nanmean(pcp_out) * n_t,
+                'removed_frac': 1 - np.nansum(pcp_out) / np.nansum(pcp_in),
+                'clipped'     : np.nanmean( np.maximum(cp_amount - pcp_in, 0) ) * n_t,   # cp that could not be removed (pcp_out set to 0)
+                'zero_frac'   : np.mean( (pcp_out==0) & (pcp_in>0) ),                    # wet ICAR values that became dry
+                'max_out'     : np.nanmax(pcp_out)
+                }
+
+
+def apply_set(ds, precip_var, cp_sub, p):
+    """ the output dataset of one parameter set (ds is not modified), and its statistics"""
+    pcp_out = cp.subtract_cp(ds[precip_var], cp_sub, p['units_conv'])
+    stats   = cp_stats(ds[precip_var], cp_sub, pcp_out, p['units_conv'])
+
+    ds_out = ds.copy()
+    if p['vars_to_drop'] is not None:
+        ds_out = cp.drop_unwanted_vars(ds_out, vars_to_drop=p['vars_to_drop'])
+    ds_out[precip_var] = pcp_out
+    ds_out[precip_var].attrs = dict(ds[precip_var].attrs)
+    ds_out[precip_var].attrs["processing_note3"] = f"Removed GCM's convective precipitation from total precipitation (units_conv={p['units_conv']})"
+    return ds_out, stats
+
+
+def write_output(ds_out, file_out):
+    os.makedirs(os.path.dirname(file_out), exist_ok=True)
+    encoding = {'time': {'units': "days since 1900-01-01"}}
+    for v in ['precip_dt', 'cu_precip_dt', 'snowfall_dt', 'Prec']:
+        if v in ds_out.data_vars: encoding[v] = {'dtype': "float32"}
+    ds_out.to_netcdf(file_out, encoding=encoding)
+
+
+##############################################################################################
+#      sweep                                                                                  #
+##############################################################################################
+def sweep_cp(path_in, path_out, year, model, scenario, GCM_path, CMIP, dt, sets, stats_only=False):
+    """ run all parameter sets in sets over one year, return the statistics as DataFrame"""
+
+    base_path = f"{path_in}/{model}_{scenario}/3hr" if CMIP=="CMIP5" else f"{path_in}/{model}_{scenario}"
+    scen_out  = scenario[:-4] if (CMIP=="CMIP5" and scenario[-4:]=="/3hr") else scenario
+    scen      = scenario.split('_')[0]
+    vars_to_correct = vars_to_correct_3hr if dt=='3hr' else vars_to_correct_24hr
+    thresholds = sorted(set(p['neg_thrsh'] for p in sets))
+    print(f"   {len(sets)} parameter sets, {len(thresholds)} neg_thrsh value(s): {thresholds}")
+
+    rows  = []
+    daily = {thr: [] for thr in thresholds}   # 24hr: daily data per month, per neg_thrsh
+    for m in range(1, 13):
+        path_m = f"{base_path}/icar_*_{year}-{str(m).zfill(2)}*.nc"
+        if len(glob.glob(path_m))==0:
+            print(f"\n   no input files for {year}-{str(m).zfill(2)}")
+            continue
+        try:
+            if m<12:
+                nextmonth_file_in = sorted(glob.glob(f"{base_path}/icar_*_{year}-{str(m+1).zfill(2)}*.nc"))[0]
+            elif m==12:
+                nextmonth_file_in = sorted(glob.glob(f"{base_path}/icar_*_{str(int(year)+1)}-01*.nc"))[0]
+        except:
+                nextmonth_file_in=None  # should catch all fringe cases, ie 2005 in hist, 2050 in sspXXX_2004
+
+        # ______ read once ______
+        print(f"\n**********************************************")
+        print(f"   reading {year}-{str(m).zfill(2)}")
+        t0 = time.time()
+        ds, ds_next = read_month(path_m, nextmonth_file_in, vars_to_correct)
+        print(f"   reading took {np.round(time.time()-t0,1)} sec")
+        if dt=='3hr':
+            cp_sub = cp.open_3hr_cp(m, year, model, scen, GCM_path=GCM_path)
+
+        # ______ correct once per neg_thrsh ______
+        for thr in thresholds:
+            t0 = time.time()
+            ds_fxd = correct_month(ds, ds_next, vars_to_correct, thr)
+            print(f"   correcting (neg_thrsh={thr}) took {np.round(time.time()-t0,1)} sec")
+
+            if dt=='24hr':
+                daily[thr].append( change_temporal_res.make_yearly_24h_file(ds_fxd).load() )
+                continue
+
+            # ______ every parameter set from the shared arrays ______
+            for p in [p for p in sets if p['neg_thrsh']==thr]:
+                ds_out, stats = apply_set(ds_fxd, cp.get_precip_var(ds_fxd), cp_sub, p)
+                rows.append( dict(name=p['name'], units_conv=p['units_conv'], neg_thrsh=thr, year=year, month=m, **stats) )
+                if not stats_only:
+                    write_output(ds_out, f"{path_out}/{p['name']}/{model}_{scen_out}/3hr/icar_3hr_{model}_{scen_out.split('_')[0]}_{year}-{str(m).zfill(2)}.nc")
+        del ds, ds_next
+
+    if dt=='24hr':
+        cp_sub = cp.open_24hr_cp(year, model, scen, GCM_path=GCM_path)
+        for thr in thresholds:
+            if len(daily[thr])==0: continue
+            ds24hr = xr.concat(daily[thr], dim='time')
+            for p in [p for p in sets if p['neg_thrsh']==thr]:
+                ds_out, stats = apply_set(ds24hr, 'Prec', cp_sub, p)
+                rows.append( dict(name=p['name'], units_conv=p['units_conv'], neg_thrsh=thr, year=year, month=0, **stats) )
+                if not stats_only:
+                    write_output(ds_out, f"{path_out}/{p['name']}/{model}_{scen_out}/daily/icar_daily_{model}_{scen_out.split('_')[0]}_{year}.nc")
+
+    return pd.DataFrame(rows)
+
+
+###########################
+#     MAIN
+###########################
+if __name__=="__main__":
+
+    t00 = time.time()
+
+    args = process_command_line()
+    year = int(args.year)
+    sets = read_sweep(args.sweep_file, args.GCM_cp_path, args.dt)
+
+    print(f"\n##############################################  ")
+    print(f"   GCM cp sweep for: " )
+    print(f"      {args.model}   {args.scenario}   {year}   {args.CMIP}   {args.dt}    \n")
+    for p in sets:
+        print(f"   {p['name']:<20} units_conv={p['units_conv']}   neg_thrsh={p['neg_thrsh']}")
+    print(f"   statistics only:         {args.stats_only}       ")
+    print(f"##############################################  \n")
+
+    stats = sweep_cp( args.path_in, args.path_out, year, args.model, args.scenario,
+                      args.GCM_cp_path, args.CMIP, args.dt, sets, stats_only=args.stats_only )
+
+    os.makedirs(args.path_out, exist_ok=True)
+    file_stats = f"{args.path_out}/sweep_cp_{args.model}_{args.scenario.split('_')[0]}_{year}_{args.dt}.csv"
+    stats.to_csv(file_stats, index=False)
+    print(f"\n   written {file_stats}")
+    if len(stats)>0:
+        print( stats.groupby('name')[['pcp_in', 'cp', 'pcp_out', 'clipped']].sum() )
+
+    print(f"\n------------------------------------------------------ ")
+    print(f"     sweep {args.model} {args.scenario.split('_')[0]} {year} took {np.round((time.time()-t00)/60,1)} min ")
+    print(f"------------------------------------------------------ \n ")
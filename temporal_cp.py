@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# coding: utf-8
+######################################################################################################
+#
+# Resample GCM cp from its native frequency (6hr, 3hr, daily) to the ICAR timestep in the pipeline
+# (iso a preprocessed copy of the cp at every frequency):
+#    - the cp is taken as constant over its native interval (mean flux), so the amount of a native
+#      step (kg m-2) is split evenly over the ICAR timesteps it covers (daily -> 3hr: 1/8 each) or
+#      summed over the ICAR timestep (3hr -> daily); in general both, via the gcd of the two steps.
+#      Mass is conserved: every native amount ends up in exactly one ICAR timestep
+#    - the native time stamps are set to the start of their interval (CMIP stamps the middle), the
+#      result is labelled with the start of the ICAR timestep (label='lower')
+#    - the result is in kg m-2 per ICAR timestep, so remove_cp.py uses units_conv = 1 (the units
+#      factor of the native cp files is applied once, before resampling: remove_cp.default_units_conv)
+#    - lazy (dask) if the native cp is; with cache_dir set the cp of the whole decade is resampled
+#      once and cached (stage_cache.py), the other years of the decade read it from the cache
+#
+# Usage:
+#   set temporal_cp.source_dt (and temporal_cp.cache_dir) in the main_*.py drivers
+#   python temporal_cp.py cp_file 3hr [--var cp] [--step 24] [--units_conv 86400]   (resample a file, print the totals)
+#
+######################################################################################################
+
+import argparse
+import xarray as xr
+import numpy as np
+import math
+
+import time_axis
+import stage_cache
+import conservation
+
+
+#########################################
+#         SETTTINGS
+#######################################
+source_dt  = None   # frequency of the GCM cp files to read ('3hr', '6hr', '24hr'), None: cp at the ICAR timestep
+cache_dir  = None   # cache of the resampled cp per decade, None: resample the year in every run
+max_bytes  = stage_cache.max_bytes_default
+step_hours = {'1hr': 1, '3hr': 3, '6hr': 6, '24hr': 24, 'daily': 24}
+
+
+def process_command_line():
+    '''Parse the commandline'''
+    parser = argparse.ArgumentParser(description='resample GCM cp to another timestep (mass conserving) and print the totals')
+    parser.add_argument('cp_file',                        help='GCM cp file')
+    parser.add_argument('out_dt',                         help="timestep to resample to, e.g. '3hr' or '24hr'")
+    parser.add_argument('--var',         default='cp',    help='cp variable')
+    parser.add_argument('--step',        default=None, type=int, help='native step (hours), default: from the time axis')
+    parser.add_argument('--units_conv',  default=1., type=float, help='factor to kg m-2 per native step')
+
+    return parser.parse_args()
+
+
+def resample(amounts, out_step, step=None):
+    """ amounts (time, ...) in kg m-2 per native step of step hours (default: from the time axis) as
+        kg m-2 per out_step hours, time = start of the out_step intervals"""
+    ta   = time_axis.TimeAxis.from_dataarray(amounts.time)
+    step = ta.step_hours() if step is None else step
+    if step is None:
+        raise ValueError("cannot determine the native timestep of a single cp timestep, pass step")
+    g = math.gcd(step, out_step)
+    k = step // g          # fine steps per native step
+    r = out_step // g      # fine steps per out step
+
+    # native amounts split evenly over the fine (g hour) steps:
+    start      = ta.window_index(step)
+    fine_hours = (start[:, None] + g*np.arange(k)[None, :]).ravel()
+    fine       = amounts.isel(time=np.repeat(np.arange(len(ta)), k))
+    if k > 1:
+        fine = fine / k
+
+    # ... summed per out step:
+    window = (fine_hours // out_step) * out_step
+    hours, counts = np.unique(window, return_counts=True)
+    if r == 1:
+        out = fine
+    elif np.all(counts==r) and np.all(np.diff(fine_hours)==g):   # complete, contiguous: a reshape
+        out = fine.coarsen(time=r).sum()
+    else:
+        out = fine.assign_coords(time=window).groupby('time').sum(min_count=1)
+    if np.any(counts < r):
+        print(f"   ! {np.sum(counts < r)} of {len(counts)} {out_step}h cp steps only partly covered by the {step}h cp")
+
+    out = out.assign_coords(time=time_axis.TimeAxis(hours, ta.calendar).decode())
+    out.attrs = {**amounts.attrs, 'units': 'kg m-2',
+                 'processing_note_resample': f"resampled from {step}h to {out_step}h, mass conserving (temporal_cp.py)"}
+    return out
+
+
+def open_cp(year, m, dt, open_year, files, params):
+    """ GCM cp (kg m-2 per dt timestep) of month m (None: the whole year) on the ICAR grid, loaded
+          open_year(yr, load): the native cp of a year in kg m-2 per native step ([] / empty if none)
+          files(years):        the native cp files of years (the cache key), params: the rest of the key"""
+    out_step = step_hours[dt]
+    step     = step_hours[source_dt]
+    print(f"   GCM cp resampled from {source_dt} to {dt} (temporal_cp.py)")
+
+    if cache_dir is None:   # only this year
+        native = open_year(year, True)
+        cp     = resample(native, out_step, step=step)
+        conservation.account('resample_cp', 'cp', into=native.sum(dtype='float64'), out=cp.sum(dtype='float64'))
+    else:                   # the decade, through the cache
+        decade = (year // 10) * 10
+        years  = list(range(decade, decade+10))
+        def compute():
+            parts = [open_year(yr, False) for yr in years]
+            parts = [resample(p, out_step, step=step) for p in parts if p.sizes['time'] > 0]
+            return xr.concat(parts, dim='time').to_dataset(name='cp')
+        ds = stage_cache.cached(cache_dir, 'temporal_cp', files(years),
+                                {**params, 'decade': decade, 'source_dt': source_dt, 'dt': dt},
+                                compute, max_bytes=max_bytes)
+        cp = ds.cp
+
+    ta  = time_axis.TimeAxis.from_dataarray(cp.time)
+    sel = ta.month_slice(year, m) if m is not None else ta.year_slice(year)
+    cp  = cp.isel(time=sel).load()
+    print(f"    GCM cp shape: {cp.shape }")
+    print(f"    GCM times: {cp.time.values.min() } to {cp.time.values.max()}")
+    return cp
+
+
+###########################
+#     MAIN
+###########################
+if __name__=="__main__":
+
+    args    = process_command_line()
+    native  = xr.open_dataset(args.cp_file)[args.var] * args.units_conv
+    out     = resample(native, step_hours[args.out_dt], step=args.step)
+    into    = float(native.sum(dtype='float64'))
+    total   = float(out.sum(dtype='float64'))
+    print(f"   {native.sizes['time']} -> {out.sizes['time']} timesteps ({out.time.values[0]} - {out.time.values[-1]})")
+    print(f"   total in {into:.6g}, out {total:.6g} kg m-2 (sum), rel. deviation {(total-into)/into if into!=0 else 0.:.2e}")
@@ -0,0 +1,51 @@
+import xarray as xr
+import numpy as np
+import cftime
+import pytest
+
+import output_registry
+
+
+def hourly(calendar, n_time=48):
+    """ hourly ta2m (time, lat_y, lon_x) starting 2051-02-27 in calendar"""
+    rng  = np.random.default_rng(1)
+    time = cftime.num2date(np.arange(n_time), "hours since 2051-02-27", calendar=calendar,
+                           only_use_cftime_datetimes=(calendar!='standard'))
+    data = (280 + rng.random((n_time, 2, 3))).astype('float32')
+    return xr.DataArray(data, dims=('time', 'lat_y', 'lon_x'), coords={'time': np.asarray(time)}, name='ta2m')
+
+
+@pytest.mark.parametrize('calendar', ['noleap', 'standard'])
+@pytest.mark.parametrize('chunks', [None, 7])
+@pytest.mark.parametrize('freq_hours', [3, 24])
+@pytest.mark.parametrize('reduction', ['mean', 'min', 'max', 'instantaneous'])
+def test_reduce(calendar, chunks, freq_hours, reduction):
+    da  = hourly(calendar)
+    da  = da if chunks is None else da.chunk(time=chunks)
+    out = output_registry.reduce(da, reduction, freq_hours, 'ta2m')
+
+    windows = da.values.reshape(-1, freq_hours, 2, 3)
+    ref = windows[:, 0] if reduction=='instantaneous' else getattr(windows, reduction)(axis=1)
+    assert out.dtype == 'float32'
+    assert out.dims == da.dims
+    np.testing.assert_allclose(out.values, ref, rtol=1e-6)
+    assert list(out.time.values) == list(da.time.values[::freq_hours])
+
+
+def test_reduce_gap():
+    da  = hourly('noleap', n_time=9)
+    da  = xr.concat([da.isel(time=slice(0, 3)), da.isel(time=slice(7, 9))], dim='time')
+    out = output_registry.reduce(da, 'mean', 3, 'ta2m')
+    assert np.isnan(out.values[1]).all()
+    np.testing.assert_allclose(out.values[2], da.values[3:].mean(axis=0), rtol=1e-6)
+
+    # no timestep at 06h: the nearest one (07h)
+    out = output_registry.reduce(da, 'instantaneous', 3, 'ta2m')
+    np.testing.assert_allclose(out.values[2], da.values[3])
+
+
+def test_build_noleap():
+    ds = xr.Dataset({'ta2m': hourly('noleap'), 'u10m': hourly('noleap'), 'v10m': hourly('noleap')})
+    out = output_registry.build(ds, 24, output_registry.select(24, list(ds.data_vars), ['Tmax', 'Tmin', 'Wind']))
+    assert [t.strftime('%m-%d') for t in out.time.values] == ['02-27', '02-28']
+    np.testing.assert_allclose(out['Tmax'].values, ds.ta2m.values.reshape(2, 24, 2, 3).max(axis=1))
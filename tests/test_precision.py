@@ -0,0 +1,53 @@
+import xarray as xr
+import numpy as np
+import cftime
+import pytest
+
+import precision
+import aggregate_in_time
+
+
+def precip_dt(calendar, n_time=48, step_hours=1):
+    """ hourly precip_dt (time, lat_y, lon_x) starting 2051-02-27 in calendar"""
+    rng   = np.random.default_rng(0)
+    hours = np.arange(n_time) * step_hours
+    time  = cftime.num2date(hours, "hours since 2051-02-27", calendar=calendar,
+                            only_use_cftime_datetimes=(calendar!='standard'))
+    data  = rng.random((n_time, 2, 3)).astype('float32')
+    return xr.DataArray(data, dims=('time', 'lat_y', 'lon_x'), coords={'time': np.asarray(time)}, name='precip_dt')
+
+
+@pytest.mark.parametrize('calendar', ['noleap', 'standard'])
+@pytest.mark.parametrize('chunks', [None, 5])
+@pytest.mark.parametrize('freq_hours', [3, 24])
+def test_resample_sum(calendar, chunks, freq_hours):
+    da  = precip_dt(calendar)
+    da  = da if chunks is None else da.chunk(time=chunks)
+    out = precision.resample_sum(da, freq_hours)
+
+    ref = da.values.astype('float64').reshape(-1, freq_hours, 2, 3).sum(axis=1)
+    assert out.dtype == 'float32'
+    np.testing.assert_allclose(out.values, ref, rtol=1e-6)
+    assert list(out.time.values) == list(da.time.values[::freq_hours])
+
+
+def test_resample_sum_noleap_feb28():
+    """ 2051-02-28 is followed by 2051-03-01 in noleap (no Feb 29 window)"""
+    out = precision.resample_sum(precip_dt('noleap', n_time=72), 24)
+    assert [t.strftime('%m-%d') for t in out.time.values] == ['02-27', '02-28', '03-01']
+
+
+def test_resample_sum_empty_window():
+    da  = precip_dt('noleap', n_time=9)
+    da  = xr.concat([da.isel(time=slice(0, 3)), da.isel(time=slice(6, 9))], dim='time')
+    out = precision.resample_sum(da, 3)
+    assert len(out.time) == 3
+    assert np.isnan(out.values[1]).all()
+    np.testing.assert_allclose(out.values[2], da.values[3:].sum(axis=0), rtol=1e-6)
+
+
+def test_yearly_24h_file_noleap():
+    ds = precip_dt('noleap').to_dataset()
+    ds.attrs['history'] = 'test'
+    ds_daily = aggregate_in_time.make_yearly_24h_file(ds)
+    np.testing.assert_allclose(ds_daily['Prec'].values, ds.precip_dt.values.reshape(2, 24, 2, 3).sum(axis=1), rtol=1e-6)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# coding: utf-8
+######################################################################################################
+#
+# Two-pass tiled version of fix_neg_pcp + aggregate_in_time, for domains / periods that do not fit
+# in memory:
+#    - pass 1: stream lat_y/lon_x tiles of the cumulative variables, to find the timesteps where ANY
+#              pixel has a negative timestep amount (the same global decision as correct_var)
+#    - pass 2: per tile: calculate the _dt variables, set the bad timesteps to NaN, interpolate in
+#              time, set small negative values to 0, aggregate to 3hr / 24hr and write the tile
+#              into the (pre-created) output file
+#
+#   memory is set by tile_size (all timesteps of one tile), not by the size of the domain.
+#
+# Usage:
+#   - called from main_3hr.py / main_24hr.py (tiled=True)
+#
+######################################################################################################
+
+import xarray as xr
+import dask.array as da
+import numpy as np
+import datetime
+import netCDF4
+import time
+
+import fix_neg_pcp as fix
+import precision
+import time_axis
+import icar_io
+import stream_aggregate as stream
+import output_registry
+
+
+def make_tiles(ny, nx, tile_size):
+    """ list of (lat_y slice, lon_x slice) covering the domain"""
+    return [ (slice(y0, min(y0+tile_size, ny)), slice(x0, min(x0+tile_size, nx)))
+             for y0 in range(0, ny, tile_size) for x0 in range(0, nx, tile_size) ]
+
+
+def _tile(ds, ds_next, varname, sy, sx):
+    """ all timesteps of one tile of varname (+ the first timesteps of next month/year), as numpy"""
+    a = ds[varname][:, sy, sx].values
+    if ds_next is not None:
+        a = np.concatenate([a, ds_next[varname][:, sy, sx].values])
+    return a
+
+
+def _aggregate(x, starts, reduction):
+    """ reduce x (time, y, x) over the windows that start at indices starts"""
+    ends = list(starts[1:]) + [len(x)]
+    out  = []
+    with np.errstate(invalid='ignore'):
+        for i0, i1 in zip(starts, ends):
+            seg = x[i0:i1]
+            if reduction=='sum':
+                out.append( precision.compensated_sum(seg, axis=0) )
+            elif reduction=='mean':
+                out.append( np.nanmean(seg, axis=0) )
+            elif reduction=='min':
+                out.append( np.nanmin(seg, axis=0) )
+            elif reduction=='max':
+                out.append( np.nanmax(seg, axis=0) )
+            elif reduction in ['instantaneous', 'first']:
+                out.append( seg[0] )
+            elif reduction=='last':
+                out.append( seg[-1] )
+    return np.stack(out)
+
+
+##############################################################################################
+#      pass 1: timesteps with negative values anywhere in the domain                         #
+##############################################################################################
+def find_bad_timesteps(ds, ds_next, vars_to_correct, tiles, neg_thrsh=fix.neg_thrsh):
+    """ {varname_dt: boolean array} of the timesteps (of the diff) with values < neg_thrsh in any tile"""
+    bad = {}
+    for varname, varname_dt in vars_to_correct.items():
+        if varname not in ds.data_vars: continue
+        for sy, sx in tiles:
+            dt = np.diff( _tile(ds, ds_next, varname, sy, sx), axis=0 )
+            b  = (dt < neg_thrsh).reshape(len(dt), -1).any(axis=1)
+            bad[varname_dt] = b if varname_dt not in bad else (bad[varname_dt] | b)
+        print(f'      {varname}: {np.sum(bad[varname_dt])} negative timesteps found')
+        for i in np.where(bad[varname_dt])[0]:
+            t = ds.time.values[i] if i < len(ds.time) else ds_next.time.values[i-len(ds.time)]
+            print( '      ', t )
+    return bad
+
+
+##############################################################################################
+#      pass 2: correct, interpolate, aggregate and write tile by tile                        #
+##############################################################################################
+def create_output(file_out, ds, products, freq_hours, window_hours, calendar):
+    """ write coords/attrs and empty (fill value) variables of the full output, tiles are written later"""
+    ny, nx   = len(ds.lat_y), len(ds.lon_x)
+    ds_out   = xr.Dataset(coords={'time': time_axis.TimeAxis(window_hours, calendar).decode()})
+    for c in ['lat', 'lon']:
+        if c in ds.coords: ds_out.coords[c] = ds[c].load()
+    ds_out.attrs = dict(ds.attrs)
+    res = '3 hourly' if freq_hours==3 else 'daily'
+    ds_out.attrs['history'] = ds_out.attrs.get('history', '') + f', modified to {res} data (tiled) on '+str(datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
+    encoding = {'time': {'units': stream.time_units, 'calendar': calendar, 'dtype': 'float64'}}
+    for name in products:
+        ds_out[name] = (('time', 'lat_y', 'lon_x'), da.zeros((len(window_hours), ny, nx), dtype='float32', chunks=(1, ny, nx)))
+        ds_out[name].attrs = stream.product_attrs(name, ds, freq_hours, products[name][0])
+        encoding[name] = {'dtype': 'float32', '_FillValue': np.float32(np.nan)}
+    # compute=False: only the metadata is written, the data of all tiles follows in pass 2
+    ds_out.to_netcdf(file_out, encoding=encoding, compute=False)
+
+
+def correct_and_aggregate_tiled(files_in, nextfile_in, vars_to_correct, freq_hours, file_out,
+                                tile_size=120, neg_thrsh=fix.neg_thrsh):
+    """ correct neg pcp and aggregate to freq_hours (3 or 24), tile by tile, writing to file_out"""
+
+    ds = icar_io.open_icar(files_in)
+    ds_next = None
+    if nextfile_in is not None:
+        ds_next = icar_io.open_file(nextfile_in).isel(time=slice(0, 2))   # 2: in case the last timestep is negative
+
+    vars_to_correct = {k: v for k, v in vars_to_correct.items() if k in ds.data_vars}
+    dt_vars  = [vars_to_correct.get(v, v) for v in ds.data_vars]
+    products = output_registry.products(freq_hours, dt_vars)
+    inputs   = sorted(set( v for p in products.values() for v in p[0] ))
+    inv      = {v: k for k, v in vars_to_correct.items()}
+
+    t_axis   = time_axis.TimeAxis.from_dataarray(ds.time)
+    windows  = t_axis.window_index(freq_hours)
+    starts   = np.concatenate([[0], np.where(np.diff(windows)!=0)[0]+1])
+    tiles    = make_tiles(len(ds.lat_y), len(ds.lon_x), tile_size)
+    n_time   = len(ds.time)
+
+    print(f"   tiled correction: {len(tiles)} tiles of max {tile_size}x{tile_size}, {n_time} timesteps -> {len(starts)} windows")
+
+    # ______ pass 1 ______
+    t0 = time.time()
+    bad = find_bad_timesteps(ds, ds_next, vars_to_correct, tiles, neg_thrsh=neg_thrsh)
+    print(f"   pass 1 (find negative timesteps) took {np.round(time.time()-t0,1)} sec")
+
+    # ______ pass 2 ______
+    t0 = time.time()
+    create_output(file_out, ds, products, freq_hours, windows[starts], t_axis.calendar)
+
+    with netCDF4.Dataset(file_out, 'a') as nc:
+        for sy, sx in tiles:
+            data = {}
+            for v in inputs:
+                if v in inv:   # timestep variable from cumulative (no next month/year: last timestep NaN)
+                    boundary = None if ds_next is None else ds_next[inv[v]][:, sy, sx].values
+                    data[v]  = fix.repair_columns( ds[inv[v]][:, sy, sx].values, boundary, bad[v],
+                                                   dtype=precision.policy_dtype(v) )
+                else:
+                    data[v] = ds[v][:, sy, sx].values
+
+            for name, (inp, reduction, derive) in products.items():
+                x = data[inp[0]] if derive is None else derive(*[data[v] for v in inp])
+                nc[name][:, sy, sx] = _aggregate(x, starts, reduction).astype(precision.policy_dtype(name))
+
+    print(f"   pass 2 (correct, aggregate, write {file_out.split('/')[-1]}) took {np.round(time.time()-t0,1)} sec")
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# coding: utf-8
+######################################################################################################
+#
+# Integer time axis:
+#    - time is decoded once to integer hours since 1900-01-01 (plus the calendar)
+#    - year / month selection is a searchsorted on that axis (no cftime .dt accessors)
+#    - resample windows (3hr, 24hr) are integer divisions, gaps are integer diffs
+#    - times are only turned back into datetime64 / cftime objects when writing
+#
+#   e.g. selecting one month out of a 150 year daily GCM cp file, opened with decode_times=False:
+#       ta  = TimeAxis.from_raw(ds.time)
+#       sub = xr.decode_cf( ds.isel(time=ta.month_slice(2051, 2)) )
+#
+# Usage:
+#   - imported by remove_cp, interp_missing, check_complete, stream_aggregate and precision
+#
+######################################################################################################
+
+import xarray as xr
+import numpy as np
+import cftime
+
+
+epoch = "hours since 1900-01-01"
+
+# hours per unit of the netcdf time units ('days since ...' etc.)
+hours_per_unit = {'days': 24., 'day': 24., 'hours': 1., 'hour': 1., 'h': 1.,
+                  'minutes': 1/60., 'minute': 1/60., 'seconds': 1/3600., 'second': 1/3600., 's': 1/3600.}
+
+
+class TimeAxis:
+    """ time as integer hours since 1900-01-01 in a given calendar """
+
+    def __init__(self, hours, calendar='standard'):
+        self.hours    = np.asarray(hours, dtype='int64')
+        self.calendar = calendar
+
+    def __len__(self):
+        return len(self.hours)
+
+    # ________ construction (decode once) ________
+    @classmethod
+    def from_values(cls, values, calendar=None):
+        """ from an array of datetime64 or cftime objects"""
+        values = np.asarray(values)
+        if np.issubdtype(values.dtype, np.datetime64):
+            hours = (values - np.datetime64('1900-01-01')) // np.timedelta64(1, 'h')
+            return cls(hours, 'standard' if calendar is None else calendar)
+        if calendar is None:
+            calendar = values.flat[0].calendar if values.size>0 else 'standard'
+        return cls(np.round(cftime.date2num(values, epoch, calendar=calendar)), calendar)
+
+    @classmethod
+    def from_dataarray(cls, time):
+        """ from a decoded time coordinate (DataArray)"""
+        calendar = time.encoding.get('calendar', None)
+        if calendar is None and time.dtype==object:
+            calendar = time.values.flat[0].calendar
+        return cls.from_values(time.values, calendar)
+
+    @classmethod
+    def from_raw(cls, time):
+        """ from an undecoded time coordinate (opened with decode_times=False): numbers + units attr.
+            Only integer / float arithmetic, no cftime objects are created."""
+        units    = time.attrs['units']
+        calendar = time.attrs.get('calendar', 'standard')
+        step, ref = units.split(' since ')
+        ref_hours = cftime.date2num(cftime.num2date(0, f"hours since {ref}", calendar=calendar), epoch, calendar=calendar)
+        hours = np.asarray(time.values, dtype='float64') * hours_per_unit[step.strip().lower()] + ref_hours
+        return cls(np.round(hours), calendar)
+
+    # ________ calendar arithmetic ________
+    def hour_of(self, year, month=1, day=1, hour=0):
+        """ hours since 1900-01-01 of a date in this calendar"""
+        return int(round(cftime.date2num(cftime.datetime(year, month, day, hour, calendar=self.calendar), epoch, calendar=self.calendar)))
+
+    def between(self, h_start, h_end):
+        """ slice of the timesteps h_start <= t < h_end (axis must be sorted)"""
+        i0 = np.searchsorted(self.hours, h_start, side='left')
+        i1 = np.searchsorted(self.hours, h_end,   side='left')
+        return slice(int(i0), int(i1))
+
+    def year_slice(self, year):
+        return self.between( self.hour_of(int(year)), self.hour_of(int(year)+1) )
+
+    def month_slice(self, year, month):
+        year, month = int(year), int(month)
+        next_y, next_m = (year+1, 1) if month==12 else (year, month+1)
+        return self.between( self.hour_of(year, month), self.hour_of(next_y, next_m) )
+
+    def window_index(self, freq_hours):
+        """ start hour of the (freq_hours long) window every timestep falls in"""
+        return (self.hours // freq_hours) * freq_hours
+
+    def window_starts(self, freq_hours):
+        """ start hours of all windows from the first to the last timestep (also windows without timesteps)"""
+        windows = self.window_index(freq_hours)
+        return np.arange(windows[0], windows[-1]+1, freq_hours) if len(windows)>0 else windows
+
+    # ________ timestep / gaps ________
+    def step_hours(self):
+        """ (smallest) timestep in hours"""
+        return int(np.min(np.diff(self.hours))) if len(self.hours)>1 else None
+
+    def gaps(self):
+        """ indices i where the step from i to i+1 is larger than the timestep"""
+        d = np.diff(self.hours)
+        return np.where( d > d.min() )[0] if len(d)>0 else np.array([], dtype='int64')
+
+    def full(self, step_hours=None):
+        """ axis without gaps, from first to last timestep"""
+        step_hours = self.step_hours() if step_hours is None else step_hours
+        return TimeAxis(np.arange(self.hours[0], self.hours[-1]+1, step_hours), self.calendar)
+
+    # ________ back to datetimes (for writing) ________
+    def decode(self):
+        """ datetime64[ns] for standard calendars, cftime objects otherwise (as xarray decodes)"""
+        times = cftime.num2date(self.hours, epoch, calendar=self.calendar,
+                                only_use_cftime_datetimes=False, only_use_python_datetimes=False)
+        times = np.asarray(times)
+        if times.size>0 and not isinstance(times.flat[0], cftime.datetime):
+            times = times.astype('datetime64[ns]')
+        return times
+
+    def to_dataarray(self):
+        return xr.DataArray(self.decode(), dims=['time'], name='time')
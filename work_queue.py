@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# coding: utf-8
+######################################################################################################
+#
+# Work queue on a shared filesystem: any number of workers (on any nodes) claim, run and complete
+# the (model, scenario, year) tasks, instead of a fixed year per array index:
+#    - every task is a small json file in queue_dir/todo | claimed | done | failed
+#    - a worker claims a task by renaming it from todo/ to claimed/ (atomic: only one worker wins)
+#    - while the task runs the worker touches the claimed file (heartbeat); claims without a
+#      heartbeat for stale_s (worker killed / node died / walltime) are put back in todo/; a worker
+#      that finds its claim gone stops its task, so a year never runs twice at the same time
+#    - a failed task (nonzero exit code) goes back to todo/ until max_attempts, then to failed/
+#    - no server or database, only rename / utime, so it works on glade / NFS / lustre and on one
+#      machine with several workers
+#
+# Usage:
+#   python work_queue.py init queue_dir "python -u main_3hr_from3hinput.py PATH_IN PATH_OUT {year} {model} {scen} True GCM_PATH CMIP6"
+#                             --models A B --scenarios ssp245_2004 --years 2005 2050      (or --tasks plan_dir/tasks_3hr.csv)
+#   python work_queue.py worker queue_dir [--max_tasks N] [--idle_exit]      (in the job script / several per node)
+#   python work_queue.py status queue_dir [--retry_failed]
+#
+######################################################################################################
+
+import argparse
+import pandas as pd
+import subprocess
+import threading
+import signal
+import socket
+import json
+import glob
+import time
+import sys
+import os
+
+
+states = ['todo', 'claimed', 'done', 'failed']
+
+heartbeat_s  = 60
+stale_s      = 600    # > heartbeat_s, claims older than this are requeued
+max_attempts = 3
+
+
+def process_command_line():
+    '''Parse the commandline'''
+    parser = argparse.ArgumentParser(description='file based work queue for the postprocessing tasks')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('init', help='add tasks to the queue')
+    p.add_argument('queue_dir',                  help='queue directory (shared filesystem)')
+    p.add_argument('cmd',                        help='command, with {model} {scen} {year} placeholders')
+    p.add_argument('--models',    nargs='*',     help='models')
+    p.add_argument('--scenarios', nargs='*',     help='scenarios')
+    p.add_argument('--years',     nargs=2, type=int, help='first and last year')
+    p.add_argument('--tasks',     default=None,  help='csv with model, scenario, year columns (e.g. from plan_jobs.py)')
+
+    p = sub.add_parser('worker', help='claim and run tasks until the queue is empty')
+    p.add_argument('queue_dir',                  help='queue directory')
+    p.add_argument('--max_tasks', default=None, type=int, help='stop after max_tasks tasks')
+    p.add_argument('--idle_exit', action='store_true',    help='exit when nothing is left in todo/ (do not wait for claimed tasks)')
+    p.add_argument('--log_dir',   default=None,  help='task output (default: queue_dir/logs)')
+
+    p = sub.add_parser('status', help='show the queue')
+    p.add_argument('queue_dir',                  help='queue directory')
+    p.add_argument('--retry_failed', action='store_true', help='move failed tasks back to todo/')
+
+    return parser.parse_args()
+
+
+def task_name(model, scen, year):
+    return f"{model}__{scen.replace('/', '_')}__{year}"
+
+
+def _base(f):
+    """ task name of a file in any state (claimed files have the worker appended)"""
+    return os.path.basename(f).split('.json')[0].split('@')[0]
+
+
+def _read(f):
+    with open(f) as fh:
+        return json.load(fh)
+
+
+def _write(f, task):
+    """ write via a tmp file + rename, so other workers never see half a file"""
+    tmp = f"{f}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as fh:
+        json.dump(task, fh)
+    os.replace(tmp, f)
+
+
+##############################################################################################
+#      queue                                                                                  #
+##############################################################################################
+class WorkQueue:
+    """ lock-file queue of tasks in queue_dir/{todo,claimed,done,failed} """
+
+    def __init__(self, queue_dir):
+        self.queue_dir = queue_dir
+        for s in states:
+            os.makedirs(f"{queue_dir}/{s}", exist_ok=True)
+        self.worker = f"{socket.gethostname()}_{os.getpid()}"
+
+    def files(self, state):
+        return sorted(glob.glob(f"{self.queue_dir}/{state}/*.json"))
+
+    def add(self, model, scen, year, cmd):
+        """ add a task to todo/ (unless it is already in the queue)"""
+        name = task_name(model, scen, year)
+        if any(_base(f)==name for s in states for f in self.files(s)):
+            return False
+        _write(f"{self.queue_dir}/todo/{name}.json",
+               dict(model=model, scenario=scen, year=int(year), cmd=cmd.format(model=model, scen=scen, year=year),
+                    attempts=0, history=[]))
+        return True
+
+    def claim(self):
+        """ (claimed file, task) of the next todo task, or None if todo/ is empty"""
+        for f in self.files('todo'):
+            claimed = f"{self.queue_dir}/claimed/{_base(f)}@{self.worker}.json"
+            try:
+                os.rename(f, claimed)   # atomic: only one worker gets it
+            except FileNotFoundError:   # claimed by another worker
+                continue
+            os.utime(claimed)
+            return claimed, _read(claimed)
+        return None
+
+    def finish(self, claimed, task, returncode, wall_s):
+        """ move the claimed task to done/, back to todo/ (retry) or to failed/"""
+        task['attempts'] += 1
+        task['history'].append(dict(worker=self.worker, returncode=returncode, wall_s=round(wall_s, 1),
+                                    end=time.strftime("%Y/%m/%d %H:%M:%S")))
+        if returncode==0:
+            state = 'done'
+        elif task['attempts'] < max_attempts:
+            state = 'todo'
+        else:
+            state = 'failed'
+        # take the claim first (atomic, raises if it was requeued meanwhile), then write the result;
+        # still a claimed/*.json file, so it is requeued as stale if the worker dies before the move:
+        finishing = f"{claimed[:-len('.json')]}.finishing.json"
+        os.rename(claimed, finishing)
+        _write(finishing, task)
+        os.rename(finishing, f"{self.queue_dir}/{state}/{_base(claimed)}.json")
+        return state
+
+    def requeue_stale(self, max_age=None):
+        """ put claims without heartbeat for max_age (default stale_s) seconds back in todo/"""
+        max_age = stale_s if max_age is None else max_age
+        n = 0
+        for f in self.files('claimed'):
+            try:
+                age = time.time() - os.path.getmtime(f)
+                if age < max_age: continue
+                os.rename(f, f"{self.queue_dir}/todo/{_base(f)}.json")
+            except FileNotFoundError:   # finished / requeued meanwhile
+                continue
+            print(f"   requeued stale task {_base(f)} (no heartbeat for {int(age)} sec)")
+            n += 1
+        return n
+
+    def retry_failed(self):
+        for f in self.files('failed'):
+            task = _read(f)
+            task['attempts'] = 0
+            _write(f, task)
+            os.rename(f, f"{self.queue_dir}/todo/{_base(f)}.json")
+
+    def counts(self):
+        return {s: len(self.files(s)) for s in states}
+
+
+##############################################################################################
+#      worker                                                                                 #
+##############################################################################################
+def run_task(claimed, task, log_dir):
+    """ run the task's command, touching the claimed file every heartbeat_s; returns exit code.
+        The command is terminated when the claim is lost (requeued and possibly run by another worker)"""
+    os.makedirs(f"{log_dir}/{task['model']}_{task['scenario']}", exist_ok=True)
+    log = f"{log_dir}/{task['model']}_{task['scenario']}/{task['year']}_attempt{task['attempts']+1}"
+    with open(log, 'w') as fh:
+        proc = subprocess.Popen(task['cmd'], shell=True, stdout=fh, stderr=subprocess.STDOUT, start_new_session=True)
+
+        stop = threading.Event()
+        def heartbeat():
+            while not stop.wait(heartbeat_s):
+                try:
+                    os.utime(claimed)
+                except FileNotFoundError:   # requeued by another worker (we were considered dead)
+                    print(f"   ! claim of {_base(claimed)} was lost, stopping the task")
+                    _stop(proc)
+                    return
+        hb = threading.Thread(target=heartbeat, daemon=True)
+        hb.start()
+        try:
+            returncode = proc.wait()
+        finally:
+            stop.set()
+            hb.join()
+            if proc.poll() is None:   # interrupted worker
+                _stop(proc)
+    return returncode
+
+
+def _stop(proc, grace_s=30):
+    """ terminate the task's process group (the shell and the python it runs), kill it after grace_s"""
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+        proc.wait(grace_s)
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def worker(queue_dir, max_tasks=None, idle_exit=False, log_dir=None):
+    """ claim and run tasks until the queue is empty (no todo and no claimed tasks)"""
+    queue   = WorkQueue(queue_dir)
+    log_dir = f"{queue_dir}/logs" if log_dir is None else log_dir
+    n_done  = 0
+    print(f"   worker {queue.worker} on {queue_dir}")
+    while max_tasks is None or n_done < max_tasks:
+        queue.requeue_stale()
+        claim = queue.claim()
+        if claim is None:
+            # nothing to do: wait for running tasks of other workers, they may fail and come back
+            if idle_exit or len(queue.files('claimed'))==0:
+                break
+            time.sleep(heartbeat_s)
+            continue
+
+        claimed, task = claim
+        print(f"   {time.strftime('%H:%M:%S')}  start {task['model']} {task['scenario']} {task['year']} (attempt {task['attempts']+1})")
+        t0 = time.time()
+        returncode = run_task(claimed, task, log_dir)
+        try:
+            state = queue.finish(claimed, task, returncode, time.time()-t0)
+        except FileNotFoundError:
+            print(f"   ! {_base(claimed)} was requeued while running, result not recorded")
+            continue
+        print(f"   {time.strftime('%H:%M:%S')}  {state:<6} {task['model']} {task['scenario']} {task['year']} "
+              f"(exit {returncode}, {round(time.time()-t0)} sec)")
+        n_done += 1
+    print(f"   worker {queue.worker} done, ran {n_done} tasks. {queue.counts()}")
+
+
+###########################
+#     MAIN
+###########################
+if __name__=="__main__":
+
+    args = process_command_line()
+
+    if args.command=='init':
+        queue = WorkQueue(args.queue_dir)
+        if args.tasks is not None:
+            tasks = pd.read_csv(args.tasks)[['model', 'scenario', 'year']].values.tolist()
+        elif args.models and args.scenarios and args.years:
+            tasks = [(m, s, y) for m in args.models for s in args.scenarios for y in range(args.years[0], args.years[1]+1)]
+        else:
+            sys.exit("   init needs --tasks or --models, --scenarios and --years")
+        n = sum(queue.add(m, s, y, args.cmd) for m, s, y in tasks)
+        print(f"   added {n} of {len(tasks)} tasks to {args.queue_dir}: {queue.counts()}")
+
+    elif args.command=='worker':
+        worker(args.queue_dir, args.max_tasks, args.idle_exit, args.log_dir)
+
+    elif args.command=='status':
+        queue = WorkQueue(args.queue_dir)
+        if args.retry_failed:
+            queue.retry_failed()
+        print(f"   {queue.counts()}")
+        for f in queue.files('claimed'):
+            print(f"      running  {_base(f):<45} {os.path.basename(f).split('@')[1][:-5]:<25} heartbeat {int(time.time()-os.path.getmtime(f))} sec ago")
+        for f in queue.files('failed'):
+            task = _read(f)
+            print(f"      failed   {_base(f):<45} exit codes {[h['returncode'] for h in task['history']]}")